@@ -0,0 +1,502 @@
+import asyncio
+import atexit
+import contextlib
+import dataclasses
+import itertools
+import threading
+import time
+from typing import Callable, Iterator
+
+from google import genai
+from google.genai import types
+
+import compaction
+import rate_limit
+import sessions
+import stats
+import tokens
+import tracing
+from config import (
+    MODEL_ID,
+    MAX_ITERATIONS,
+    COMPACTION_ENABLED,
+    DEDUPLICATION_ENABLED,
+    CONTEXT_CACHE_ENABLED,
+    MAX_REQUEST_TOKENS,
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_EXPECTED_RESPONSE_TOKENS,
+    STATS_MAX_TOKENS_PER_DAY,
+)
+from retry import resilient_caller
+from call_function import FunctionCallDispatcher, ResultDeduplicator, available_functions, call_functions_async, system_prompt
+from context_cache import ContextCache, default_config
+from functions.apply_patch import patch_metrics
+
+
+token_estimator = tokens.TokenEstimator(
+    overhead_characters=len(system_prompt) + len(available_functions.model_dump_json(exclude_none=True)),
+)
+"""Estimates the prompt tokens of every request before it's sent. Shared by all the sessions
+of the process, so that its calibration improves with every response."""
+
+
+_context_caches: dict[int, ContextCache] = {}
+_context_caches_lock = threading.Lock()
+
+
+def context_cache(client: genai.Client) -> ContextCache | None:
+    """Returns the context cache of the given client, shared by all the sessions using it
+    (e.g. those of the daemon and of a batch), so that they reuse the same cached content.
+    Context caches are deleted when the process exits, see `close_context_caches()`."""
+    if not CONTEXT_CACHE_ENABLED:
+        return None
+    with _context_caches_lock:
+        # The cache keeps a reference to its client, so the id is never reused by another one
+        cache = _context_caches.get(id(client))
+        if cache is None:
+            cache = _context_caches[id(client)] = ContextCache(client)
+        return cache
+
+
+def close_context_caches() -> None:
+    """Deletes the server-side cached contents, instead of paying for their storage until they expire."""
+    with _context_caches_lock:
+        caches = list(_context_caches.values())
+        _context_caches.clear()
+    for cache in caches:
+        cache.close()
+
+
+atexit.register(close_context_caches)
+
+
+@dataclasses.dataclass
+class AgentUsage:
+    """Totals for one agent session, updated after each response."""
+    iterations: int = 0
+    prompt_tokens: int = 0
+    response_tokens: int = 0
+    total_tokens: int = 0
+
+    def add(self, usage_metadata: types.GenerateContentResponseUsageMetadata | None) -> None:
+        self.iterations += 1
+        if usage_metadata is not None:
+            self.prompt_tokens += usage_metadata.prompt_token_count or 0
+            self.response_tokens += usage_metadata.candidates_token_count or 0
+            self.total_tokens += usage_metadata.total_token_count or 0
+
+
+def agent_request(
+    prompt: str,
+    api_key: str,
+    verbose: bool,
+    stream: bool = False,
+    client: genai.Client | None = None,
+    usage: AgentUsage | None = None,
+    session: sessions.Session | None = None,
+) -> str:
+    """Starts the agent, which will iterate over the user prompt and the result
+    of available functions (called by the agent) until one of these things happen,
+    whichever comes first;
+    - the agent believes it satisfied the user request
+    - the agent concludes it cannot satisfy the user request
+    - the max number of iterations is reached
+
+    Return's the agent final answer, or raises an exception.
+
+    With `stream` enabled, text is printed as soon as it is received and every function call
+    starts executing as soon as it's received, without waiting for the full response.
+
+    A `client` can be provided to share its connection pool between sessions,
+    and a `usage` object to collect the session iterations and tokens.
+
+    With a `session`, every iteration is saved to disk, and the conversation continues
+    from the messages already saved in it. The prompt is then optional, if given it's
+    added after them.
+
+    WARNING: Note that the agent is able to use some tools that can edit existing files
+    and execute Python scripts, there are some basic safeguards but the wrong prompt
+    can wreak havoc. You've been warned.
+    """
+    # Will contain all messages in the conversation, which will be provided
+    # with each request to the LLM so it can use the whole thing as context.
+    messages = _initial_messages(prompt, session, verbose)
+    deduplicator = _deduplicator(messages)
+
+    if client is None:
+        client = genai.Client(api_key=api_key)
+    shared_context_cache = context_cache(client)
+
+    for iteration in range(MAX_ITERATIONS):
+        if verbose:
+            if iteration > 0:
+                print("\n------------------------------\n")
+            print("Sending request.")
+
+        contents = _compact(messages, verbose)
+        contents = _check_token_budget(client, messages, contents, verbose)
+        estimated_tokens = token_estimator.estimate(contents)
+        config, request_contents = _request_config(contents, shared_context_cache)
+
+        dispatcher = FunctionCallDispatcher(verbose, deduplicator=deduplicator)
+        with _rate_limit(estimated_tokens + RATE_LIMIT_EXPECTED_RESPONSE_TOKENS) as reservation:
+            start = time.perf_counter()
+            with tracing.span("generate_content", iteration=iteration, stream=stream) as span:
+                if stream:
+                    response = _generate_content_stream(client, request_contents, config, dispatcher)
+                else:
+                    response = resilient_caller.call(lambda: client.models.generate_content(
+                        model=MODEL_ID,
+                        contents=request_contents,
+                        config=config,
+                    ), discarded=_record_discarded(estimated_tokens, _conversation_id(session), iteration))
+                    for called_function in response.function_calls or []:
+                        dispatcher.submit(called_function)
+                _trace_response(span, response)
+
+            latency = time.perf_counter() - start
+            reservation.record(lambda: stats.add(response.usage_metadata, _conversation_id(session), iteration, MODEL_ID, latency))
+        if usage is not None:
+            usage.add(response.usage_metadata)
+
+        _append_response(messages, response, verbose)
+        _calibrate(contents, estimated_tokens, response, verbose)
+
+        # Function calls started as soon as they were received, this is the time spent waiting for them
+        with tracing.span("function_results", iteration=iteration):
+            function_call_results = dispatcher.results()
+        stats.add_tool_calls(dispatcher.executed_calls, _conversation_id(session), iteration)
+        if response.function_calls:
+            _append_function_results(messages, response.function_calls, function_call_results, verbose)
+        if session is not None:
+            with tracing.span("session.record"):
+                session.record(messages, response.usage_metadata)
+        # Without function calls, this was the final message from the AI, no further action is needed.
+        if not response.function_calls and response.text:
+            return response.text
+
+    raise Exception("Agent loop was terminated due to reaching the max iterations limit.")
+
+
+async def async_agent_request(
+    prompt: str,
+    api_key: str,
+    verbose: bool,
+    client: genai.Client | None = None,
+    usage: AgentUsage | None = None,
+    session: sessions.Session | None = None,
+) -> str:
+    """Same as `agent_request`, but never blocks the event loop: the model is called
+    through the async client, scripts run as asyncio subprocesses and stats are written
+    from a worker thread. This allows running many agent sessions in a single process.
+
+    A `client`, a `usage` object and a `session` can be provided, as for `agent_request`.
+    """
+    messages = _initial_messages(prompt, session, verbose)
+    deduplicator = _deduplicator(messages)
+
+    if client is None:
+        client = genai.Client(api_key=api_key)
+    shared_context_cache = context_cache(client)
+
+    for iteration in range(MAX_ITERATIONS):
+        if verbose:
+            if iteration > 0:
+                print("\n------------------------------\n")
+            print("Sending request.")
+
+        contents = _compact(messages, verbose)
+        contents = await asyncio.to_thread(_check_token_budget, client, messages, contents, verbose)
+        estimated_tokens = token_estimator.estimate(contents)
+        config, request_contents = await asyncio.to_thread(_request_config, contents, shared_context_cache)
+
+        async with _rate_limit_async(estimated_tokens + RATE_LIMIT_EXPECTED_RESPONSE_TOKENS) as reservation:
+            start = time.perf_counter()
+            with tracing.span("generate_content", iteration=iteration, stream=False) as span:
+                record_discarded = _record_discarded(estimated_tokens, _conversation_id(session), iteration)
+                response = await resilient_caller.call_async(lambda: client.aio.models.generate_content(
+                    model=MODEL_ID,
+                    contents=request_contents,
+                    config=config,
+                ), discarded=lambda discarded: asyncio.get_running_loop().run_in_executor(None, record_discarded, discarded))
+                _trace_response(span, response)
+
+            latency = time.perf_counter() - start
+            # The database write happens in a worker thread, not to block the event loop
+            await asyncio.to_thread(reservation.record, lambda: stats.add(response.usage_metadata, _conversation_id(session), iteration, MODEL_ID, latency))
+        if usage is not None:
+            usage.add(response.usage_metadata)
+
+        _append_response(messages, response, verbose)
+        _calibrate(contents, estimated_tokens, response, verbose)
+
+        if response.function_calls:
+            executed_calls: list[stats.ToolCall] = []
+            with tracing.span("function_results", iteration=iteration):
+                function_call_results = await call_functions_async(response.function_calls, verbose, executed_calls, deduplicator)
+            await asyncio.to_thread(stats.add_tool_calls, executed_calls, _conversation_id(session), iteration)
+            _append_function_results(messages, response.function_calls, function_call_results, verbose)
+        if session is not None:
+            with tracing.span("session.record"):
+                await asyncio.to_thread(session.record, messages, response.usage_metadata)
+        if not response.function_calls and response.text:
+            return response.text
+
+    raise Exception("Agent loop was terminated due to reaching the max iterations limit.")
+
+
+def _generate_content_stream(
+    client: genai.Client,
+    contents: list[types.Content],
+    config: types.GenerateContentConfig,
+    dispatcher: FunctionCallDispatcher,
+) -> types.GenerateContentResponse:
+    """Requests a streamed response. Text is printed as soon as it arrives, and each
+    function call is submitted to the dispatcher as soon as its part is received.
+
+    Returns the full response, rebuilt from the received chunks.
+    """
+    parts: list[types.Part] = []
+    usage_metadata = None
+    # Only opening the stream can be retried: once chunks are received, text has been
+    # printed and function calls have started.
+    chunks = resilient_caller.call(lambda: _open_stream(client, contents, config), hedge=False)
+    for chunk in chunks:
+        if chunk.usage_metadata:
+            usage_metadata = chunk.usage_metadata
+        if not chunk.candidates or not chunk.candidates[0].content:
+            continue
+        for part in chunk.candidates[0].content.parts or []:
+            if part.function_call:
+                dispatcher.submit(part.function_call)
+                parts.append(part)
+            elif part.text:
+                print(part.text, end="", flush=True)
+                # Merge consecutive text chunks, so that the history has one part per text block
+                if parts and parts[-1].text and not parts[-1].function_call:
+                    parts[-1] = types.Part(text=parts[-1].text + part.text)
+                else:
+                    parts.append(part)
+
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=parts))] if parts else None,
+        usage_metadata=usage_metadata,
+    )
+
+
+def _open_stream(
+    client: genai.Client,
+    contents: list[types.Content],
+    config: types.GenerateContentConfig,
+) -> Iterator[types.GenerateContentResponse]:
+    """Requests a streamed response, and waits for its first chunk (which is when request errors are raised)."""
+    chunks = client.models.generate_content_stream(
+        model=MODEL_ID,
+        contents=contents,
+        config=config,
+    )
+    first_chunk = next(chunks, None)
+    return itertools.chain([first_chunk] if first_chunk else [], chunks)
+
+
+def _initial_messages(prompt: str, session: sessions.Session | None, verbose: bool) -> list[types.Content]:
+    """Returns the messages the conversation starts from: those saved in the session, followed by the prompt."""
+    messages = list(session.messages) if session is not None else []
+    if session is not None and verbose:
+        print(f"Conversation {session.conversation_id}, {len(messages)} messages and {session.usage['iterations']} iterations saved.")
+    if prompt or session is None:
+        messages.append(types.Content(role="user", parts=[types.Part(text=prompt)]))
+        if verbose:
+            print(f"User prompt: {prompt}")
+    if not messages or messages[-1].role == "model":
+        raise ValueError("The conversation is already finished, a new prompt is needed to continue it")
+    return messages
+
+
+def _conversation_id(session: sessions.Session | None) -> int | None:
+    return session.conversation_id if session is not None else None
+
+
+def _trace_response(span: tracing.Span | tracing.NoSpan, response: types.GenerateContentResponse) -> None:
+    if not tracing.enabled():
+        return
+    span.set("function_calls", len(response.function_calls or []))
+    if response.usage_metadata:
+        span.set("prompt_tokens", response.usage_metadata.prompt_token_count)
+        span.set("response_tokens", response.usage_metadata.candidates_token_count)
+        span.set("cached_tokens", response.usage_metadata.cached_content_token_count)
+
+
+def _compact(messages: list[types.Content], verbose: bool) -> list[types.Content]:
+    """Returns the messages to send to the model, with outdated function results compacted.
+    The full history in `messages` is left unchanged."""
+    if not COMPACTION_ENABLED:
+        return messages
+    with tracing.span("compact", messages=len(messages)):
+        contents = compaction.compact(messages)
+    if verbose:
+        before = tokens.estimate_tokens(messages)
+        after = tokens.estimate_tokens(contents)
+        if after < before:
+            print(f"Compacted history from ~{before} to ~{after} tokens.")
+    return contents
+
+
+def _check_token_budget(
+    client: genai.Client,
+    messages: list[types.Content],
+    contents: list[types.Content],
+    verbose: bool,
+) -> list[types.Content]:
+    """Returns the messages to send, compacted further if the request would be larger than
+    `MAX_REQUEST_TOKENS` or than the tokens left in the daily quota.
+    Raises `TokenBudgetExceeded` if the request is still larger than `MAX_REQUEST_TOKENS`.
+    """
+    budget = MAX_REQUEST_TOKENS
+    if RATE_LIMIT_ENABLED:
+        remaining = STATS_MAX_TOKENS_PER_DAY - stats.database().tokens_last_24h() - RATE_LIMIT_EXPECTED_RESPONSE_TOKENS
+        # Without any tokens left compacting doesn't help, the rate limiter waits or fails
+        if remaining > 0:
+            budget = min(budget, remaining)
+    estimated_tokens = token_estimator.estimate(contents)
+    if estimated_tokens <= budget:
+        return contents
+
+    if COMPACTION_ENABLED:
+        with tracing.span("compact", messages=len(messages), budget=budget):
+            contents = compaction.ContextCompactor(token_budget=token_estimator.content_budget(budget)).compact(messages)
+        if verbose:
+            print(f"Request of ~{estimated_tokens} tokens is over the budget of {budget}, compacted to ~{token_estimator.estimate(contents)} tokens.")
+        estimated_tokens = token_estimator.estimate(contents)
+    if estimated_tokens > MAX_REQUEST_TOKENS:
+        # The estimate may be wrong, only refuse requests that are too large for sure
+        with tracing.span("count_tokens"):
+            counted_tokens = token_estimator.count(client, MODEL_ID, contents)
+        if counted_tokens > MAX_REQUEST_TOKENS:
+            raise tokens.TokenBudgetExceeded(
+                f"The request would use {counted_tokens} prompt tokens, more than the limit of {MAX_REQUEST_TOKENS}"
+            )
+    return contents
+
+
+def _calibrate(
+    contents: list[types.Content],
+    estimated_tokens: int,
+    response: types.GenerateContentResponse,
+    verbose: bool,
+) -> None:
+    """Improves the token estimates with the actual prompt tokens of the request."""
+    if response.usage_metadata is None or not response.usage_metadata.prompt_token_count:
+        return
+    token_estimator.calibrate(contents, response.usage_metadata.prompt_token_count)
+    if verbose:
+        print(f"Estimated prompt tokens: {estimated_tokens}, actual: {response.usage_metadata.prompt_token_count}")
+
+
+def _record_discarded(
+    estimated_tokens: int,
+    conversation_id: int | None,
+    iteration: int,
+) -> Callable[[types.GenerateContentResponse | None], None]:
+    """Returns the callback recording the usage of a hedged request whose response was discarded:
+    it's billed and counts towards the quotas as any other. The usage of a request cancelled before
+    completing is unknown, the estimated prompt tokens and the expected response tokens are recorded."""
+    def record(response: types.GenerateContentResponse | None) -> None:
+        usage_metadata = response.usage_metadata if response is not None else None
+        if usage_metadata is None:
+            usage_metadata = types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=estimated_tokens,
+                candidates_token_count=RATE_LIMIT_EXPECTED_RESPONSE_TOKENS,
+                total_token_count=estimated_tokens + RATE_LIMIT_EXPECTED_RESPONSE_TOKENS,
+            )
+        stats.add(usage_metadata, conversation_id, iteration, MODEL_ID)
+    return record
+
+
+def _rate_limit(estimated_tokens: int) -> contextlib.AbstractContextManager[rate_limit.Reservation]:
+    if not RATE_LIMIT_ENABLED:
+        return contextlib.nullcontext(rate_limit.Reservation())
+    return rate_limit.rate_limiter.request(estimated_tokens)
+
+
+def _rate_limit_async(estimated_tokens: int) -> contextlib.AbstractAsyncContextManager[rate_limit.Reservation]:
+    if not RATE_LIMIT_ENABLED:
+        return contextlib.nullcontext(rate_limit.Reservation())
+    return rate_limit.rate_limiter.request_async(estimated_tokens)
+
+
+def _request_config(
+    contents: list[types.Content],
+    context_cache: ContextCache | None,
+) -> tuple[types.GenerateContentConfig, list[types.Content]]:
+    """Returns the config for the next request, and the contents to send with it."""
+    if context_cache is None:
+        return default_config(), contents
+    return context_cache.request(contents)
+
+
+def _append_response(
+    messages: list[types.Content],
+    response: types.GenerateContentResponse,
+    verbose: bool,
+) -> None:
+    """Appends the response candidates to the messages list."""
+    if verbose:
+        print("Response received.")
+        if response.usage_metadata:
+            print("\nSTATS:")
+            print(f"Prompt tokens: {response.usage_metadata.prompt_token_count}")
+            print(f"Response tokens: {response.usage_metadata.candidates_token_count}")
+            print(f"Total tokens: {response.usage_metadata.total_token_count}")
+            if response.usage_metadata.cached_content_token_count:
+                print(f"Cached tokens: {response.usage_metadata.cached_content_token_count}")
+        else:
+            print("ERROR: API usage data not available")
+        print(f"Model calls: {resilient_caller.metrics.summary()}")
+        if patch_metrics.patches:
+            print(f"Patches: {patch_metrics.summary()}")
+
+    # A list of response variations, usually just one.
+    if response.candidates is None:
+        print("WARNING: No response candidate found.")
+    else:
+        for candidate in response.candidates:
+            if candidate.content:
+                messages.append(candidate.content)
+                if verbose:
+                    print(f"Appending a response candidate to messages list:")
+                    print(f" - Role: {candidate.content.role}")
+                    if candidate.content.parts:
+                        for i, part in enumerate(candidate.content.parts):
+                            print(f" - Part {i}")
+                            if part.text:
+                                print("   - Includes text")
+                            if part.function_call:
+                                print("   - Includes a function call // " + (part.function_call.name or ""))
+                    print("")
+
+
+def _deduplicator(messages: list[types.Content]) -> ResultDeduplicator | None:
+    """Results of this session are numbered after those already in the messages."""
+    if not DEDUPLICATION_ENABLED:
+        return None
+    return ResultDeduplicator(previous_calls=len(compaction.tool_exchanges(messages)))
+
+
+def _append_function_results(
+    messages: list[types.Content],
+    function_calls: list[types.FunctionCall],
+    function_call_results: list[types.Content],
+    verbose: bool,
+) -> None:
+    """Appends the results of the function calls to the messages list, in the same order as the calls."""
+    for called_function, function_call_result in zip(function_calls, function_call_results):
+        messages.append(types.Content(
+            role="user",
+            parts=function_call_result.parts,
+        ))
+        if verbose:
+            try:
+                print(f"-> {function_call_result.parts[0].function_response.response}") # type: ignore
+            except Exception as exc:
+                raise ValueError(f"Invalid result structure for function \"{called_function.name}\"") from exc
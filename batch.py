@@ -0,0 +1,148 @@
+"""Runs many prompts from a JSONL file in a single process.
+
+Each input line is a JSON object with a "prompt" and an optional "id" (the line number
+by default). Prompts run concurrently, sharing the same API client, function results
+cache and rate limiter, and each result is appended to the output JSONL file as soon
+as it completes:
+    {"id": "...", "conversation_id": 7, "status": "ok", "response": "...", "iterations": 3,
+     "prompt_tokens": 1200, "response_tokens": 150, "total_tokens": 1350, "wall_time_seconds": 4.2}
+Failed prompts have `"status": "error"` and an "error" message instead of the response.
+Each prompt is a conversation saved in the sessions directory, as those started from the
+command line, and the stats of its requests have the same `conversation_id`.
+
+Running a batch again with the same output file resumes it: prompts with a successful
+result are skipped, failed and missing ones are run again.
+"""
+import concurrent.futures
+import json
+import os
+import time
+
+from google import genai
+
+from agent import AgentUsage, agent_request
+from config import BATCH_CONCURRENCY, SESSIONS_DIRECTORY
+from sessions import Session
+
+
+def read_prompts(input_path: str) -> list[dict]:
+    """Returns the prompts of the input file, each with an "id" and a "prompt"."""
+    prompts = []
+    ids = set()
+    with open(input_path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                prompt = entry["prompt"]
+            except (ValueError, KeyError, TypeError) as exc:
+                raise ValueError(f'Invalid prompt at line {line_number} of "{input_path}": {exc!r}') from exc
+            prompt_id = str(entry.get("id", line_number))
+            if prompt_id in ids:
+                raise ValueError(f'Duplicate prompt id "{prompt_id}" at line {line_number} of "{input_path}"')
+            ids.add(prompt_id)
+            prompts.append({"id": prompt_id, "prompt": prompt})
+    return prompts
+
+
+def completed_ids(output_path: str) -> set[str]:
+    """Returns the ids of the prompts with a successful result in the output file, if it exists.
+    A line left incomplete by a crash is ignored."""
+    ids = set()
+    if not os.path.exists(output_path):
+        return ids
+    with open(output_path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get("status") == "ok":
+                ids.add(str(result["id"]))
+    return ids
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    api_key: str,
+    concurrency: int = BATCH_CONCURRENCY,
+    verbose: bool = False,
+    client: genai.Client | None = None,
+    sessions_directory: str = SESSIONS_DIRECTORY,
+) -> dict[str, int]:
+    """Runs the prompts of the input file not completed yet, appending results to the output file.
+    Each prompt is a new conversation saved in `sessions_directory`, its id is in the result
+    and in the stats of its requests.
+
+    Returns the number of prompts that succeeded, failed and were skipped.
+    """
+    prompts = read_prompts(input_path)
+    done = completed_ids(output_path)
+    pending = [entry for entry in prompts if entry["id"] not in done]
+    counts = {"ok": 0, "error": 0, "skipped": len(prompts) - len(pending)}
+    if not pending:
+        print("All prompts are already completed.")
+        return counts
+
+    if client is None:
+        client = genai.Client(api_key=api_key)
+    print(f"Running {len(pending)} prompts ({counts['skipped']} already completed), {concurrency} at a time.")
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        if output.tell() > 0:
+            _terminate_last_line(output_path, output)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+        futures = [
+            executor.submit(_run_prompt, entry, api_key, verbose, client, sessions_directory)
+            for entry in pending
+        ]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                # Written from this thread only, one full line at a time
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                counts[result["status"]] += 1
+                print(
+                    f"[{counts['ok'] + counts['error']}/{len(pending)}] {result['id']}: {result['status']}"
+                    f" ({result['wall_time_seconds']:.1f}s, {result['total_tokens']} tokens)"
+                )
+        except KeyboardInterrupt:
+            print("Interrupted, run the batch again to resume it.")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    print(f"Batch completed: {counts['ok']} succeeded, {counts['error']} failed.")
+    return counts
+
+
+def _run_prompt(entry: dict, api_key: str, verbose: bool, client: genai.Client, sessions_directory: str) -> dict:
+    usage = AgentUsage()
+    result: dict = {"id": entry["id"]}
+    start = time.perf_counter()
+    try:
+        session = Session.create(sessions_directory)
+        result["conversation_id"] = session.conversation_id
+        result["response"] = agent_request(entry["prompt"], api_key, verbose, client=client, usage=usage, session=session)
+        result["status"] = "ok"
+    except Exception as exc:
+        result["status"] = "error"
+        result["error"] = str(exc)
+    result["iterations"] = usage.iterations
+    result["prompt_tokens"] = usage.prompt_tokens
+    result["response_tokens"] = usage.response_tokens
+    result["total_tokens"] = usage.total_tokens
+    result["wall_time_seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def _terminate_last_line(output_path: str, output) -> None:
+    """Ends the output file with a newline, if a crash left its last line incomplete."""
+    with open(output_path, "rb") as file:
+        file.seek(-1, os.SEEK_END)
+        if file.read(1) != b"\n":
+            output.write("\n")
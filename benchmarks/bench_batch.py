@@ -0,0 +1,105 @@
+"""Runs the same prompts as separate agent processes, one after the other, and with `main.py batch`.
+
+The model is a local HTTP server answering every request with a short text after a fixed
+delay, so only the agent overhead is measured: interpreter startup, imports and client
+creation for each process, against a single process running prompts concurrently.
+Stats are recorded in a temporary directory and the rate limiter is disabled.
+
+    uv run -m benchmarks.bench_batch [prompts]
+"""
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+PROMPTS = 20
+CONCURRENCY = 8
+MODEL_LATENCY_SECONDS = 0.2
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AGENT_SCRIPT = """
+import sys
+from google import genai
+from google.genai import types
+import agent
+agent.RATE_LIMIT_ENABLED = False
+client = genai.Client(api_key="fake_api_key", http_options=types.HttpOptions(base_url=sys.argv[1]))
+agent.agent_request(sys.argv[2], "fake_api_key", False, client=client)
+"""
+
+
+class _ModelHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(MODEL_LATENCY_SECONDS)
+        data = json.dumps({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": "Done."}]}}],
+            "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 5, "totalTokenCount": 15},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def _sequential(base_url: str, prompts: int, directory: str) -> float:
+    env = os.environ | {"PYTHONPATH": REPO_DIRECTORY}
+    start = time.perf_counter()
+    for i in range(prompts):
+        subprocess.run(
+            [sys.executable, "-c", AGENT_SCRIPT, base_url, f"Prompt {i}"],
+            cwd=directory, env=env, check=True, capture_output=True,
+        )
+    return time.perf_counter() - start
+
+
+def _batch(base_url: str, prompts: int, directory: str) -> float:
+    from google import genai
+    from google.genai import types
+
+    import agent
+    import batch
+
+    agent.RATE_LIMIT_ENABLED = False
+    input_path = os.path.join(directory, "prompts.jsonl")
+    with open(input_path, "w") as file:
+        for i in range(prompts):
+            file.write(json.dumps({"id": i, "prompt": f"Prompt {i}"}) + "\n")
+
+    start = time.perf_counter()
+    # Client creation is included, as it is for each sequential run
+    client = genai.Client(api_key="fake_api_key", http_options=types.HttpOptions(base_url=base_url))
+    batch.run_batch(input_path, os.path.join(directory, "results.jsonl"), "fake_api_key", CONCURRENCY, client=client)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    prompts = int(sys.argv[1]) if len(sys.argv) > 1 else PROMPTS
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ModelHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://{}:{}/".format(*server.server_address)
+
+    with tempfile.TemporaryDirectory() as directory:
+        sequential = _sequential(base_url, prompts, directory)
+        # Stats are written to the current directory
+        os.chdir(directory)
+        batched = _batch(base_url, prompts, directory)
+
+    print(f"\n{prompts} prompts, model latency {MODEL_LATENCY_SECONDS * 1000:.0f}ms")
+    print(f"Sequential processes: {sequential:.2f}s ({sequential / prompts * 1000:.0f}ms per prompt)")
+    print(f"Batch, {CONCURRENCY} at a time: {batched:.2f}s ({batched / prompts * 1000:.0f}ms per prompt)")
+    print(f"Speedup: {sequential / batched:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Prompt tokens sent at each iteration of a simulated session, with and without compaction.
+
+The session resembles a fix-test loop on the calculator project: the agent lists directories,
+reads files, runs the tests and rewrites a file, reading the same files over and over.
+Token counts are estimated with `tokens.estimate_tokens`, no API request is sent.
+
+    uv run -m benchmarks.bench_compaction
+"""
+import os
+
+from google.genai import types
+
+import tokens
+from compaction import ContextCompactor
+from config import MAX_ITERATIONS, COMPACTION_TOKEN_BUDGET
+
+
+CALCULATOR_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "calculator")
+
+
+def _read(path: str) -> str:
+    with open(os.path.join(CALCULATOR_DIR, path), encoding="utf-8") as f:
+        return f.read()
+
+
+def _model_turn(iteration: int) -> list[tuple[str, dict, str]]:
+    """Function calls requested by the model at the given iteration, with their results."""
+    test_output = "STDERR: " + ("." * 40 + "\n") * 60 + f"FAILED (failures={MAX_ITERATIONS - iteration})"
+    match iteration % 4:
+        case 0:
+            return [
+                ("get_files_info", {}, "- main.py: file_size=588 bytes, is_dir=False\n- tests.py: file_size=1354 bytes, is_dir=False\n- pkg: file_size=4096 bytes, is_dir=True"),
+                ("get_files_info", {"directory": "pkg"}, "- calculator.py: file_size=1744 bytes, is_dir=False\n- render.py: file_size=777 bytes, is_dir=False"),
+            ]
+        case 1:
+            return [
+                ("get_file_content", {"file_path": "pkg/calculator.py"}, _read("pkg/calculator.py")),
+                ("get_file_content", {"file_path": "tests.py"}, _read("tests.py")),
+                ("get_file_content", {"file_path": "main.py"}, _read("main.py")),
+            ]
+        case 2:
+            return [("run_python_file", {"file_path": "tests.py"}, test_output)]
+        case _:
+            return [
+                ("write_file", {"file_path": "pkg/calculator.py", "content": _read("pkg/calculator.py")}, "Successfully wrote"),
+                ("run_python_file", {"file_path": "tests.py"}, test_output),
+            ]
+
+
+def simulate(compactor: ContextCompactor | None) -> list[int]:
+    """Returns the estimated prompt tokens sent at each iteration."""
+    messages = [types.Content(role="user", parts=[types.Part(text="please fix the bug in the calculator")])]
+    prompt_tokens: list[int] = []
+    for iteration in range(MAX_ITERATIONS):
+        contents = compactor.compact(messages) if compactor else messages
+        prompt_tokens.append(tokens.estimate_tokens(contents))
+
+        calls = _model_turn(iteration)
+        messages.append(types.Content(role="model", parts=[
+            types.Part(text="Let me check."),
+            *(types.Part(function_call=types.FunctionCall(name=name, args=args)) for name, args, _ in calls),
+        ]))
+        for name, _, result in calls:
+            messages.append(types.Content(role="user", parts=[
+                types.Part.from_function_response(name=name, response={"result": result}),
+            ]))
+    return prompt_tokens
+
+
+def main():
+    before = simulate(None)
+    after = simulate(ContextCompactor())
+    print(f"Token budget: {COMPACTION_TOKEN_BUDGET}")
+    print("Iteration    Full history    Compacted")
+    for iteration, (full, compacted) in enumerate(zip(before, after)):
+        print(f"{iteration:>9}    {full:>12}    {compacted:>9}")
+    print(f"{'Total':>9}    {sum(before):>12}    {sum(after):>9}    ({100 - 100 * sum(after) / sum(before):.1f}% saved)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Listing a synthetic tree of 50k files: 50 directories with 10 subdirectories each,
+100 files per subdirectory, plus an ignored `node_modules`-like directory of the same size.
+
+Compares `get_files_info` with the original implementation (`os.listdir`, then `os.path.getsize`
+and `os.path.isdir` for every entry), both for a single directory and for the whole tree,
+which the original could only list by being called once per directory.
+
+    uv run -m benchmarks.bench_files_info [files]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from functions import get_files_info as get_files_info_module
+
+
+FILES = 50_000
+FILES_PER_DIRECTORY = 100
+SUBDIRECTORIES = 10
+
+
+def _legacy_get_files_info(working_directory: str, directory: str = "") -> str:
+    subdir_abspath = os.path.abspath(os.path.join(working_directory, directory))
+    lines = []
+    for filename in os.listdir(subdir_abspath):
+        if filename == "__pycache__":
+            continue
+        filepath = os.path.join(subdir_abspath, filename)
+        size = os.path.getsize(filepath)
+        is_dir = os.path.isdir(filepath)
+        lines.append(f"- {filename}: file_size={size} bytes, is_dir={is_dir}")
+    return "\n".join(lines)
+
+
+def _legacy_walk(working_directory: str) -> int:
+    """Lists every directory, as the agent had to, returns the number of entries."""
+    entries = 0
+    pending = [""]
+    while pending:
+        directory = pending.pop()
+        for line in _legacy_get_files_info(working_directory, directory).splitlines():
+            entries += 1
+            if line.endswith("is_dir=True"):
+                pending.append(os.path.join(directory, line[2:line.index(":")]))
+    return entries
+
+
+def _populate(root: str, files: int) -> None:
+    directories = max(files // (FILES_PER_DIRECTORY * SUBDIRECTORIES), 1)
+    os.makedirs(root)
+    with open(os.path.join(root, ".gitignore"), "w") as f:
+        f.write("vendor/\n*.log\n")
+    for top in ("src", "vendor"):
+        for i in range(directories):
+            for j in range(SUBDIRECTORIES):
+                directory = os.path.join(root, top, f"dir{i}", f"sub{j}")
+                os.makedirs(directory)
+                for k in range(FILES_PER_DIRECTORY):
+                    with open(os.path.join(directory, f"file{k}.{'log' if k % 10 == 0 else 'py'}"), "w") as f:
+                        f.write("x" * k)
+
+
+def _time(fn) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main() -> None:
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else FILES
+    # Without the limit, to compare complete listings
+    get_files_info_module.MAX_LISTING_ENTRIES = sys.maxsize
+    get_files_info = get_files_info_module.get_files_info
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"Creating {files} files (and as many ignored ones)...")
+        tree = os.path.join(root, "tree")
+        _populate(tree, files)
+        flat = os.path.join(root, "flat")
+        os.makedirs(flat)
+        for k in range(files):
+            open(os.path.join(flat, f"file{k}.py"), "w").close()
+
+        legacy_ms, _ = _time(lambda: _legacy_get_files_info(root, "flat"))
+        scandir_ms, _ = _time(lambda: get_files_info(root, "flat"))
+        print(f"\nSingle directory of {files} files")
+        print(f"  listdir + getsize + isdir {legacy_ms:8.1f}ms")
+        print(f"  scandir                   {scandir_ms:8.1f}ms   {legacy_ms / scandir_ms:.1f}x")
+
+        legacy_ms, legacy_entries = _time(lambda: _legacy_walk(os.path.join(tree, "src")))
+        scandir_ms, result = _time(lambda: get_files_info(tree, "src", recursive=True))
+        print(f"\nWhole tree, {files} files")
+        print(f"  one call per directory    {legacy_ms:8.1f}ms   {legacy_entries} entries")
+        print(f"  recursive scandir         {scandir_ms:8.1f}ms   {len(str(result).splitlines())} entries, *.log ignored")
+
+        legacy_ms, legacy_entries = _time(lambda: _legacy_walk(tree))
+        scandir_ms, result = _time(lambda: get_files_info(tree, recursive=True))
+        print(f"\nWhole tree with an ignored directory of {files} files")
+        print(f"  one call per directory    {legacy_ms:8.1f}ms   {legacy_entries} entries")
+        print(f"  recursive scandir         {scandir_ms:8.1f}ms   {len(str(result).splitlines())} entries")
+
+
+if __name__ == "__main__":
+    main()
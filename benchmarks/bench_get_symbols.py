@@ -0,0 +1,68 @@
+"""Outline of a synthetic project of 2000 Python modules (about 300 lines each).
+
+Compares the first outline with an outline of unchanged files (from the cache).
+Also compares the size of the outline with the size of the files, which is what the
+agent would otherwise read to find its way around.
+
+    uv run -m benchmarks.bench_get_symbols [files]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from functions import get_symbols as get_symbols_module
+
+
+FILES = 2_000
+CLASSES_PER_FILE = 5
+METHODS_PER_CLASS = 8
+
+
+def _module_source(i: int) -> str:
+    lines = ["import os", "import sys", ""]
+    for c in range(CLASSES_PER_FILE):
+        lines += [f"class Model{i}_{c}(Base):", f'    """Model number {c} of module {i}."""', ""]
+        for m in range(METHODS_PER_CLASS):
+            lines += [
+                f"    def method_{m}(self, value: int, *, scale: float = 1.0) -> float:",
+                f'        """Computes step {m}."""',
+                "        total = 0",
+                "        for item in range(value):",
+                "            total += item * scale",
+                "        return total",
+                "",
+            ]
+    return "\n".join(lines) + "\n"
+
+
+def _milliseconds(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+def main() -> None:
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else FILES
+    # Without the limit, to outline every file
+    get_symbols_module.MAX_LENGTH = sys.maxsize
+    with tempfile.TemporaryDirectory() as root:
+        total_bytes = 0
+        for i in range(files):
+            source = _module_source(i)
+            total_bytes += len(source)
+            with open(os.path.join(root, f"module{i}.py"), "w") as f:
+                f.write(source)
+
+        first_ms = _milliseconds(lambda: get_symbols_module.get_symbols(root))
+        cached_ms = _milliseconds(lambda: get_symbols_module.get_symbols(root))
+        outline = get_symbols_module.get_symbols(root)
+
+        print(f"{files} files, {total_bytes / 1_000_000:.1f}MB")
+        print(f"  first outline                {first_ms:8.1f}ms")
+        print(f"  unchanged files, cached      {cached_ms:8.1f}ms")
+        print(f"  outline size                 {len(outline) / total_bytes:8.1%} of the files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Per-call latency of `run_python_file` on the calculator project, with a new interpreter
+for every call (cold) and with the warm worker pool.
+
+    uv run -m benchmarks.bench_python_pool [calls]
+"""
+import os
+import statistics
+import sys
+import time
+
+from functions import python_pool, run_python
+from config import PYTHON_POOL_SIZE
+
+
+CALLS = 20
+WORKING_DIRECTORY = "calculator"
+SCRIPTS = [("tests.py", None), ("main.py", ["3 + 5 * 2"])]
+
+
+def _latencies(file_path: str, args: list[str] | None, calls: int) -> list[float]:
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        run_python.run_python_file(WORKING_DIRECTORY, file_path, args)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def _print(name: str, latencies: list[float]) -> None:
+    print(f"  {name:<5} median {statistics.median(latencies):6.1f}ms   max {max(latencies):6.1f}ms")
+
+
+def main() -> None:
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+    # Start the workers in advance, as they would be after the first call
+    pool = python_pool.get_pool(WORKING_DIRECTORY, PYTHON_POOL_SIZE)
+    pool.run(os.path.abspath(os.path.join(WORKING_DIRECTORY, "main.py")), [], timeout=30)
+
+    for file_path, args in SCRIPTS:
+        print(f"{' '.join([file_path, *(args or [])])}, {calls} calls")
+        run_python.PYTHON_POOL_ENABLED = False
+        cold = _latencies(file_path, args, calls)
+        run_python.PYTHON_POOL_ENABLED = True
+        warm = _latencies(file_path, args, calls)
+        _print("cold", cold)
+        _print("warm", warm)
+        print(f"  speedup {statistics.median(cold) / statistics.median(warm):.1f}x\n")
+
+
+if __name__ == "__main__":
+    main()
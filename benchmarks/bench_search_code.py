@@ -0,0 +1,90 @@
+"""Code search on a synthetic repository of 100k small Python files.
+
+Compares `search_code` with a plain scan that reads every file and matches the pattern,
+which is what finding a symbol costs without an index. The index is built on the first
+search; later searches only check the files' stats when the refresh interval has passed.
+
+    uv run -m benchmarks.bench_search_code [files]
+"""
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+from functions import code_index
+from functions.search_code import search_code
+
+
+FILES = 100_000
+FILES_PER_DIRECTORY = 500
+SEARCHES = 20
+
+QUERIES = [
+    ("rare identifier", "handler_4242", False),
+    ("common identifier", "self.value", False),
+    ("regex", r"def compute_\w+_4242\(", True),
+]
+
+
+def _populate(root: str, files: int) -> None:
+    random.seed(0)
+    for i in range(files):
+        directory = os.path.join(root, f"module{i // FILES_PER_DIRECTORY}")
+        if i % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, f"file{i}.py"), "w") as f:
+            f.write(
+                f"import os\n\n\nclass Handler{i}:\n"
+                f"    def __init__(self, value):\n        self.value = value\n\n"
+                f"    def compute_{random.choice(['sum', 'product', 'mean'])}_{i}(self, items):\n"
+                f"        return handler_{i}(self.value, items)\n\n\n"
+                f"def handler_{i}(value, items):\n    return [value * item for item in items]\n"
+            )
+
+
+def _scan(root: str, regex: re.Pattern) -> int:
+    matches = 0
+    for directory, _, files in os.walk(root):
+        for file in files:
+            with open(os.path.join(directory, file), encoding="utf-8") as f:
+                for line in f:
+                    if regex.search(line):
+                        matches += 1
+    return matches
+
+
+def _milliseconds(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+
+def main() -> None:
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else FILES
+    with tempfile.TemporaryDirectory() as root:
+        project = os.path.join(root, "project")
+        print(f"Creating {files} files...")
+        _populate(project, files)
+        code_index.CODE_INDEX_DB_NAME = os.path.join(root, "index.db")
+
+        index = code_index.get_index(project)
+        print(f"\nFirst search, building the index  {_milliseconds(index.refresh) / 1000:8.1f}s")
+        index.mark_stale()
+        print(f"Refresh, no files changed          {_milliseconds(index.refresh):8.1f}ms")
+        print(f"Index size                         {os.path.getsize(code_index.CODE_INDEX_DB_NAME) / 1_000_000:8.1f}MB")
+
+        for name, pattern, is_regex in QUERIES:
+            regex = re.compile(pattern if is_regex else re.escape(pattern))
+            scan_ms = _milliseconds(lambda: _scan(project, regex))
+            latencies = [_milliseconds(lambda: search_code(project, pattern, is_regex=is_regex)) for _ in range(SEARCHES)]
+            print(f"\n{name}: {pattern}")
+            print(f"  scan every file    {scan_ms:8.1f}ms")
+            print(f"  search_code        {statistics.median(latencies):8.1f}ms (median of {SEARCHES})")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Usage window queries on a synthetic database with one million records spread over a year.
+
+Compares the indexed queries of `stats.Database` with the original full-table scans
+on the `ts` text column (before the rollup tables were added).
+
+    uv run -m benchmarks.bench_stats [records]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from stats import Database, datetime_to_string, string_to_epoch_us
+
+
+RECORDS = 1_000_000
+
+LEGACY_QUERIES = {
+    "tokens_last_24h": "SELECT SUM(tokens_total) FROM stats WHERE ts >= datetime('now', '-1 days')",
+    "requests_last_24h": "SELECT COUNT(*) FROM stats WHERE ts >= datetime('now', '-1 days')",
+    "requests_last_minute": "SELECT COUNT(*) FROM stats WHERE ts >= datetime('now', '-1 minutes')",
+}
+
+
+def _populate(db: Database, records: int) -> None:
+    now = datetime.now(timezone.utc)
+    random.seed(0)
+    rows = []
+    for _ in range(records):
+        ts = datetime_to_string(now - timedelta(seconds=random.uniform(0, 365 * 24 * 3600)))
+        tokens_prompt = random.randint(100, 5000)
+        rows.append({
+            "ts": ts,
+            "conversation_id": None,
+            "tokens_prompt": tokens_prompt,
+            "tokens_candidates": 100,
+            "tokens_total": tokens_prompt + 100,
+            "ts_us": string_to_epoch_us(ts),
+        })
+    with db._connection:
+        db._connection.executemany(
+            "INSERT INTO stats (ts, conversation_id, tokens_prompt, tokens_candidates, tokens_total, ts_us)"
+            " VALUES (:ts, :conversation_id, :tokens_prompt, :tokens_candidates, :tokens_total, :ts_us)",
+            rows,
+        )
+
+
+def _timed(function, repeat: int = 20) -> float:
+    """Returns the best time of `repeat` runs, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else RECORDS
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(directory, "bench_stats.db"))
+        start = time.perf_counter()
+        _populate(db, records)
+        print(f"Inserted {records} records in {time.perf_counter() - start:.1f}s")
+
+        print("Query                    Full scan    Indexed")
+        for name, legacy_query in LEGACY_QUERIES.items():
+            legacy_ms = _timed(lambda: db._connection.execute(legacy_query).fetchone(), repeat=3)
+            indexed_ms = _timed(getattr(db, name))
+            print(f"{name:<22} {legacy_ms:>9.2f}ms {indexed_ms:>8.3f}ms")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Estimating the prompt tokens of every request of a long session: 15 iterations with
+4 function calls each, whose results are calculator files and test outputs (about 3k characters).
+
+Compares measuring the whole history at every iteration (as the estimate did before parts
+were memoized) with measuring only the parts added since the previous iteration.
+
+    uv run -m benchmarks.bench_tokens [iterations]
+"""
+import sys
+import time
+
+from google.genai import types
+
+import tokens
+
+
+ITERATIONS = 15
+CALLS_PER_ITERATION = 4
+RESULT = ("def add(a, b):\n    return a + b\n\n" * 100)[:3_000]
+
+
+def _iteration(number: int) -> list[types.Content]:
+    calls = [types.FunctionCall(name="get_file_content", args={"file_path": f"pkg/module{number}_{i}.py"}) for i in range(CALLS_PER_ITERATION)]
+    messages = [types.Content(role="model", parts=[types.Part(function_call=call) for call in calls])]
+    for call in calls:
+        messages.append(types.Content(role="user", parts=[types.Part.from_function_response(name=call.name, response={"result": RESULT})]))
+    return messages
+
+
+def _session_milliseconds(iterations: int, estimate) -> float:
+    """Total time spent estimating the history before each request of a session."""
+    messages = [types.Content(role="user", parts=[types.Part(text="fix the bug in the calculator")])]
+    total = 0.0
+    for number in range(iterations):
+        start = time.perf_counter()
+        estimate(messages)
+        total += time.perf_counter() - start
+        messages += _iteration(number)
+    return total * 1000
+
+
+def _unmemoized(contents: list[types.Content]) -> int:
+    return sum(tokens._measure(part) for content in contents for part in content.parts or []) // tokens.CHARACTERS_PER_TOKEN
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    estimator = tokens.TokenEstimator(overhead_characters=5_000)
+    unmemoized_ms = _session_milliseconds(iterations, _unmemoized)
+    memoized_ms = _session_milliseconds(iterations, estimator.estimate)
+
+    print(f"{iterations} iterations, {iterations * CALLS_PER_ITERATION} function results")
+    print(f"  whole history measured every time   {unmemoized_ms:8.2f}ms per session")
+    print(f"  memoized parts                      {memoized_ms:8.2f}ms per session")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Cost of a span, with tracing disabled (the default) and enabled.
+
+Spans surround operations that take milliseconds (model requests, function calls,
+database writes), so a span should cost a tiny fraction of that even when enabled.
+
+    uv run -m benchmarks.bench_tracing [spans]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import tracing
+
+
+SPANS = 200_000
+
+
+def _nanoseconds_per_span(spans: int) -> float:
+    start = time.perf_counter_ns()
+    for i in range(spans):
+        with tracing.span("tool.get_file_content", iteration=i) as span:
+            span.set("result_characters", 1234)
+    return (time.perf_counter_ns() - start) / spans
+
+
+def _nanoseconds_per_loop(spans: int) -> float:
+    start = time.perf_counter_ns()
+    for i in range(spans):
+        pass
+    return (time.perf_counter_ns() - start) / spans
+
+
+def main() -> None:
+    spans = int(sys.argv[1]) if len(sys.argv) > 1 else SPANS
+    loop_ns = _nanoseconds_per_loop(spans)
+    tracing.disable()
+    disabled_ns = _nanoseconds_per_span(spans)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.json")
+        tracing.enable(path)
+        enabled_ns = _nanoseconds_per_span(spans)
+        tracing.disable()
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        tracing.summary(path)
+        summary_ms = (time.perf_counter() - start) * 1000
+
+    print(f"{spans} spans")
+    print(f"  disabled       {disabled_ns - loop_ns:8.0f}ns per span")
+    print(f"  enabled        {enabled_ns - loop_ns:8.0f}ns per span, {size / spans:.0f} bytes per event")
+    print(f"  summary        {summary_ms:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,31 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
 from google.genai import types
 
-from config import WORKING_DIRECTORY
+import stats
+import tracing
+from compaction import back_reference
+from config import (
+    WORKING_DIRECTORY,
+    MAX_PARALLEL_FUNCTION_CALLS,
+    TOOL_CACHE_MAX_ENTRIES,
+    TOOL_CACHE_MAX_CHARACTERS,
+)
+from functions.apply_patch import apply_patch, schema_apply_patch
 from functions.get_files_info import get_files_info, schema_get_file_info
 from functions.get_file_content import get_file_content, schema_get_file_content
-from functions.run_python import run_python_file, schema_run_python_file
+from functions.get_symbols import get_symbols, schema_get_symbols
+from functions import code_index
+from functions.run_python import run_python_file, run_python_file_async, schema_run_python_file
+from functions.search_code import search_code, schema_search_code
 from functions.write_file import write_file, schema_write_file
 
 
@@ -13,10 +35,27 @@ available_functions = types.Tool(
         schema_get_file_content,
         schema_run_python_file,
         schema_write_file,
+        schema_apply_patch,
+        schema_search_code,
+        schema_get_symbols,
     ]
 )
 
 
+WRITE_FUNCTIONS = {"write_file", "apply_patch"}
+"""Functions that modify files in the working directory.
+These are never executed at the same time as any other function call."""
+
+
+CACHEABLE_FUNCTIONS = {"get_files_info", "get_file_content"}
+"""Functions whose result only depends on their arguments and on the state of the files they read."""
+
+
+DEDUPLICATED_FUNCTIONS = CACHEABLE_FUNCTIONS | {"search_code", "get_symbols"}
+"""Functions that only read files, whose results can be replaced by a reference to an identical
+earlier result, see `ResultDeduplicator`."""
+
+
 system_prompt = """
 You are a helpful AI coding agent.
 
@@ -26,65 +65,442 @@ When a user asks a question or makes a request, make a function call plan. You c
 - Read file contents
 - Execute Python files with optional arguments
 - Write or overwrite files
+- Modify files by sending only the changes, as a diff or search/replace blocks
+- Search the code for a text or a regular expression
+- Outline the classes and functions of Python files, with their line ranges
 
 All paths you provide should be relative to the working directory. You do not need to specify the working directory in your function calls as it is automatically injected for security reasons.
 If the user request is not clear enough, before asking for more context use the option "List files and directories" as a first step to understand the contents of the working directory.
 """
 
 
-# TODO add tests
 def call_function(
     function_call_part: types.FunctionCall,
     verbose=False,
+    executed_calls: list[stats.ToolCall] | None = None,
 ) -> types.Content:
+    """Executes a function call requested by the agent, and returns its result.
+    If an `executed_calls` list is provided, the stats of the call are appended to it."""
+    tool_call = stats.ToolCall(function=function_call_part.name or "", duration_us=0, result_bytes=0)
+    start = time.perf_counter()
+    with tracing.span("call_function", function=function_call_part.name) as span:
+        content = _call_function(function_call_part, verbose, tool_call)
+        span.set("cached", tool_call.cached)
+        span.set("result_bytes", tool_call.result_bytes)
+    _record_call(tool_call, start, executed_calls)
+    return content
+
+
+def _call_function(
+    function_call_part: types.FunctionCall,
+    verbose: bool,
+    tool_call: stats.ToolCall,
+) -> types.Content:
+    _print_call(function_call_part, verbose)
+
+    function_name = function_call_part.name
+    if function_name is None:
+        return _error_response("call_function", f"Unknown function: {function_name}", tool_call)
+
+    args = function_call_part.args or {}
+    cache_key = tool_cache.key(function_name, args)
+    if cache_key is not None:
+        cached_result = tool_cache.get(cache_key)
+        if cached_result is not None:
+            if verbose:
+                print(f"   - Cached result for: {function_name}({args})")
+            tool_call.cached = True
+            return _result_response(function_name, cached_result, tool_call)
+
+    function_result: str
+    with tracing.span(f"tool.{function_name}"):
+        match function_name:
+            case "get_files_info": function_result = get_files_info(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+            case "get_file_content": function_result = get_file_content(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+            case "run_python_file": function_result = run_python_file(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+            case "write_file": function_result = write_file(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+            case "apply_patch": function_result = apply_patch(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+            case "search_code": function_result = search_code(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+            case "get_symbols": function_result = get_symbols(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+            case _:
+                #return f"Error: function call for \"{function_call_part.name}\" not implemented."
+                return _error_response(function_name, f"Unknown function: {function_name}", tool_call)
+
+    if function_name in WRITE_FUNCTIONS:
+        tool_cache.invalidate(os.path.join(WORKING_DIRECTORY, args.get("file_path", "")))
+        code_index.file_written(WORKING_DIRECTORY, args.get("file_path", ""))
+    elif function_name == "run_python_file":
+        # A script can write anywhere. File contents are validated by their stats anyway,
+        # but a directory listing would not notice a file changing size.
+        tool_cache.invalidate_listings()
+        code_index.mark_stale()
+    if cache_key is not None:
+        tool_cache.put(cache_key, function_result)
+
+    return _result_response(function_name, function_result, tool_call)
+
+
+async def call_function_async(
+    function_call_part: types.FunctionCall,
+    verbose=False,
+    executed_calls: list[stats.ToolCall] | None = None,
+) -> types.Content:
+    """Same as `call_function`, but never blocks the event loop: scripts are executed
+    as asyncio subprocesses and every other function runs in a worker thread."""
+    if function_call_part.name != "run_python_file":
+        return await asyncio.to_thread(call_function, function_call_part, verbose, executed_calls)
+
+    _print_call(function_call_part, verbose)
+    tool_call = stats.ToolCall(function=function_call_part.name, duration_us=0, result_bytes=0)
+    start = time.perf_counter()
+    with tracing.span("call_function", function=function_call_part.name) as span:
+        with tracing.span("tool.run_python_file"):
+            function_result = await run_python_file_async(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
+        content = _result_response(function_call_part.name, function_result, tool_call)
+        span.set("result_bytes", tool_call.result_bytes)
+    tool_cache.invalidate_listings()
+    code_index.mark_stale()
+    _record_call(tool_call, start, executed_calls)
+    return content
+
+
+def _record_call(tool_call: stats.ToolCall, start: float, executed_calls: list[stats.ToolCall] | None) -> None:
+    tool_call.duration_us = round((time.perf_counter() - start) * 1_000_000)
+    if executed_calls is not None:
+        # Appending is atomic, calls running in parallel can share the list
+        executed_calls.append(tool_call)
+
+
+def _print_call(function_call_part: types.FunctionCall, verbose: bool) -> None:
     if verbose:
         print(f" - Calling function: {function_call_part.name}({function_call_part.args})")
     else:
         print(f" - Calling function: {function_call_part.name}")
 
-    function_name = function_call_part.name
-    if function_name is None:
-        return types.Content(
-            role="tool",
-            parts=[
-                types.Part.from_function_response(
-                    name="call_function",
-                    response={"error": f"Unknown function: {function_name}"},
-                )
-            ],
-        )
 
-    function_result: str
-    match function_name:
-        case "get_files_info": function_result = get_files_info(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
-        case "get_file_content": function_result = get_file_content(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
-        case "run_python_file": function_result = run_python_file(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
-        case "write_file": function_result = write_file(WORKING_DIRECTORY, **function_call_part.args) # type: ignore
-        case _:
-            #return f"Error: function call for \"{function_call_part.name}\" not implemented."
-            return types.Content(
-                role="tool",
-                parts=[
-                    types.Part.from_function_response(
-                        name=function_name,
-                        response={"error": f"Unknown function: {function_name}"},
-                    )
-                ],
-            )
+def _result_response(name: str, result: str, tool_call: stats.ToolCall) -> types.Content:
+    tool_call.result_bytes = len(result.encode("utf-8"))
+    tool_call.error = result.startswith("Error:")
+    return _function_response(name, {"result": result})
+
 
+def _error_response(name: str, error: str, tool_call: stats.ToolCall) -> types.Content:
+    tool_call.result_bytes = len(error.encode("utf-8"))
+    tool_call.error = True
+    return _function_response(name, {"error": error})
+
+
+def _function_response(name: str, response: dict) -> types.Content:
     return types.Content(
         role="tool",
         parts=[
             types.Part.from_function_response(
-                name=function_name,
-                response={"result": function_result},
+                name=name,
+                response=response,
             )
         ],
     )
 
 
+class ToolResultCache:
+    """In-memory LRU cache for the results of `CACHEABLE_FUNCTIONS`.
+
+    Keys contain the function name, its arguments and a signature of the stats
+    of the file or directory being read (inode, modification time, size), so a result
+    is never returned after the file changed on disk, even if it was changed by another process.
+    A single `os.stat()` is needed to check the signature, the file itself is not read.
+
+    A directory modification time only changes when entries are added or removed, not when a file
+    in it changes size, so cached listings must be invalidated explicitly: see `invalidate()`
+    and `invalidate_listings()`.
+
+    Errors are not cached. The cache is bound both by number of entries and by the total
+    number of characters of the cached results. It is safe to use from multiple threads.
+    """
+
+    def __init__(
+        self,
+        working_directory: str,
+        max_entries: int = TOOL_CACHE_MAX_ENTRIES,
+        max_characters: int = TOOL_CACHE_MAX_CHARACTERS,
+    ) -> None:
+        self._working_directory = working_directory
+        self._max_entries = max_entries
+        self._max_characters = max_characters
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self._characters = 0
+        # Absolute path of the file or directory read -> keys of its cached results
+        self._keys_by_path: dict[str, set[tuple]] = {}
+        self._lock = threading.Lock()
+
+    def key(self, function_name: str, args: dict) -> tuple | None:
+        """Returns the cache key for a function call, or None if the result should not be cached."""
+        if self._max_entries <= 0 or function_name not in CACHEABLE_FUNCTIONS:
+            return None
+        if function_name == "get_files_info" and (args.get("recursive") or args.get("max_depth")):
+            # Would depend on the stats of every subdirectory, not only of the listed one
+            return None
+        path = self._path(function_name, args)
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        args_json = json.dumps(args, sort_keys=True, default=str)
+        return (function_name, args_json, path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def get(self, key: tuple) -> str | None:
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key: tuple, result: str) -> None:
+        if result.startswith("Error:") or len(result) > self._max_characters:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = result
+            self._characters += len(result)
+            self._keys_by_path.setdefault(key[2], set()).add(key)
+            while len(self._entries) > self._max_entries or self._characters > self._max_characters:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, file_path: str) -> None:
+        """Removes the results that depend on the given file: its content,
+        and the listing of the directory that contains it."""
+        file_abspath = os.path.abspath(file_path)
+        with self._lock:
+            for path in (file_abspath, os.path.dirname(file_abspath)):
+                for key in list(self._keys_by_path.get(path, ())):
+                    self._remove(key)
+
+    def invalidate_listings(self) -> None:
+        """Removes all cached directory listings."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == "get_files_info"]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self._characters = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, function_name: str, args: dict) -> str:
+        relative_path = args.get("directory", "") if function_name == "get_files_info" else args.get("file_path", "")
+        return os.path.abspath(os.path.join(self._working_directory, str(relative_path)))
+
+    def _remove(self, key: tuple) -> None:
+        result = self._entries.pop(key)
+        self._characters -= len(result)
+        keys = self._keys_by_path[key[2]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_path[key[2]]
+
+
+tool_cache = ToolResultCache(WORKING_DIRECTORY)
+
+
+class FunctionCallDispatcher:
+    """Executes the function calls of a single agent response, possibly in parallel.
+
+    Calls are submitted in the order the agent requested them, and `results()`
+    returns their results in that same order.
+
+    Functions that only read (or run scripts) are executed concurrently in a bounded
+    thread pool. A call in `WRITE_FUNCTIONS` acts as a barrier: it starts only after every
+    previously submitted call has finished, and calls submitted after it wait for it to finish.
+    This way a script never runs while a file is being written, and consecutive writes
+    to the same path are applied in the requested order.
+    """
+
+    def __init__(
+        self,
+        verbose=False,
+        max_workers: int = MAX_PARALLEL_FUNCTION_CALLS,
+        deduplicator: "ResultDeduplicator | None" = None,
+    ) -> None:
+        self._verbose = verbose
+        self._deduplicator = deduplicator
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers),
+            thread_name_prefix="function_call",
+        )
+        self._calls: list[types.FunctionCall] = []
+        self._futures: list[Future[types.Content]] = []
+        # Stats of each submitted call (a list, empty until the call completes)
+        self._tool_calls: list[list[stats.ToolCall]] = []
+        # Calls submitted since the last write, and the last write itself
+        self._since_barrier: list[Future[types.Content]] = []
+        self._barrier: Future[types.Content] | None = None
+
+    def submit(self, function_call_part: types.FunctionCall) -> None:
+        # Calls run with the context variables of the caller, like asyncio tasks do
+        context = contextvars.copy_context()
+        tool_calls: list[stats.ToolCall] = []
+        if function_call_part.name in WRITE_FUNCTIONS:
+            wait_for = self._since_barrier + ([self._barrier] if self._barrier else [])
+            future = self._executor.submit(context.run, self._call_after, wait_for, function_call_part, tool_calls)
+            self._barrier = future
+            self._since_barrier = []
+        else:
+            wait_for = [self._barrier] if self._barrier else []
+            future = self._executor.submit(context.run, self._call_after, wait_for, function_call_part, tool_calls)
+            self._since_barrier.append(future)
+        self._calls.append(function_call_part)
+        self._futures.append(future)
+        self._tool_calls.append(tool_calls)
+
+    def _call_after(
+        self,
+        wait_for: list[Future[types.Content]],
+        function_call_part: types.FunctionCall,
+        tool_calls: list[stats.ToolCall],
+    ) -> types.Content:
+        # The executor queue is FIFO, so every future we wait for was picked up
+        # by a worker before this one: waiting here can never deadlock the pool.
+        for future in wait_for:
+            future.exception()
+        return call_function(function_call_part, self._verbose, tool_calls)
+
+    @property
+    def executed_calls(self) -> list[stats.ToolCall]:
+        """Stats of the completed calls, in submission order."""
+        return [tool_call for tool_calls in self._tool_calls for tool_call in tool_calls]
+
+    def results(self) -> list[types.Content]:
+        """Waits for all submitted calls and returns their results in submission order,
+        deduplicated if the dispatcher has a `ResultDeduplicator`.
+        Exceptions raised by a function call are propagated."""
+        try:
+            results = [future.result() for future in self._futures]
+        finally:
+            self._executor.shutdown(wait=True)
+        if self._deduplicator is not None:
+            results = self._deduplicator.deduplicate(self._calls, results, self.executed_calls)
+        return results
+
+
+def call_functions(
+    function_calls: list[types.FunctionCall],
+    verbose=False,
+) -> list[types.Content]:
+    """Executes all the function calls requested in a single agent response,
+    see `FunctionCallDispatcher`. Results are returned in the same order as the calls."""
+    dispatcher = FunctionCallDispatcher(verbose)
+    for function_call_part in function_calls:
+        dispatcher.submit(function_call_part)
+    return dispatcher.results()
+
+
+async def call_functions_async(
+    function_calls: list[types.FunctionCall],
+    verbose=False,
+    executed_calls: list[stats.ToolCall] | None = None,
+    deduplicator: "ResultDeduplicator | None" = None,
+) -> list[types.Content]:
+    """Async version of `call_functions`, with the same ordering guarantees.
+    The stats of the calls are appended to `executed_calls`, if provided,
+    and the results are deduplicated with `deduplicator`, if provided."""
+    semaphore = asyncio.Semaphore(max(1, MAX_PARALLEL_FUNCTION_CALLS))
+    # Stats of each call, in call order
+    tool_calls: list[list[stats.ToolCall]] = [[] for _ in function_calls]
+
+    async def call(function_call_part: types.FunctionCall, calls: list[stats.ToolCall]) -> types.Content:
+        async with semaphore:
+            return await call_function_async(function_call_part, verbose, calls)
+
+    results: list[types.Content] = []
+    pending = []
+    for function_call_part, calls in zip(function_calls, tool_calls):
+        if function_call_part.name in WRITE_FUNCTIONS:
+            results += await asyncio.gather(*pending)
+            pending = []
+            results.append(await call(function_call_part, calls))
+        else:
+            pending.append(call(function_call_part, calls))
+    results += await asyncio.gather(*pending)
+
+    ordered_calls = [tool_call for calls in tool_calls for tool_call in calls]
+    if deduplicator is not None:
+        results = deduplicator.deduplicate(function_calls, results, ordered_calls)
+    if executed_calls is not None:
+        executed_calls += ordered_calls
+    return results
+
+
+class ResultDeduplicator:
+    """Replaces function results identical to an earlier one of the same session with a short
+    back reference to it (see `compaction.back_reference()`), instead of sending the same
+    file content or listing to the model again.
+
+    Functions are still executed (unchanged files are served by `tool_cache` anyway), so a result
+    is only replaced when it's really identical: a file that changed is always sent again.
+    Only results of `DEDUPLICATED_FUNCTIONS` are replaced, when the reference is shorter.
+
+    Calls are numbered in the order their results are appended to the conversation,
+    starting after the `previous_calls` already in it (e.g. in a resumed session).
+    """
+
+    def __init__(self, previous_calls: int = 0) -> None:
+        self.calls = previous_calls
+        # Function name and arguments -> number of the call that returned the result, and its digest
+        self._results: dict[tuple[str, str], tuple[int, bytes]] = {}
+
+    def deduplicate(
+        self,
+        function_calls: list[types.FunctionCall],
+        results: list[types.Content],
+        tool_calls: list[stats.ToolCall] | None = None,
+    ) -> list[types.Content]:
+        """Returns the results of the given calls (in the same order), with repeated ones replaced.
+        The result size in the stats of replaced calls is updated, if they are provided."""
+        deduplicated = []
+        for i, (function_call_part, content) in enumerate(zip(function_calls, results)):
+            self.calls += 1
+            reference = self._reference(function_call_part, content)
+            if reference is None:
+                deduplicated.append(content)
+                continue
+            deduplicated.append(_function_response(function_call_part.name or "", {"result": reference}))
+            if tool_calls is not None and i < len(tool_calls) and tool_calls[i].function == function_call_part.name:
+                tool_calls[i].result_bytes = len(reference.encode("utf-8"))
+        return deduplicated
+
+    def _reference(self, function_call_part: types.FunctionCall, content: types.Content) -> str | None:
+        if function_call_part.name not in DEDUPLICATED_FUNCTIONS:
+            return None
+        result = (content.parts[0].function_response.response or {}).get("result") # type: ignore
+        if not isinstance(result, str) or result.startswith("Error:"):
+            return None
+
+        key = (function_call_part.name, json.dumps(function_call_part.args or {}, sort_keys=True, default=str))
+        digest = hashlib.blake2b(result.encode("utf-8"), digest_size=16).digest()
+        earlier = self._results.get(key)
+        if earlier is not None and earlier[1] == digest:
+            reference = back_reference(earlier[0], function_call_part.name)
+            if len(reference) < len(result):
+                return reference
+            return None
+        self._results[key] = (self.calls, digest)
+        return None
+
+
 __all__ = [
     "available_functions",
     "system_prompt",
     "call_function",
+    "call_function_async",
+    "call_functions",
+    "call_functions_async",
+    "FunctionCallDispatcher",
+    "ResultDeduplicator",
+    "ToolResultCache",
+    "tool_cache",
 ]
\ No newline at end of file
@@ -0,0 +1,282 @@
+import json
+import os
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+from google.genai import types
+
+import tokens
+from config import COMPACTION_TOKEN_BUDGET, COMPACTION_MAX_OUTPUT_CHARACTERS
+
+
+COMPACTED_PREFIX = "[Compacted]"
+"""Start of every function result or argument replaced by the compaction engine."""
+
+BACK_REFERENCE_PREFIX = "[Unchanged]"
+"""Start of every function result replaced by a reference to an identical earlier result,
+see `call_function.ResultDeduplicator`."""
+
+_BACK_REFERENCE = re.compile(re.escape(BACK_REFERENCE_PREFIX) + r" Identical to the result of call #(\d+)")
+
+WRITTEN_CONTENT_ARGUMENTS = {"write_file": "content", "apply_patch": "patch"}
+"""Functions that modify a file (given as `file_path`), and the argument with the content they send."""
+
+
+@dataclass
+class ToolExchange:
+    """A function call requested by the model, and the position of its response in the messages list."""
+    name: str
+    args: dict
+    # Position of the model message containing the call, and of the call in its parts
+    call_message_index: int
+    call_part_index: int
+    # Position of the message containing the response, and of the response in its parts
+    message_index: int
+    part_index: int
+    # The exchange belongs to the most recent model response, which the model hasn't seen the result of yet
+    recent: bool = False
+
+    def path(self, key: str) -> str:
+        return os.path.normpath(str(self.args.get(key, "")))
+
+    def response(self, messages: list[types.Content]) -> dict:
+        part = messages[self.message_index].parts[self.part_index] # type: ignore
+        return part.function_response.response or {} # type: ignore
+
+    def is_compacted(self, messages: list[types.Content]) -> bool:
+        return str(self.response(messages).get("result", "")).startswith(COMPACTED_PREFIX)
+
+    def referenced_call(self, messages: list[types.Content]) -> int | None:
+        """Returns the number of the call this result is a back reference to, if it is one."""
+        return referenced_call(str(self.response(messages).get("result", "")))
+
+
+def back_reference(call_number: int, name: str) -> str:
+    """Returns the result replacing one identical to that of an earlier call. Calls are numbered
+    from 1, in the order of their responses in the conversation (as in `tool_exchanges()`)."""
+    return f"{BACK_REFERENCE_PREFIX} Identical to the result of call #{call_number} ({name} with the same arguments), nothing changed since."
+
+
+def referenced_call(result: str) -> int | None:
+    match = _BACK_REFERENCE.match(result)
+    return int(match.group(1)) if match else None
+
+
+CompactionStage = Callable[[list[types.Content], list[ToolExchange]], None]
+"""A compaction stage replaces some elements of the messages list (never in place,
+so that the original messages are unchanged) to reduce its size."""
+
+
+def tool_exchanges(messages: list[types.Content]) -> list[ToolExchange]:
+    """Pairs every function response in the messages with the function call that requested it.
+
+    Responses are appended in the same order as the calls of the previous model message.
+    """
+    exchanges: list[ToolExchange] = []
+    pending: deque[tuple[int, int, types.FunctionCall]] = deque()
+    last_call_message_index = -1
+    for message_index, message in enumerate(messages):
+        for part_index, part in enumerate(message.parts or []):
+            if part.function_call:
+                if message_index != last_call_message_index:
+                    pending.clear()
+                    last_call_message_index = message_index
+                pending.append((message_index, part_index, part.function_call))
+            elif part.function_response and pending:
+                call_message_index, call_part_index, function_call = pending.popleft()
+                exchanges.append(ToolExchange(
+                    name=part.function_response.name or "",
+                    args=function_call.args or {},
+                    call_message_index=call_message_index,
+                    call_part_index=call_part_index,
+                    message_index=message_index,
+                    part_index=part_index,
+                ))
+    for exchange in exchanges:
+        exchange.recent = exchange.call_message_index == last_call_message_index
+    return exchanges
+
+
+def replace_response(messages: list[types.Content], exchange: ToolExchange, result: str) -> None:
+    """Replaces the response of a function call, keeping it paired with its call."""
+    message = messages[exchange.message_index]
+    parts = list(message.parts or [])
+    function_response = parts[exchange.part_index].function_response
+    parts[exchange.part_index] = types.Part(
+        function_response=function_response.model_copy(update={"response": {"result": result}}), # type: ignore
+    )
+    messages[exchange.message_index] = message.model_copy(update={"parts": parts})
+
+
+def replace_call_argument(messages: list[types.Content], exchange: ToolExchange, key: str, value: str) -> None:
+    """Replaces a single argument of the function call that requested the exchange."""
+    message = messages[exchange.call_message_index]
+    parts = list(message.parts or [])
+    function_call = parts[exchange.call_part_index].function_call
+    args = dict(function_call.args or {}) # type: ignore
+    args[key] = value
+    parts[exchange.call_part_index] = types.Part(
+        function_call=function_call.model_copy(update={"args": args}), # type: ignore
+    )
+    messages[exchange.call_message_index] = message.model_copy(update={"parts": parts})
+
+
+# --------------
+#     STAGES
+# --------------
+
+
+def drop_superseded_reads(messages: list[types.Content], exchanges: list[ToolExchange]) -> None:
+    """A file read is stale if the same file is read again with the same arguments,
+    or is written, later in the conversation. A read answered with a back reference
+    doesn't make the result it refers to stale."""
+    read_later: set[str] = set()
+    written_later: set[str] = set()
+    for exchange in reversed(exchanges):
+        if exchange.name in WRITTEN_CONTENT_ARGUMENTS:
+            written_later.add(exchange.path("file_path"))
+        elif exchange.name == "get_file_content":
+            path = exchange.path("file_path")
+            read_key = json.dumps({**exchange.args, "file_path": path}, sort_keys=True, default=str)
+            if (read_key in read_later or path in written_later) and not exchange.is_compacted(messages):
+                replace_response(messages, exchange, f'{COMPACTED_PREFIX} Outdated content of "{path}", it was read again or modified later.')
+            elif exchange.referenced_call(messages) is not None:
+                continue
+            read_later.add(read_key)
+
+
+def drop_superseded_listings(messages: list[types.Content], exchanges: list[ToolExchange]) -> None:
+    """A directory listing is stale if the same directory is listed again with the same arguments,
+    or a file in that directory (or in its subdirectories, for a recursive listing) is written,
+    later in the conversation. As for reads, back references don't make listings stale."""
+    listed_later: set[str] = set()
+    written_later: set[str] = set()
+    for exchange in reversed(exchanges):
+        if exchange.name in WRITTEN_CONTENT_ARGUMENTS:
+            written_later.add(os.path.dirname(exchange.path("file_path")) or ".")
+        elif exchange.name == "get_files_info":
+            directory = exchange.path("directory")
+            listing_key = json.dumps({**exchange.args, "directory": directory}, sort_keys=True, default=str)
+            if exchange.args.get("recursive") or exchange.args.get("max_depth"):
+                written = any(_is_within(path, directory) for path in written_later)
+            else:
+                written = directory in written_later
+            if (listing_key in listed_later or written) and not exchange.is_compacted(messages):
+                replace_response(messages, exchange, f'{COMPACTED_PREFIX} Outdated listing of "{directory}", it was listed again or modified later.')
+            elif exchange.referenced_call(messages) is not None:
+                continue
+            listed_later.add(listing_key)
+
+
+def _is_within(path: str, directory: str) -> bool:
+    return directory == "." or path == directory or path.startswith(directory + os.sep)
+
+
+def drop_superseded_writes(messages: list[types.Content], exchanges: list[ToolExchange]) -> None:
+    """The content (or patch) sent with a write is stale if the same file is written or read later."""
+    accessed_later: set[str] = set()
+    for exchange in reversed(exchanges):
+        if exchange.name in WRITTEN_CONTENT_ARGUMENTS or exchange.name == "get_file_content":
+            path = exchange.path("file_path")
+            argument = WRITTEN_CONTENT_ARGUMENTS.get(exchange.name)
+            content = exchange.args.get(argument) if argument else None
+            if (
+                argument is not None
+                and path in accessed_later
+                and isinstance(content, str)
+                and not content.startswith(COMPACTED_PREFIX)
+            ):
+                replace_call_argument(messages, exchange, argument, f"{COMPACTED_PREFIX} {len(content)} characters, outdated.")
+            accessed_later.add(path)
+
+
+def truncate_old_outputs(messages: list[types.Content], exchanges: list[ToolExchange]) -> None:
+    """Keeps only the start and the end of the output of scripts executed in previous iterations."""
+    half = COMPACTION_MAX_OUTPUT_CHARACTERS // 2
+    for exchange in exchanges:
+        if exchange.name != "run_python_file" or exchange.recent:
+            continue
+        result = str(exchange.response(messages).get("result", ""))
+        if len(result) > COMPACTION_MAX_OUTPUT_CHARACTERS and not result.startswith(COMPACTED_PREFIX):
+            omitted = len(result) - 2 * half
+            replace_response(
+                messages,
+                exchange,
+                f"{COMPACTED_PREFIX} Output of a previous execution, {omitted} characters omitted in the middle:\n"
+                f"{result[:half]}\n[...]\n{result[-half:]}",
+            )
+
+
+def restore_back_references(original: list[types.Content], messages: list[types.Content], exchanges: list[ToolExchange]) -> None:
+    """Replaces each back reference to a compacted result with the original result.
+    Unlike the stages, it needs the original messages, and runs after all of them."""
+    for exchange in exchanges:
+        call_number = exchange.referenced_call(messages)
+        if call_number is None or not 1 <= call_number <= len(exchanges):
+            continue
+        referenced = exchanges[call_number - 1]
+        if referenced.is_compacted(messages):
+            replace_response(messages, exchange, str(referenced.response(original).get("result", "")))
+
+
+DEFAULT_STAGES: list[CompactionStage] = [
+    drop_superseded_reads,
+    drop_superseded_listings,
+    drop_superseded_writes,
+    truncate_old_outputs,
+]
+
+
+class ContextCompactor:
+    """Reduces the size of the messages list before it's sent to the model.
+
+    Every stage replaces stale function results (or arguments) with a short note,
+    the function call and response parts are never removed so that every call keeps
+    its response. If the result is still larger than `token_budget`, results of previous
+    iterations are replaced as well, oldest first. Results of the most recent model response
+    are never compacted, as the model hasn't seen them yet, so the budget is a target
+    that can be exceeded.
+
+    Finally, a back reference to a result that was compacted gets that result back (from the
+    original messages), so that the model can still see it, in the most recent position.
+
+    The original messages list and its elements are never modified.
+    """
+
+    def __init__(
+        self,
+        stages: list[CompactionStage] | None = None,
+        token_budget: int = COMPACTION_TOKEN_BUDGET,
+    ) -> None:
+        self.stages = DEFAULT_STAGES if stages is None else stages
+        self.token_budget = token_budget
+
+    def compact(self, messages: list[types.Content]) -> list[types.Content]:
+        compacted = list(messages)
+        exchanges = tool_exchanges(compacted)
+        for stage in self.stages:
+            stage(compacted, exchanges)
+        self._enforce_budget(compacted, exchanges)
+        restore_back_references(messages, compacted, exchanges)
+        return compacted
+
+    def _enforce_budget(self, messages: list[types.Content], exchanges: list[ToolExchange]) -> None:
+        excess = tokens.estimate_tokens(messages) - self.token_budget
+        for exchange in exchanges:
+            if excess <= 0:
+                break
+            if exchange.recent or exchange.is_compacted(messages) or exchange.referenced_call(messages) is not None:
+                continue
+            before = tokens.content_tokens(messages[exchange.message_index])
+            replace_response(messages, exchange, f"{COMPACTED_PREFIX} Result omitted to save space, call the function again if needed.")
+            excess -= before - tokens.content_tokens(messages[exchange.message_index])
+
+
+def compact(messages: list[types.Content]) -> list[types.Content]:
+    """Compacts the messages with the default stages and token budget, see `ContextCompactor`."""
+    return _default_compactor.compact(messages)
+
+
+_default_compactor = ContextCompactor()
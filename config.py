@@ -6,10 +6,44 @@ SUBCOMMAND_TIMEOUT_SECONDS = 30
 """Maximum allowed execution time for a function called by the agent.
 Subcommand execution should be terminated if it runs longer than this amount of seconds."""
 
+MAX_OUTPUT_HEAD_BYTES = 4_000
+MAX_OUTPUT_TAIL_BYTES = 4_000
+"""Limits the output of an executed Python file that is sent to the LLM: when stdout or stderr
+are longer than the sum of these, only their first and last bytes are kept."""
+MAX_OUTPUT_BYTES = 10_000_000
+"""An executed Python file writing more than this (stdout and stderr combined) is terminated."""
+
+PYTHON_POOL_ENABLED = False
+"""Run Python files in warm interpreters forked from a pool of workers, which import the
+modules used by the project in advance, instead of starting a new interpreter every time.
+Only standard library and installed modules are imported in advance, but they may still run code
+at import time, once per worker. Scripts run with resource limits and a minimal environment (see
+`functions/zygote.py`), unlike in a new interpreter."""
+PYTHON_POOL_SIZE = 2
+"""Number of workers in the pool, i.e. of Python files that can start running at the same time."""
+
 MAX_FILE_CONTENT_LENGTH = 10_000
 """Limits the number of characters that the agent can read from a file.
 Prevents accidentally sending huge files to the LLM."""
 
+MAX_LISTING_ENTRIES = 1_000
+"""Limits the number of entries returned by a directory listing, recursive listings
+of big trees stop at this many entries (the shallowest ones are kept)."""
+
+SEARCH_MAX_RESULTS = 100
+"""Limits the number of matching lines returned by a code search."""
+
+CODE_INDEX_DB_NAME = "code_index.db"
+"""Index of the contents of the working directory, used by code search. Shared by all
+working directories and agent processes, it can be deleted at any time to rebuild it."""
+
+CODE_INDEX_REFRESH_SECONDS = 10
+"""Before a search, files modified since the last refresh are indexed again, if it's older than this.
+Files written by the agent are indexed immediately, and every file is checked after running a script."""
+
+CODE_INDEX_MAX_FILE_BYTES = 1_000_000
+"""Bigger files are not indexed, and not searched."""
+
 WORKING_DIRECTORY = "./calculator"
 """The functions executed by the agent should be able to access
 only files and subdirectories located within this directory."""
@@ -18,6 +52,91 @@ MAX_ITERATIONS = 15
 """Maximum number of times the agent can iterate over the results of its actions.
 This helps preventing infinite loops and wasting tokens."""
 
+MAX_PARALLEL_FUNCTION_CALLS = 4
+"""Maximum number of function calls, requested by the agent in a single response,
+that can be executed at the same time. Set to 1 to execute them one after another."""
+
+TOOL_CACHE_MAX_ENTRIES = 256
+"""Maximum number of function results (file contents and directory listings) kept in memory,
+so that reading again an unchanged file doesn't touch the disk. Set to 0 to disable the cache."""
+
+TOOL_CACHE_MAX_CHARACTERS = 2_000_000
+"""Maximum total size of the results kept in the cache, least recently used results are evicted first."""
+
+DEDUPLICATION_ENABLED = True
+"""When the agent reads the same file (or lists the same directory, searches the same text...) again
+in a session and the result didn't change, send a short reference to the earlier identical result
+instead of the whole result again."""
+
+COMPACTION_ENABLED = True
+"""Before each request, replace outdated function results in the conversation history
+(files read again or modified, directories listed again, old script outputs) with a short note."""
+
+COMPACTION_TOKEN_BUDGET = 30_000
+"""If the compacted history is still estimated larger than this number of tokens,
+results of previous iterations are omitted too, oldest first."""
+
+MAX_REQUEST_TOKENS = 100_000
+"""Before each request its prompt tokens are estimated: requests larger than this, or than the tokens
+left in the daily quota, are compacted further. Requests still larger than this are counted exactly
+with the API, and refused if they really are."""
+
+COMPACTION_MAX_OUTPUT_CHARACTERS = 2_000
+"""Outputs of scripts executed in previous iterations are truncated to this length (start and end are kept)."""
+
+CONTEXT_CACHE_ENABLED = False
+"""Store the system prompt and the function declarations in a server-side cache, instead of sending
+them with every request. Cached tokens are billed at a reduced rate, but the API only accepts
+caches above a minimum size (and not on every plan): when a cache can't be created,
+requests are sent normally. The cache is shared by the sessions of the same process
+(daemon, batch), and deleted when the process exits."""
+
+CONTEXT_CACHE_TTL_SECONDS = 600
+"""How long the server keeps the cache after it was last refreshed."""
+
+CONTEXT_CACHE_PREFIX_MESSAGES = 0
+"""Number of messages at the start of the conversation (e.g. 1 for the user prompt)
+to include in the cache, together with the system prompt and function declarations."""
+
+RETRY_MAX_ATTEMPTS = 5
+"""Model calls failing with a transient error (rate limit, server or connection error)
+are sent again, up to this many times in total."""
+RETRY_INITIAL_DELAY_SECONDS = 1.0
+"""Maximum wait before the first retry, doubled for each following one.
+The actual wait is random, unless the server specifies one."""
+RETRY_MAX_DELAY_SECONDS = 60.0
+"""Upper limit for the wait between retries."""
+
+HEDGING_ENABLED = False
+"""Send a model call again if it takes longer than most previous calls, and use whichever
+response arrives first. Reduces the slowest response times, but duplicate requests count
+towards the quotas too (their usage is recorded in the stats). Streamed calls are never hedged."""
+HEDGING_LATENCY_PERCENTILE = 95
+"""Calls slower than this percentile of the recent ones are hedged."""
+HEDGING_MIN_SAMPLES = 20
+"""Calls are not hedged until there are enough recent latencies to compute the percentile."""
+
+BATCH_CONCURRENCY = 4
+"""Number of prompts run at the same time by `main.py batch`, unless specified with --concurrency."""
+
+DAEMON_SOCKET_PATH = "agent.sock"
+"""Unix socket used by `main.py serve` to receive prompts, and by `main.py --daemon` to send them.
+Relative paths are resolved from the directory the commands are run from."""
+
+SESSIONS_DIRECTORY = "sessions"
+"""Where the conversations started from the command line are saved, so that they can be
+continued with --resume. Relative paths are resolved from the directory the agent is run from."""
+SESSION_SNAPSHOT_INTERVAL = 10
+"""Every this many iterations, the whole conversation is saved in a snapshot, so that resuming
+reads the snapshot and the few iterations logged after it, instead of the whole log."""
+
+TRACING_ENABLED = False
+"""Record how long each model request, function call and stats write takes, in `TRACE_FILE_NAME`.
+Can be enabled for a single run with --trace. Summarize the trace with `main.py trace summary`."""
+TRACE_FILE_NAME = "trace.json"
+"""Trace events are appended to this file, one per line. It can be opened as it is in
+chrome://tracing or https://ui.perfetto.dev to see a timeline."""
+
 
 # -------------
 #     STATS
@@ -25,6 +144,33 @@ This helps preventing infinite loops and wasting tokens."""
 
 
 STATS_DB_NAME = "api_stats.db"
+
+STATS_WRITE_BEHIND = False
+"""Buffer stats records in memory and write them in batches, instead of one transaction per request.
+Useful when running many sessions in the same process (daemon, batch), but buffered records
+are lost if the process is killed."""
+
+STATS_FLUSH_INTERVAL_SECONDS = 5.0
+"""With write-behind enabled, maximum time a record is kept in memory before being written."""
+
+STATS_FLUSH_MAX_RECORDS = 50
+"""With write-behind enabled, buffered records are written as soon as there are this many."""
+
 STATS_MAX_REQUESTS_PER_DAY = 200
 STATS_MAX_REQUESTS_PER_MINUTE = 15
 STATS_MAX_TOKENS_PER_DAY = 200_000
+
+STATS_PRICE_PER_MILLION_PROMPT_TOKENS = 0.10
+STATS_PRICE_PER_MILLION_RESPONSE_TOKENS = 0.40
+"""Prices in USD of the model tokens on the paid plan, used to estimate the cost of each conversation in `main.py stats`."""
+STATS_REPORT_ROWS = 10
+"""Number of rows of each report printed by `main.py stats`."""
+
+RATE_LIMIT_ENABLED = True
+"""Delay requests to the model so that they stay within the quotas above, instead of having them rejected.
+Usage is read from the stats database, so the quotas are shared with any other agent process."""
+RATE_LIMIT_MAX_WAIT_SECONDS = 120
+"""Fail instead of waiting if a request could not be sent within this time."""
+RATE_LIMIT_EXPECTED_RESPONSE_TOKENS = 500
+"""Added to the estimated size of the request to predict its total token usage,
+since the response counts towards the daily quota too."""
@@ -0,0 +1,153 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from google import genai
+from google.genai import types
+
+import call_function
+from config import (
+    MODEL_ID,
+    CONTEXT_CACHE_TTL_SECONDS,
+    CONTEXT_CACHE_PREFIX_MESSAGES,
+)
+
+
+REFRESH_MARGIN_SECONDS = 30
+"""The cache expiration is extended if it would expire within this amount of seconds."""
+
+MAX_CACHED_CONTENTS = 8
+"""With `prefix_messages`, each conversation has its own cached content: the least recently
+used ones are deleted beyond this number."""
+
+RETRY_AFTER_FAILURE_SECONDS = 300
+"""After failing to create a cache (e.g. because the content is below the minimum size
+accepted by the API), requests are sent without cache for this amount of seconds."""
+
+
+class ContextCache:
+    """Keeps a server-side cached content for the static prefix of every request:
+    the system prompt, the tool declarations and optionally the first `prefix_messages`
+    messages of the conversation, so that they are not billed in full on every iteration.
+
+    A single instance should be shared by all the sessions using the same client, so that they
+    reuse the same cached content, and closed when they are done (see `agent.context_cache()`).
+    With `prefix_messages`, a cached content is kept for each different prefix, up to
+    `MAX_CACHED_CONTENTS`.
+
+    A cached content is recreated whenever its content changes (e.g. when the function schemas
+    in `call_function.py` are modified, or when an early message is compacted), and its TTL is
+    extended when it's about to expire. If the cache cannot be created, requests are sent
+    with the full content instead. It is safe to use from multiple threads.
+    """
+
+    def __init__(
+        self,
+        client: genai.Client,
+        model: str = MODEL_ID,
+        ttl_seconds: int = CONTEXT_CACHE_TTL_SECONDS,
+        prefix_messages: int = CONTEXT_CACHE_PREFIX_MESSAGES,
+        max_cached_contents: int = MAX_CACHED_CONTENTS,
+    ) -> None:
+        self._client = client
+        self._model = model
+        self._ttl_seconds = ttl_seconds
+        self._prefix_messages = prefix_messages
+        self._max_cached_contents = max_cached_contents
+        # Fingerprint of the prefix -> its cached content, least recently used first
+        self._cached_contents: OrderedDict[str, types.CachedContent] = OrderedDict()
+        # Fingerprint of the system prompt and tools, all the cached contents are recreated if they change
+        self._static_fingerprint: str | None = None
+        self._disabled_until = 0.0
+        self._lock = threading.Lock()
+
+    def request(self, contents: list[types.Content]) -> tuple[types.GenerateContentConfig, list[types.Content]]:
+        """Returns the config to use for the next request, and the contents to send with it
+        (without the messages that are part of the cached content)."""
+        with self._lock:
+            if time.monotonic() < self._disabled_until:
+                return default_config(), contents
+
+            prefix = contents[:self._prefix_messages] if len(contents) > self._prefix_messages else []
+            static_fingerprint = self._compute_fingerprint([])
+            fingerprint = self._compute_fingerprint(prefix)
+            try:
+                if static_fingerprint != self._static_fingerprint:
+                    self._delete_all()
+                    self._static_fingerprint = static_fingerprint
+                cached_content = self._cached_contents.get(fingerprint)
+                if cached_content is None or _expires_within(cached_content, 0):
+                    cached_content = self._create(prefix, fingerprint)
+                elif _expires_within(cached_content, REFRESH_MARGIN_SECONDS):
+                    cached_content = self._client.caches.update(
+                        name=cached_content.name, # type: ignore
+                        config=types.UpdateCachedContentConfig(ttl=f"{self._ttl_seconds}s"),
+                    )
+                self._cached_contents[fingerprint] = cached_content
+                self._cached_contents.move_to_end(fingerprint)
+                while len(self._cached_contents) > self._max_cached_contents:
+                    self._delete(next(iter(self._cached_contents)))
+            except Exception:
+                self._cached_contents.pop(fingerprint, None)
+                self._disabled_until = time.monotonic() + RETRY_AFTER_FAILURE_SECONDS
+                return default_config(), contents
+
+        config = types.GenerateContentConfig(cached_content=cached_content.name) # type: ignore
+        return config, contents[len(prefix):]
+
+    def close(self) -> None:
+        """Deletes the cached contents, instead of waiting for them to expire."""
+        with self._lock:
+            self._delete_all()
+
+    def _create(self, prefix: list[types.Content], fingerprint: str) -> types.CachedContent:
+        if fingerprint in self._cached_contents:
+            self._delete(fingerprint)
+        return self._client.caches.create(
+            model=self._model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=call_function.system_prompt,
+                tools=[call_function.available_functions],
+                contents=prefix or None, # type: ignore
+                ttl=f"{self._ttl_seconds}s",
+            ),
+        )
+
+    def _delete_all(self) -> None:
+        for fingerprint in list(self._cached_contents):
+            self._delete(fingerprint)
+
+    def _delete(self, fingerprint: str) -> None:
+        cached_content = self._cached_contents.pop(fingerprint)
+        if _expires_within(cached_content, 0):
+            return
+        try:
+            self._client.caches.delete(name=cached_content.name) # type: ignore
+        except Exception:
+            # It will expire anyway
+            pass
+
+    def _compute_fingerprint(self, prefix: list[types.Content]) -> str:
+        digest = hashlib.sha256()
+        digest.update(self._model.encode())
+        digest.update(call_function.system_prompt.encode())
+        digest.update(call_function.available_functions.model_dump_json().encode())
+        for content in prefix:
+            digest.update(content.model_dump_json().encode())
+        return digest.hexdigest()
+
+
+def _expires_within(cached_content: types.CachedContent, seconds: float) -> bool:
+    if cached_content.expire_time is None:
+        return False
+    return (cached_content.expire_time - datetime.now(timezone.utc)).total_seconds() < seconds
+
+
+def default_config() -> types.GenerateContentConfig:
+    """Config for a request that includes the full system prompt and tool declarations."""
+    return types.GenerateContentConfig(
+        tools=[call_function.available_functions],
+        system_instruction=call_function.system_prompt,
+    )
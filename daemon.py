@@ -0,0 +1,209 @@
+"""Long-lived agent process, listening for prompts on a Unix socket.
+
+Starting the agent for every prompt means paying every time for interpreter startup,
+heavy imports and client creation. `serve()` does all of that once, then runs each
+prompt received on the socket in its own thread, sharing the same API client (and its
+connection pool) and the same function results cache.
+
+The protocol is one JSON object per line. The client sends a single request:
+    {"prompt": "...", "verbose": false, "stream": false}
+and the daemon replies with any number of output messages, with the text the agent
+would print on the console, followed by a single result or error message:
+    {"type": "output", "text": "..."}
+    {"type": "result", "text": "...", "conversation_id": 1}
+    {"type": "error", "message": "...", "conversation_id": 1}
+
+Each prompt is a new conversation, saved in the sessions directory as those started from
+the command line, and its requests are recorded in the stats with its conversation id.
+
+Only the standard library is imported at module level, so that the client is fast to start.
+"""
+import contextvars
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from typing import Callable
+
+from config import DAEMON_SOCKET_PATH, SESSIONS_DIRECTORY
+
+
+class _ContextStdout(io.TextIOBase):
+    """Replaces `sys.stdout` so that each request's output is sent to its own client.
+
+    The destination is stored in a context variable, which is inherited by the threads
+    that execute function calls (see `FunctionCallDispatcher`).
+    """
+
+    def __init__(self, default) -> None:
+        self._default = default
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        return (_output.get() or self._default).write(text)
+
+    def flush(self) -> None:
+        (_output.get() or self._default).flush()
+
+
+class _SocketWriter:
+    """Sends printed text to the client, one output message per line (or per flush)."""
+
+    def __init__(self, send) -> None:
+        self._send = send
+        self._buffer = ""
+        self._lock = threading.Lock()
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            self._buffer += text
+            if "\n" in text:
+                self._flush()
+        return len(text)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._buffer:
+            self._send({"type": "output", "text": self._buffer})
+            self._buffer = ""
+
+
+_output: contextvars.ContextVar[_SocketWriter | None] = contextvars.ContextVar("daemon_output", default=None)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: "_AgentServer"
+
+    def handle(self) -> None:
+        send_lock = threading.Lock()
+
+        def send(message: dict) -> None:
+            with send_lock:
+                self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+        try:
+            request = json.loads(self.rfile.readline())
+            prompt = request["prompt"]
+        except Exception as exc:
+            send({"type": "error", "message": f"Invalid request: {exc}"})
+            return
+
+        writer = _SocketWriter(send)
+        token = _output.set(writer)
+        conversation_id = None
+        try:
+            session = self.server.create_session()
+            conversation_id = session.conversation_id
+            result = self.server.agent_request(
+                prompt,
+                self.server.api_key,
+                bool(request.get("verbose", False)),
+                stream=bool(request.get("stream", False)),
+                client=self.server.client,
+                session=session,
+            )
+            writer.flush()
+            send({"type": "result", "text": result, "conversation_id": conversation_id})
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, nobody to report to
+            pass
+        except Exception as exc:
+            try:
+                writer.flush()
+                send({"type": "error", "message": str(exc), "conversation_id": conversation_id})
+            except OSError:
+                pass
+        finally:
+            _output.reset(token)
+
+
+class _AgentServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str,
+        api_key: str,
+        agent_request: Callable[..., str],
+        sessions_directory: str = SESSIONS_DIRECTORY,
+    ) -> None:
+        # Imported here, so that the client mode doesn't pay for it
+        from google import genai
+        import sessions
+
+        self.api_key = api_key
+        self.client = genai.Client(api_key=api_key)
+        self.agent_request = agent_request
+        self.create_session = lambda: sessions.Session.create(sessions_directory)
+        super().__init__(socket_path, _RequestHandler)
+
+
+def serve(
+    api_key: str,
+    agent_request: Callable[..., str],
+    socket_path: str = DAEMON_SOCKET_PATH,
+) -> None:
+    """Listens for prompts on the socket until interrupted, and answers them with `agent_request`."""
+    if os.path.exists(socket_path):
+        if _is_listening(socket_path):
+            raise RuntimeError(f'Another agent daemon is already listening on "{socket_path}"')
+        # Left over by a daemon that didn't exit cleanly
+        os.remove(socket_path)
+
+    server = _AgentServer(socket_path, api_key, agent_request)
+    sys.stdout = _ContextStdout(sys.stdout)
+    print(f'Agent daemon listening on "{socket_path}", press Ctrl+C to stop.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def send_prompt(
+    prompt: str,
+    verbose: bool,
+    stream: bool = False,
+    socket_path: str = DAEMON_SOCKET_PATH,
+) -> str:
+    """Sends the prompt to a running daemon, printing its output while it's received.
+
+    Returns the agent final answer, or raises an exception.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError as exc:
+            raise ConnectionError(f'Cannot connect to the agent daemon on "{socket_path}", start it with `main.py serve`: {exc}') from exc
+        request = {"prompt": prompt, "verbose": verbose, "stream": stream}
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+
+        with sock.makefile("r", encoding="utf-8") as replies:
+            for line in replies:
+                message = json.loads(line)
+                match message["type"]:
+                    case "output": print(message["text"], end="", flush=True)
+                    case "result": return message["text"]
+                    case "error": raise Exception(message["message"])
+
+    raise ConnectionError("The agent daemon closed the connection before replying")
+
+
+def _is_listening(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+            return True
+        except OSError:
+            return False
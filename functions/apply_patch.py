@@ -0,0 +1,217 @@
+import math
+import os
+import re
+import threading
+from google.genai import types
+
+from functions.write_file import write_atomically
+from tokens import CHARACTERS_PER_TOKEN
+
+
+_SEARCH_REPLACE_BLOCK = re.compile(
+    r"^<<<<<<< SEARCH[ \t]*\n(.*?)^=======[ \t]*\n(.*?)^>>>>>>> REPLACE[ \t]*$",
+    re.MULTILINE | re.DOTALL,
+)
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+
+class PatchError(Exception):
+    """The patch is malformed, or doesn't match the current content of the file."""
+
+
+class PatchMetrics:
+    """Counts applied patches, and compares their size with the size of the patched files,
+    which is what the model would have written to rewrite them with `write_file`."""
+
+    def __init__(self) -> None:
+        self.patches = 0
+        self.patch_characters = 0
+        self.rewrite_characters = 0
+        self._lock = threading.Lock()
+
+    def record(self, patch: str, new_content: str) -> None:
+        with self._lock:
+            self.patches += 1
+            self.patch_characters += len(patch)
+            self.rewrite_characters += len(new_content)
+
+    def saved_tokens(self) -> int:
+        """Estimate of the output tokens saved by sending patches instead of whole files."""
+        return math.ceil((self.rewrite_characters - self.patch_characters) / CHARACTERS_PER_TOKEN)
+
+    def summary(self) -> str:
+        if not self.rewrite_characters:
+            return f"{self.patches} patches"
+        saved_percent = 100 * (self.rewrite_characters - self.patch_characters) / self.rewrite_characters
+        return f"{self.patches} patches, about {self.saved_tokens()} output tokens saved ({saved_percent:.0f}%) compared with rewriting the files"
+
+
+patch_metrics = PatchMetrics()
+
+
+def apply_patch(working_directory: str, file_path: str, patch: str) -> str:
+    """Modifies an existing file with a patch, either a unified diff or search/replace blocks.
+    The whole patch is checked against the current content before anything is written,
+    and the file is written atomically.
+    Returns a message specifying the result of the operation.
+
+    - working_directory: relative path from cwd to a project directory
+    - file_path: relative path within the chosen working directory
+    - patch: the changes to apply, see `schema_apply_patch`
+    """
+    # Prevent accessing anything outside of the working directory
+    workdir_abspath = os.path.abspath(working_directory)
+    file_abspath = os.path.abspath(os.path.join(working_directory, file_path))
+
+    if not file_abspath.startswith(workdir_abspath):
+        return f'Error: Cannot write to "{file_path}" as it is outside the permitted working directory'
+    if not os.path.isfile(file_abspath):
+        return f'Error: File not found or is not a regular file: "{file_path}". Use write_file to create new files'
+
+    try:
+        with open(file_abspath, encoding="utf-8", newline="") as f:
+            content = f.read()
+    except Exception as exc:
+        return f'Error: cannot read file "{file_path}": {exc}'
+
+    try:
+        if _SEARCH_REPLACE_BLOCK.search(patch):
+            new_content, changes = apply_search_replace(content, patch)
+        elif any(_HUNK_HEADER.match(line) for line in patch.splitlines()):
+            new_content, changes = apply_unified_diff(content, patch)
+        else:
+            return "Error: the patch must be a unified diff with @@ hunk headers, or search/replace blocks"
+    except PatchError as exc:
+        return f'Error: cannot apply patch to "{file_path}": {exc}. The file was not modified'
+
+    try:
+        write_atomically(file_abspath, new_content)
+    except Exception as exc:
+        return f'Error: cannot write to file "{file_path}": {exc}'
+    patch_metrics.record(patch, new_content)
+    return f'Successfully patched "{file_path}" ({changes} changes, {len(new_content)} characters)'
+
+
+def apply_search_replace(content: str, patch: str) -> tuple[str, int]:
+    """Replaces the text of each SEARCH section, which must appear exactly once, with its REPLACE section."""
+    blocks = _SEARCH_REPLACE_BLOCK.findall(patch)
+    for number, (search, replace) in enumerate(blocks, start=1):
+        if not search:
+            raise PatchError(f"search block {number} is empty")
+        occurrences = content.count(search)
+        if occurrences == 0:
+            # The model may have omitted the final newline of the last line of the file
+            if search.endswith("\n") and content.endswith(search[:-1]):
+                search = search[:-1]
+                replace = replace[:-1] if replace.endswith("\n") else replace
+            else:
+                raise PatchError(f"search block {number} was not found, read the file again to copy its current content exactly")
+        elif occurrences > 1:
+            raise PatchError(f"search block {number} appears {occurrences} times, include more lines to make it unique")
+        content = content.replace(search, replace, 1)
+    return content, len(blocks)
+
+
+def apply_unified_diff(content: str, patch: str) -> tuple[str, int]:
+    """Applies the hunks of a unified diff. As with `patch`, a hunk is found even if
+    the lines it changes moved from the position in its header, but never with different context."""
+    lines = content.splitlines(keepends=True)
+    newline = "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+    hunks = _parse_hunks(patch)
+    if not hunks:
+        raise PatchError("the diff contains no hunks")
+
+    # Position of the line after the last applied hunk, and shift of the following ones
+    search_from = 0
+    offset = 0
+    for number, (start, old_lines, new_lines) in enumerate(hunks, start=1):
+        expected = max(start - 1, 0) + offset
+        if old_lines:
+            position = _find_lines(lines, old_lines, search_from, expected)
+            if position is None:
+                preview = "".join(f"\n    {line}" for line in old_lines[:3])
+                raise PatchError(f"hunk {number} does not match the current content near line {start}, expected:{preview}")
+        else:
+            # Pure insertion, after the line in the header, shifted as the other hunks
+            position = min(max(start + offset, search_from), len(lines))
+
+        replaced_last_line = position + len(old_lines) == len(lines)
+        missing_final_newline = bool(lines) and not lines[-1].endswith("\n")
+        replacement = [line + newline for line in new_lines]
+        if replacement and replaced_last_line and missing_final_newline:
+            replacement[-1] = replacement[-1][:-len(newline)]
+        lines[position:position + len(old_lines)] = replacement
+        search_from = position + len(replacement)
+        offset += len(replacement) - len(old_lines)
+    return "".join(lines), len(hunks)
+
+
+def _parse_hunks(patch: str) -> list[tuple[int, list[str], list[str]]]:
+    """Returns the start line in the original file, the old lines and the new lines of each hunk."""
+    hunks: list[tuple[int, list[str], list[str]]] = []
+    old_lines: list[str] = []
+    new_lines: list[str] = []
+    in_hunk = False
+    patch_lines = patch.splitlines()
+    if sum(1 for line in patch_lines if line.startswith("+++ ")) > 1:
+        raise PatchError("the diff modifies several files, send a patch for each file")
+    for i, line in enumerate(patch_lines):
+        header = _HUNK_HEADER.match(line)
+        if header:
+            old_lines, new_lines = [], []
+            hunks.append((int(header.group(1)), old_lines, new_lines))
+            in_hunk = True
+        elif not in_hunk or line.startswith("\\"):
+            # File headers, or "\ No newline at end of file"
+            continue
+        elif line.startswith("diff ") or (line.startswith("--- ") and patch_lines[i + 1:i + 2] and patch_lines[i + 1].startswith("+++ ")):
+            # Header of the next file. Otherwise "--- " is a removed line starting with "--"
+            in_hunk = False
+        elif line.startswith("-"):
+            old_lines.append(line[1:])
+        elif line.startswith("+"):
+            new_lines.append(line[1:])
+        else:
+            # Context, the leading space is often lost from empty lines
+            old_lines.append(line[1:] if line.startswith(" ") else line)
+            new_lines.append(line[1:] if line.startswith(" ") else line)
+    return hunks
+
+
+def _find_lines(lines: list[str], expected_lines: list[str], search_from: int, expected: int) -> int | None:
+    """Returns the position of the expected lines (ignoring line endings) closest to `expected`,
+    not before `search_from`, or None if they're not found."""
+    stripped = [line.rstrip("\r\n") for line in lines]
+    last = len(lines) - len(expected_lines)
+    candidates = sorted(range(search_from, last + 1), key=lambda position: abs(position - expected))
+    for position in candidates:
+        if stripped[position:position + len(expected_lines)] == expected_lines:
+            return position
+    return None
+
+
+# The `working_directory` is intentionally not listed as we won't allow the AI to specify that argument.
+schema_apply_patch = types.FunctionDeclaration(
+    name="apply_patch",
+    description=(
+        "Modify an existing file by sending only the changes, instead of its whole content. Prefer this to write_file for changes to existing files."
+        " The patch is either a unified diff (with @@ hunk headers and 3 lines of context),"
+        " or one or more search/replace blocks, each made of a line `<<<<<<< SEARCH`, the exact current text to replace,"
+        " a line `=======`, the new text, and a line `>>>>>>> REPLACE`. The text to replace must appear only once in the file."
+        " If any part of the patch doesn't match the file, nothing is modified."
+    ),
+    parameters=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "file_path": types.Schema(
+                type=types.Type.STRING,
+                description="The file to modify, specified as a path relative to the working directory.",
+            ),
+            "patch": types.Schema(
+                type=types.Type.STRING,
+                description="A unified diff, or search/replace blocks.",
+            ),
+        },
+        required=["file_path", "patch"],
+    )
+)
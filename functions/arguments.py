@@ -0,0 +1,14 @@
+"""Validation of the arguments of function calls requested by the agent, shared by the functions."""
+
+
+def optional_int(name: str, value, minimum: int) -> int | None:
+    """Returns the integer value of an optional argument, or None if it's not given.
+    Raises `ValueError` if it's not an integer, or smaller than `minimum`."""
+    # Numbers in function calls may be received as floats
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+        raise ValueError(f"{name} must be an integer not smaller than {minimum}")
+    return value
@@ -0,0 +1,322 @@
+"""Full text index of the files in a working directory, used by `search_code`.
+
+Contents are stored in an SQLite FTS5 table with the trigram tokenizer, which can find
+any substring of at least 3 characters without reading the files. A regular expression
+is only checked against the files containing the literal parts it requires.
+
+The index is stored on disk, so it's built once and then updated incrementally:
+before a search, files whose modification time or size changed are indexed again,
+and files written by the agent are updated immediately. Files ignored by `.gitignore`,
+bigger than `CODE_INDEX_MAX_FILE_BYTES`, or not UTF-8 text are not indexed.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Iterator
+
+from config import CODE_INDEX_DB_NAME, CODE_INDEX_REFRESH_SECONDS, CODE_INDEX_MAX_FILE_BYTES
+from functions.gitignore import IgnoreRules, walk_files
+
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        id       INTEGER PRIMARY KEY,
+        root     TEXT    NOT NULL,
+        path     TEXT    NOT NULL,
+        mtime_ns INT     NOT NULL,
+        size     INT     NOT NULL,
+        -- 0 for files that are not indexed, e.g. binary files
+        indexed  INT     NOT NULL,
+        UNIQUE (root, path)
+    )
+    """,
+    # The rowid of the content is the id of the file
+    "CREATE VIRTUAL TABLE IF NOT EXISTS content USING fts5(body, tokenize='trigram')",
+]
+
+_TRIGRAM = 3
+_READ_BATCH_SIZE = 100
+
+
+class CodeIndex:
+    """Index of the files of a working directory. Safe to use from multiple threads,
+    and from multiple processes sharing the same database."""
+
+    def __init__(self, working_directory: str, db_name: str | None = None) -> None:
+        self._root = os.path.abspath(working_directory)
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(db_name or CODE_INDEX_DB_NAME, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in _SCHEMA:
+                self._connection.execute(statement)
+        # None until the first refresh
+        self._refreshed_at: float | None = None
+
+    def search(self, regex: re.Pattern, literals: list[str], directory: str = "") -> Iterator[tuple[str, int, str]]:
+        """Yields the path (relative to the working directory), line number and line
+        of each match of the regular expression, in the order files were indexed.
+
+        `literals` are strings that any match must contain: only the files that contain
+        them are searched. Without literals (or with literals shorter than 3 characters)
+        every file in the directory is searched.
+        """
+        self.refresh_if_needed()
+        literals = [literal for literal in literals if len(literal) >= _TRIGRAM]
+        prefix = directory.replace(os.sep, "/").strip("/")
+        params: list = []
+        if literals:
+            # Files are found by the full text index, then joined with their paths
+            query = "SELECT content.rowid, files.path, content.body FROM content CROSS JOIN files ON files.id = content.rowid"
+            query += " WHERE content MATCH ? AND files.root = ?"
+            params += [" AND ".join('"' + literal.replace('"', '""') + '"' for literal in literals), self._root]
+            # Sorted as the full text index returns them, so that it stops at the limit
+            id_column = "content.rowid"
+        else:
+            query = "SELECT files.id, files.path, content.body FROM files CROSS JOIN content ON content.rowid = files.id"
+            query += " WHERE files.root = ?"
+            params.append(self._root)
+            id_column = "files.id"
+        if prefix:
+            query += " AND files.path >= ? AND files.path < ?"
+            params += [prefix + "/", prefix + "0"]
+        query += f" AND {id_column} > ? ORDER BY {id_column} LIMIT ?"
+
+        # Files are read a few at a time, the caller may stop after the first matches
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(query, [*params, last_id, _READ_BATCH_SIZE]).fetchall()
+            for file_id, path, body in rows:
+                if not regex.search(body):
+                    continue
+                for number, line in enumerate(body.splitlines(), start=1):
+                    if regex.search(line):
+                        yield path, number, line
+            if len(rows) < _READ_BATCH_SIZE:
+                return
+            last_id = rows[-1][0]
+
+    def refresh_if_needed(self) -> None:
+        if self._refreshed_at is None or time.monotonic() - self._refreshed_at > CODE_INDEX_REFRESH_SECONDS:
+            self.refresh()
+
+    def mark_stale(self) -> None:
+        """Files may have changed without the index knowing, check them all before the next search."""
+        self._refreshed_at = None
+
+    def refresh(self) -> None:
+        """Indexes the files added or modified since the last refresh, and removes the deleted ones."""
+        with self._lock:
+            indexed = {
+                path: (file_id, mtime_ns, size)
+                for file_id, path, mtime_ns, size in self._connection.execute(
+                    "SELECT id, path, mtime_ns, size FROM files WHERE root = ?", (self._root,)
+                )
+            }
+            with self._connection:
+                for path, stat in walk_files(self._root):
+                    previous = indexed.pop(path, None)
+                    if previous is not None and previous[1:] == (stat.st_mtime_ns, stat.st_size):
+                        continue
+                    self._update(path, stat, previous[0] if previous else None)
+                for file_id, _, _ in indexed.values():
+                    self._delete(file_id)
+            self._refreshed_at = time.monotonic()
+
+    def update_file(self, file_path: str) -> None:
+        """Indexes a single file again, or removes it from the index if it doesn't exist anymore."""
+        file_abspath = os.path.abspath(os.path.join(self._root, file_path))
+        path = os.path.relpath(file_abspath, self._root).replace(os.sep, "/")
+        if path.startswith("../"):
+            return
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT id FROM files WHERE root = ? AND path = ?", (self._root, path)).fetchone()
+            try:
+                stat = os.stat(file_abspath)
+            except OSError:
+                stat = None
+            if stat is None or _ignored(self._root, path):
+                if row is not None:
+                    self._delete(row[0])
+            else:
+                self._update(path, stat, row[0] if row else None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _update(self, path: str, stat: os.stat_result, file_id: int | None) -> None:
+        body = _read_text(os.path.join(self._root, path), stat.st_size)
+        if file_id is None:
+            file_id = self._connection.execute(
+                "INSERT INTO files (root, path, mtime_ns, size, indexed) VALUES (?, ?, ?, ?, ?)",
+                (self._root, path, stat.st_mtime_ns, stat.st_size, body is not None),
+            ).lastrowid
+        else:
+            self._connection.execute(
+                "UPDATE files SET mtime_ns = ?, size = ?, indexed = ? WHERE id = ?",
+                (stat.st_mtime_ns, stat.st_size, body is not None, file_id),
+            )
+            self._connection.execute("DELETE FROM content WHERE rowid = ?", (file_id,))
+        if body is not None:
+            self._connection.execute("INSERT INTO content (rowid, body) VALUES (?, ?)", (file_id, body))
+
+    def _delete(self, file_id: int) -> None:
+        self._connection.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        self._connection.execute("DELETE FROM content WHERE rowid = ?", (file_id,))
+
+
+def _ignored(root: str, path: str) -> bool:
+    """Whether the file, or any of the directories containing it, is ignored."""
+    rules = IgnoreRules.for_directory(root, root)
+    names = path.split("/")
+    for i in range(len(names)):
+        relpath = "/".join(names[:i + 1])
+        is_dir = i < len(names) - 1
+        if rules.ignored(relpath, is_dir):
+            return True
+        if is_dir:
+            rules = rules.child(root, relpath)
+    return False
+
+
+def _read_text(path: str, size: int) -> str | None:
+    """Returns the content of a text file, or None if it's binary or too big to be indexed."""
+    if size > CODE_INDEX_MAX_FILE_BYTES:
+        return None
+    try:
+        with open(path, "rb") as f:
+            data = f.read(CODE_INDEX_MAX_FILE_BYTES + 1)
+        if b"\0" in data or len(data) > CODE_INDEX_MAX_FILE_BYTES:
+            return None
+        return data.decode("utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def required_literals(pattern: str) -> list[str] | None:
+    """Returns strings that any match of the regular expression must contain,
+    or None if the pattern can match without any specific string (it has top level alternatives),
+    or if it can't be parsed confidently: the caller should then search every file.
+
+    Only the literal characters outside of groups and character classes are considered:
+    it's not the longest possible list, but it never misses a match.
+    """
+    # With the verbose flag, whitespace is not literal
+    if re.search(r"\(\?[a-zA-Z]*x", pattern):
+        return None
+    literals: list[str] = []
+    current: list[str] = []
+
+    def end_literal() -> None:
+        if current:
+            literals.append("".join(current))
+            current.clear()
+
+    i = 0
+    depth = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+        length = 1
+        if char == "\\":
+            length = _escape_length(pattern, i)
+            if length is None:
+                return None
+            escaped = pattern[i + 1:i + 2]
+            if escaped and not escaped.isalnum():
+                literal = escaped
+        elif char == "[":
+            # Skip the whole character class
+            end = i + 1
+            if pattern[end:end + 1] == "^":
+                end += 1
+            if pattern[end:end + 1] == "]":
+                end += 1
+            while end < len(pattern) and pattern[end] != "]":
+                end += 2 if pattern[end] == "\\" else 1
+            length = end + 1 - i
+        elif char == "{":
+            # Skip the whole quantifier, the atom before it was already left out of the literal
+            quantifier = _QUANTIFIER.match(pattern, i)
+            if quantifier is None:
+                return None
+            length = quantifier.end() - i
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            # Any alternative may match
+            return None
+        elif char not in ".^$*+?{}":
+            literal = char
+
+        # A character followed by a quantifier that allows zero repetitions is optional,
+        # and one repeated a given number of times ({m,n}) is left out too
+        following = pattern[i + length:i + length + 1]
+        if literal is not None and depth == 0 and following not in ("?", "*", "{"):
+            current.append(literal)
+            if following == "+":
+                end_literal()
+        else:
+            end_literal()
+        i += length
+    end_literal()
+    return literals
+
+
+_QUANTIFIER = re.compile(r"\{(?:\d+(?:,\d*)?|,\d*)\}")
+
+# Number of characters after the backslash of escapes matching a character given by its code
+_CODE_ESCAPE_LENGTHS = {"x": 3, "u": 5, "U": 9}
+
+
+def _escape_length(pattern: str, i: int) -> int | None:
+    """Returns the length of the escape sequence starting at `pattern[i]`, or None if it's not clear."""
+    escaped = pattern[i + 1:i + 2]
+    if escaped in _CODE_ESCAPE_LENGTHS:
+        return 1 + _CODE_ESCAPE_LENGTHS[escaped]
+    if escaped == "N":
+        end = pattern.find("}", i)
+        return None if pattern[i + 2:i + 3] != "{" or end < 0 else end + 1 - i
+    if escaped.isdigit():
+        # Octal escapes and group references, the digits that follow are never literal
+        length = 2
+        while length < 4 and pattern[i + length:i + length + 1].isdigit():
+            length += 1
+        return length
+    return 2
+
+
+_indexes: dict[str, CodeIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(working_directory: str) -> CodeIndex:
+    """Returns the index of the working directory, opening it on first use."""
+    working_directory = os.path.abspath(working_directory)
+    with _indexes_lock:
+        if working_directory not in _indexes:
+            _indexes[working_directory] = CodeIndex(working_directory)
+        return _indexes[working_directory]
+
+
+def file_written(working_directory: str, file_path: str) -> None:
+    """Updates the index after a file was written, if the working directory has been searched."""
+    with _indexes_lock:
+        index = _indexes.get(os.path.abspath(working_directory))
+    if index is not None:
+        index.update_file(file_path)
+
+
+def mark_stale() -> None:
+    """Files may have been changed by a script, they're checked again before the next search."""
+    with _indexes_lock:
+        for index in _indexes.values():
+            index.mark_stale()
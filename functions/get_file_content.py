@@ -1,10 +1,24 @@
+import codecs
+import mmap
 import os
 from google.genai import types
 
 from config import MAX_FILE_CONTENT_LENGTH as MAX_LENGTH
+from functions.arguments import optional_int
 
 
-def get_file_content(working_directory: str, file_path: str) -> str:
+# A UTF-8 character is at most 4 bytes, so this many bytes always contain enough characters.
+MAX_BYTES = (MAX_LENGTH + 1) * 4
+
+
+def get_file_content(
+    working_directory: str,
+    file_path: str,
+    offset: int | None = None,
+    start_line: int | None = None,
+    end_line: int | None = None,
+    tail_lines: int | None = None,
+) -> str:
     """Returns the contents of a file.as a string.
 
     If file does not exist or is not withing the chosen directory,
@@ -12,6 +26,13 @@ def get_file_content(working_directory: str, file_path: str) -> str:
 
     - working_directory: relative path from cwd to a project directory
     - file_path: relative path within the chosen working directory
+
+    Only part of the file can be requested, with at most one of:
+    - offset: position in bytes to start reading from, as suggested when content is truncated
+    - start_line, end_line: range of lines to read, starting from 1 and both included
+    - tail_lines: number of lines to read from the end of the file
+
+    At most `MAX_LENGTH` characters are returned, only the bytes needed for them are read.
     """
     # Prevent accessing anything outside of the working directory
     workdir_abspath = os.path.abspath(working_directory)
@@ -23,29 +44,155 @@ def get_file_content(working_directory: str, file_path: str) -> str:
         return f'Error: File not found or is not a regular file: "{file_path}"'
 
     try:
-        with open(file_abspath, "r", encoding="utf-8") as f:
-            # TODO pass MAX_LENGTH to read() as we don't need to read the whole file
-            content = f.read()
-            if len(content) <= MAX_LENGTH:
-                return content
+        offset = optional_int("offset", offset, minimum=0)
+        start_line = optional_int("start_line", start_line, minimum=1)
+        end_line = optional_int("end_line", end_line, minimum=1)
+        tail_lines = optional_int("tail_lines", tail_lines, minimum=1)
+    except ValueError as exc:
+        return f"Error: {exc}"
+    modes = [offset is not None, start_line is not None or end_line is not None, tail_lines is not None]
+    if sum(modes) > 1:
+        return "Error: specify only one of offset, start_line and end_line, or tail_lines"
+    if start_line is not None and end_line is not None and end_line < start_line:
+        return "Error: end_line must not be smaller than start_line"
+
+    try:
+        with open(file_abspath, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if tail_lines is not None:
+                return _read_tail(f, size, tail_lines, file_path)
+            if start_line is not None or end_line is not None:
+                start, stop = _line_range(f, size, start_line or 1, end_line)
+                if start is None:
+                    return f'Error: "{file_path}" has fewer than {start_line} lines'
             else:
-                return content[:MAX_LENGTH] + f'[...File "{file_path}" truncated at {MAX_LENGTH} characters]'
+                start, stop = offset or 0, size
+            return _read_range(f, start, stop, size, file_path)
     except Exception as exc:
         # Allow the agent to handle unexpected errors instead of crashing
         return f"Error: cannot read file: {exc}"
 
 
+def _read_range(f, start: int, stop: int, size: int, file_path: str) -> str:
+    """Returns the content between two byte positions, truncated at `MAX_LENGTH` characters."""
+    if start >= size:
+        return "" if start == 0 else f'Error: offset {start} is past the end of "{file_path}" ({size} bytes)'
+    f.seek(start)
+    data = f.read(min(stop - start, MAX_BYTES))
+    # The offset may be in the middle of a character
+    skipped = _continuation_bytes(data) if start > 0 else 0
+    content = codecs.getincrementaldecoder("utf-8")().decode(data[skipped:], final=start + len(data) >= stop)
+
+    if len(content) <= MAX_LENGTH:
+        return content
+    content = content[:MAX_LENGTH]
+    next_offset = start + skipped + len(content.encode("utf-8"))
+    return content + (
+        f'[...File "{file_path}" truncated at {MAX_LENGTH} characters,'
+        f" {stop - next_offset} more bytes: continue reading with offset={next_offset}]"
+    )
+
+
+def _line_range(f, size: int, start_line: int, end_line: int | None) -> tuple[int | None, int]:
+    """Returns the byte positions where the start line begins and the end line ends,
+    or None if the file has fewer lines. Lines are found without reading the file in memory."""
+    if size == 0:
+        return (0 if start_line == 1 else None), 0
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        if start_line > 1:
+            newline = _find_newline(mm, 0, start_line - 1)
+            if newline == -1 or newline == size - 1:
+                return None, size
+            start = newline + 1
+        if end_line is None:
+            return start, size
+        newline = _find_newline(mm, start, end_line - start_line + 1)
+        return start, size if newline == -1 else newline + 1
+
+
+def _find_newline(mm: mmap.mmap, start: int, count: int) -> int:
+    """Returns the position of the `count`-th newline from `start`, or -1 if there are fewer."""
+    # Newlines are counted a chunk at a time, much faster than finding them one by one
+    chunk_size = 1 << 20
+    while start < len(mm):
+        chunk = mm[start:start + chunk_size]
+        newlines = chunk.count(b"\n")
+        if newlines < count:
+            count -= newlines
+            start += len(chunk)
+            continue
+        position = -1
+        for _ in range(count):
+            position = chunk.find(b"\n", position + 1)
+        return start + position
+    return -1
+
+
+def _read_tail(f, size: int, lines: int, file_path: str) -> str:
+    """Returns the last lines of the file, keeping the last `MAX_LENGTH` characters if they're longer."""
+    if size == 0:
+        return ""
+    window_start = max(size - MAX_BYTES, 0)
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # A newline at the end of the file doesn't start a new line
+        position = size - 1 if mm[size - 1:size] == b"\n" else size
+        start = window_start
+        for _ in range(lines):
+            newline = mm.rfind(b"\n", window_start, position)
+            if newline == -1:
+                break
+            position = newline
+        else:
+            start = position + 1
+        data = mm[start:size]
+
+    skipped = _continuation_bytes(data) if start > 0 else 0
+    content = data[skipped:].decode("utf-8")
+    if len(content) <= MAX_LENGTH and (start == 0 or start > window_start):
+        return content
+    return f'[...File "{file_path}" truncated, showing its last {min(len(content), MAX_LENGTH)} characters]\n' + content[-MAX_LENGTH:]
+
+
+def _continuation_bytes(data: bytes) -> int:
+    """Returns the number of UTF-8 continuation bytes at the start of the data,
+    i.e. the end of a character that started before it."""
+    count = 0
+    while count < min(len(data), 3) and data[count] & 0xC0 == 0x80:
+        count += 1
+    return count
+
+
 # The `working_directory` is intentionally not listed as we won't allow the AI to specify that argument.
 schema_get_file_content = types.FunctionDeclaration(
     name="get_file_content",
-    description="Get the contents of the specified file as a string. The file is constrained to the working directory.",
+    description=(
+        f"Get the contents of the specified file as a string, up to {MAX_LENGTH} characters. The file is constrained to the working directory."
+        " To read only part of a file, specify either an offset, a range of lines, or a number of lines from the end."
+    ),
     parameters=types.Schema(
         type=types.Type.OBJECT,
         properties={
             "file_path": types.Schema(
                 type=types.Type.STRING,
                 description="The file to read, specified as a path relative to the working directory.",
-            )
+            ),
+            "offset": types.Schema(
+                type=types.Type.INTEGER,
+                description="Position in bytes to start reading from. When content is truncated, the offset to continue reading from is provided.",
+            ),
+            "start_line": types.Schema(
+                type=types.Type.INTEGER,
+                description="First line to read, starting from 1. If not provided with end_line, the first line of the file.",
+            ),
+            "end_line": types.Schema(
+                type=types.Type.INTEGER,
+                description="Last line to read, included. If not provided with start_line, the last line of the file.",
+            ),
+            "tail_lines": types.Schema(
+                type=types.Type.INTEGER,
+                description="Number of lines to read from the end of the file, e.g. for logs.",
+            ),
         }
     )
 )
@@ -1,12 +1,30 @@
 import os
+from collections import deque
 from google.genai import types
 
+from config import MAX_LISTING_ENTRIES
+from functions.arguments import optional_int
+from functions.gitignore import IgnoreRules
 
-def get_files_info(working_directory, directory="") -> str:
+
+def get_files_info(
+    working_directory,
+    directory="",
+    recursive: bool = False,
+    max_depth: int | None = None,
+    max_entries: int | None = None,
+) -> str:
     """Returns a string representation of the contents of a directory.
 
     - working_directory: relative path from cwd to a project directory
     - directory: the relative path within the chosen working directory
+    - recursive: also list the contents of subdirectories, with paths relative to `directory`
+    - max_depth: levels of subdirectories to list, 1 is only `directory` itself. Implies `recursive`
+    - max_entries: stop after this many entries, at most `MAX_LISTING_ENTRIES`
+
+    Directories come first, then files, each sorted by name. Entries ignored by the
+    `.gitignore` files of the working directory are skipped, and ignored directories are
+    not walked. Symlinked directories are listed but not walked.
 
     On failure, returns the error as a string.
     """
@@ -20,33 +38,102 @@ def get_files_info(working_directory, directory="") -> str:
         return f'Error: "{directory}" is not a directory'
 
     try:
-        lines = []
-        for filename in os.listdir(subdir_abspath):
-            if filename == "__pycache__":
+        max_depth = optional_int("max_depth", max_depth, minimum=1)
+        max_entries = optional_int("max_entries", max_entries, minimum=1)
+    except ValueError as exc:
+        return f"Error: {exc}"
+    if max_depth is None:
+        max_depth = None if recursive else 1
+    max_entries = MAX_LISTING_ENTRIES if max_entries is None else min(max_entries, MAX_LISTING_ENTRIES)
+
+    try:
+        rules = IgnoreRules.for_directory(workdir_abspath, subdir_abspath)
+        subdir_relpath = os.path.relpath(subdir_abspath, workdir_abspath).replace(os.sep, "/")
+        subdir_relpath = "" if subdir_relpath == "." else subdir_relpath + "/"
+
+        # Path of each walked directory relative to the listed one -> (is_file, name, line) of its entries
+        listings: dict[str, list[tuple[bool, str, str]]] = {}
+        count = 0
+        truncated = False
+        # Walked breadth first, so that shallow entries are kept when the listing is truncated.
+        # Directory, its path relative to the listed one, its ignore rules, and its depth
+        pending = deque([(subdir_abspath, "", rules, 1)])
+        while pending and not truncated:
+            path, relpath, rules, depth = pending.popleft()
+            try:
+                iterator = os.scandir(path)
+            except OSError:
+                if depth == 1:
+                    raise
+                # An unreadable subdirectory is listed, but without its contents
                 continue
-            filepath = os.path.join(subdir_abspath, filename)
-            size = os.path.getsize(filepath)
-            is_dir = os.path.isdir(filepath)
-            lines.append(f"- {filename}: file_size={size} bytes, is_dir={is_dir}")
+            listing = listings[relpath] = []
+            with iterator:
+                for entry in iterator:
+                    entry_relpath = relpath + entry.name
+                    # Known from the directory itself on most filesystems, without a syscall
+                    is_dir = entry.is_dir()
+                    if rules.ignored(subdir_relpath + entry_relpath, is_dir):
+                        continue
+                    if count == max_entries:
+                        truncated = True
+                        break
+                    count += 1
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        # Broken symlink
+                        size = entry.stat(follow_symlinks=False).st_size
+                    listing.append((not is_dir, entry.name, f"- {entry_relpath}: file_size={size} bytes, is_dir={is_dir}"))
+                    if is_dir and (max_depth is None or depth < max_depth) and not entry.is_symlink():
+                        entry_rules = rules.child(workdir_abspath, subdir_relpath + entry_relpath)
+                        pending.append((entry.path, entry_relpath + "/", entry_rules, depth + 1))
 
+        lines: list[str] = []
+        _append_lines(listings, "", lines)
+        if truncated:
+            lines.append(f"[...Listing truncated at {max_entries} entries: list a subdirectory, or use a smaller max_depth]")
         return "\n".join(lines)
     except Exception as exc:
         # Allow the agent to handle unexpected errors instead of crashing
         return f"Error: cannot list contents: {exc}"
 
 
+def _append_lines(listings: dict[str, list[tuple[bool, str, str]]], relpath: str, lines: list[str]) -> None:
+    """Appends the lines of a directory's entries, each directory followed by its own entries."""
+    for is_file, name, line in sorted(listings.get(relpath, ())):
+        lines.append(line)
+        if not is_file:
+            _append_lines(listings, relpath + name + "/", lines)
+
+
 # The `working_directory` is intentionally not listed as we won't allow the AI to specify that.
 # The working directory will be hardcoded as a security measure.
 schema_get_file_info = types.FunctionDeclaration(
     name="get_files_info",
-    description="Lists files in the specified directory along with their sizes, constrained to the working directory.",
+    description=(
+        "Lists files in the specified directory along with their sizes, constrained to the working directory."
+        f" Files ignored by .gitignore are not listed. At most {MAX_LISTING_ENTRIES} entries are returned."
+    ),
     parameters=types.Schema(
         type=types.Type.OBJECT,
         properties={
             "directory": types.Schema(
                 type=types.Type.STRING,
                 description="The directory to list files from, relative to the working directory. If not provided, lists files in the working directory itself.",
-            )
+            ),
+            "recursive": types.Schema(
+                type=types.Type.BOOLEAN,
+                description="Also list the contents of subdirectories, with paths relative to the listed directory. Prefer this to listing subdirectories one by one.",
+            ),
+            "max_depth": types.Schema(
+                type=types.Type.INTEGER,
+                description="Levels of subdirectories to list recursively, 1 lists only the directory itself.",
+            ),
+            "max_entries": types.Schema(
+                type=types.Type.INTEGER,
+                description="Maximum number of entries to list.",
+            ),
         }
     )
 )
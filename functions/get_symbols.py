@@ -0,0 +1,154 @@
+import ast
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from google.genai import types
+
+from config import MAX_FILE_CONTENT_LENGTH as MAX_LENGTH
+from functions.gitignore import walk_files
+
+
+CACHE_MAX_FILES = 10_000
+
+# Long docstrings are summarized by their first line, cut at this length
+MAX_SUMMARY_LENGTH = 80
+
+# Content hash -> outline lines of the file
+_cache: OrderedDict[bytes, list[str]] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_symbols(working_directory: str, path: str = "") -> str:
+    """Returns an outline of a Python file, or of every Python file in a directory:
+    their classes and functions, with signatures, line ranges and docstring summaries.
+
+    - working_directory: relative path from cwd to a project directory
+    - path: relative path of a file or directory within the chosen working directory
+
+    Outlines are cached by file content. At most `MAX_LENGTH` characters are returned.
+    """
+    # Prevent accessing anything outside of the working directory
+    workdir_abspath = os.path.abspath(working_directory)
+    abspath = os.path.abspath(os.path.join(working_directory, path))
+
+    if not abspath.startswith(workdir_abspath):
+        return f'Error: Cannot read "{path}" as it is outside the permitted working directory'
+    if not os.path.exists(abspath):
+        return f'Error: "{path}" does not exist'
+
+    try:
+        if os.path.isdir(abspath):
+            file_paths = sorted(relpath for relpath, _ in walk_files(workdir_abspath, abspath) if relpath.endswith(".py"))
+            if not file_paths:
+                return f'No Python files in "{path}"'
+        else:
+            file_paths = [os.path.relpath(abspath, workdir_abspath)]
+        outlines = _outlines(workdir_abspath, file_paths)
+    except Exception as exc:
+        # Allow the agent to handle unexpected errors instead of crashing
+        return f"Error: cannot outline symbols: {exc}"
+
+    result = "\n".join(f"{file_path}\n" + "\n".join(lines) if lines else file_path for file_path, lines in zip(file_paths, outlines))
+    if len(result) > MAX_LENGTH:
+        # Cut at the last whole line, or in the middle of a single line longer than the limit
+        cut = result.rfind("\n", 0, MAX_LENGTH)
+        result = result[:cut if cut != -1 else MAX_LENGTH]
+        result += f'\n[...Outline truncated at {MAX_LENGTH} characters: outline a subdirectory or a single file]'
+    return result
+
+
+def outline(source: bytes) -> list[str]:
+    """Returns a line for each class and function defined in the source, indented by nesting."""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError) as exc:
+        return [f"  {type(exc).__name__}: {exc}"]
+    lines: list[str] = []
+    _outline_body(tree.body, 1, lines)
+    return lines
+
+
+def _outline_body(body: list[ast.stmt], depth: int, lines: list[str]) -> None:
+    for node in body:
+        if isinstance(node, ast.ClassDef):
+            bases = [ast.unparse(base) for base in node.bases] + [ast.unparse(keyword) for keyword in node.keywords]
+            header = f"class {node.name}({', '.join(bases)})" if bases else f"class {node.name}"
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            header = f"{'async ' if isinstance(node, ast.AsyncFunctionDef) else ''}def {node.name}({ast.unparse(node.args)})"
+            if node.returns is not None:
+                header += f" -> {ast.unparse(node.returns)}"
+        elif isinstance(node, (ast.If, ast.Try, ast.TryStar, ast.With, ast.AsyncWith)):
+            # e.g. definitions under `if TYPE_CHECKING:` or `try: import ... except ImportError:`
+            _outline_body(node.body, depth, lines)
+            for handler in getattr(node, "handlers", []):
+                _outline_body(handler.body, depth, lines)
+            _outline_body(getattr(node, "orelse", []), depth, lines)
+            _outline_body(getattr(node, "finalbody", []), depth, lines)
+            continue
+        else:
+            continue
+
+        decorators = "".join(f"@{ast.unparse(decorator)} " for decorator in node.decorator_list)
+        start = node.decorator_list[0].lineno if node.decorator_list else node.lineno
+        line = f"{'  ' * depth}{decorators}{header}: lines {start}-{node.end_lineno}"
+        docstring = ast.get_docstring(node)
+        if docstring:
+            summary = docstring.strip().splitlines()[0]
+            if len(summary) > MAX_SUMMARY_LENGTH:
+                summary = summary[:MAX_SUMMARY_LENGTH] + "..."
+            line += f"  # {summary}"
+        lines.append(line)
+        # Functions nested in functions are implementation details
+        if isinstance(node, ast.ClassDef):
+            _outline_body(node.body, depth + 1, lines)
+
+
+def _outlines(workdir_abspath: str, file_paths: list[str]) -> list[list[str]]:
+    """Returns the outline of each file, from the cache when its content didn't change."""
+    outlines: list[list[str] | None] = []
+    # Content hash and source of the files not in the cache, by position
+    missing: dict[int, tuple[bytes, bytes]] = {}
+    for i, file_path in enumerate(file_paths):
+        with open(os.path.join(workdir_abspath, file_path), "rb") as f:
+            source = f.read()
+        digest = hashlib.blake2b(source, digest_size=16).digest()
+        with _cache_lock:
+            cached = _cache.get(digest)
+            if cached is not None:
+                _cache.move_to_end(digest)
+        outlines.append(cached)
+        if cached is None:
+            missing[i] = (digest, source)
+
+    # Parsing in a process pool was not faster: sending sources and outlines between
+    # processes costs about as much as parsing them
+    computed = [outline(source) for _, source in missing.values()]
+
+    with _cache_lock:
+        for (i, (digest, _)), lines in zip(missing.items(), computed):
+            outlines[i] = lines
+            _cache[digest] = lines
+        while len(_cache) > CACHE_MAX_FILES:
+            _cache.popitem(last=False)
+    return outlines # type: ignore
+
+
+# The `working_directory` is intentionally not listed as we won't allow the AI to specify that argument.
+schema_get_symbols = types.FunctionDeclaration(
+    name="get_symbols",
+    description=(
+        "Get an outline of a Python file, or of all the Python files in a directory: classes, functions and methods,"
+        " with their signatures, line ranges and the first line of their docstrings."
+        " Use it to understand the structure of the code, then read only the relevant lines with get_file_content."
+    ),
+    parameters=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "path": types.Schema(
+                type=types.Type.STRING,
+                description="The file or directory to outline, relative to the working directory. If not provided, outlines the whole working directory.",
+            ),
+        }
+    )
+)
@@ -0,0 +1,184 @@
+"""Matching of paths against `.gitignore` files, used to skip ignored files
+in directory listings, code search and symbol outlines.
+
+Supports what projects commonly put in their `.gitignore`: comments, negated patterns (`!`),
+directory-only patterns (trailing `/`), patterns anchored to the `.gitignore` location
+(containing a `/`), and the `*`, `?`, `[...]` and `**` wildcards.
+As with git, files inside an ignored directory are ignored too, whatever the rules say
+about them: the directory is never walked.
+
+Paths are relative to the working directory, with `/` separators.
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Iterator
+
+
+ALWAYS_IGNORED = ("__pycache__/", ".git/")
+"""Ignored even without a `.gitignore` file."""
+
+
+@dataclass(frozen=True)
+class _Rule:
+    # Directory of the `.gitignore` file the rule comes from, "" for the working directory
+    base: str
+    regex: re.Pattern
+    negated: bool
+    directory_only: bool
+
+
+class IgnoreRules:
+    """The rules that apply inside a directory: its own, and those inherited from its parents.
+
+    Immutable, a subdirectory gets new rules from `child()` while the parent's
+    stay valid for its other subdirectories.
+    """
+
+    def __init__(self, rules: tuple[_Rule, ...] = ()) -> None:
+        self._rules = rules
+
+    @classmethod
+    def for_directory(cls, working_directory: str, directory: str) -> "IgnoreRules":
+        """Returns the rules that apply inside a directory of the working directory,
+        reading the `.gitignore` files from the working directory down to it."""
+        rules = cls().extend(ALWAYS_IGNORED, "")
+        rules = rules.child(working_directory, "")
+        relative_path = ""
+        for name in _relative(working_directory, directory).split("/"):
+            if not name:
+                continue
+            relative_path = f"{relative_path}/{name}" if relative_path else name
+            rules = rules.child(working_directory, relative_path)
+        return rules
+
+    def child(self, working_directory: str, relative_path: str) -> "IgnoreRules":
+        """Returns these rules, plus those of the `.gitignore` file in the given directory if any."""
+        try:
+            with open(os.path.join(working_directory, relative_path, ".gitignore"), encoding="utf-8", errors="replace") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return self
+        return self.extend(lines, relative_path)
+
+    def extend(self, lines, base: str) -> "IgnoreRules":
+        """Returns these rules, plus the given `.gitignore` lines of the `base` directory."""
+        rules = [rule for line in lines if (rule := _parse(line, base)) is not None]
+        return IgnoreRules(self._rules + tuple(rules)) if rules else self
+
+    def ignored(self, relative_path: str, is_dir: bool) -> bool:
+        # The last matching rule wins, as in git
+        for rule in reversed(self._rules):
+            if rule.directory_only and not is_dir:
+                continue
+            if rule.base:
+                if not relative_path.startswith(rule.base + "/"):
+                    continue
+                path = relative_path[len(rule.base) + 1:]
+            else:
+                path = relative_path
+            if rule.regex.fullmatch(path):
+                return not rule.negated
+        return False
+
+
+def walk_files(working_directory: str, directory: str = "") -> Iterator[tuple[str, os.stat_result]]:
+    """Yields the path relative to the working directory, with `/` separators, and the stats
+    of every regular file in the directory and its subdirectories that is not ignored.
+    Symlinks are not followed."""
+    root = os.path.abspath(working_directory)
+    start = os.path.abspath(os.path.join(root, directory))
+    relpath = _relative(root, start)
+    pending = [(relpath + "/" if relpath else "", IgnoreRules.for_directory(root, start))]
+    while pending:
+        relpath, rules = pending.pop()
+        try:
+            iterator = os.scandir(os.path.join(root, relpath))
+        except OSError:
+            continue
+        with iterator:
+            for entry in iterator:
+                entry_relpath = relpath + entry.name
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if rules.ignored(entry_relpath, is_dir):
+                        continue
+                    if is_dir:
+                        pending.append((entry_relpath + "/", rules.child(root, entry_relpath)))
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry_relpath, entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+
+def _relative(working_directory: str, directory: str) -> str:
+    relative_path = os.path.relpath(directory, working_directory).replace(os.sep, "/")
+    return "" if relative_path == "." else relative_path
+
+
+def _parse(line: str, base: str) -> _Rule | None:
+    """Returns the rule of a `.gitignore` line, or None for blank lines and comments."""
+    # Trailing spaces are ignored unless escaped
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    line = stripped
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    elif line.startswith("\\"):
+        # Escaped leading "#" or "!"
+        line = line[1:]
+    directory_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    # A pattern with a slash (other than at its end) is relative to the `.gitignore` directory,
+    # otherwise it matches a name at any depth
+    anchored = "/" in line
+    line = line.lstrip("/")
+    pattern = _translate(line)
+    if not anchored:
+        pattern = "(?:.*/)?" + pattern
+    return _Rule(base, re.compile(pattern, re.DOTALL), negated, directory_only)
+
+
+def _translate(pattern: str) -> str:
+    """Translates a glob pattern to a regular expression, where wildcards don't match `/` but `**` does."""
+    result = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            # Zero or more directories
+            result.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i) and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == "/"):
+            result.append(".*")
+            i += 2
+        elif char == "*":
+            result.append("[^/]*")
+            i += 1
+        elif char == "?":
+            result.append("[^/]")
+            i += 1
+        elif char == "[":
+            end = pattern.find("]", i + 2)
+            if end == -1:
+                result.append(re.escape(char))
+                i += 1
+                continue
+            content = pattern[i + 1:end]
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            result.append("[" + content.replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif char == "\\" and i + 1 < len(pattern):
+            result.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            result.append(re.escape(char))
+            i += 1
+    return "".join(result)
@@ -0,0 +1,118 @@
+"""Bounded capture of the output of scripts executed by `run_python_file`.
+
+Pipes are read incrementally while the script runs. Only the first and last bytes of each
+stream are kept, so a chatty script neither fills the memory nor blows the token budget,
+and a script writing more than the allowed total is killed without waiting for it to complete.
+"""
+import asyncio
+import codecs
+import os
+import selectors
+import time
+from typing import Callable
+
+from config import MAX_OUTPUT_HEAD_BYTES, MAX_OUTPUT_TAIL_BYTES, MAX_OUTPUT_BYTES
+
+
+READ_SIZE = 65536
+
+
+class BoundedOutput:
+    """Output of a stream: all of it up to `head_bytes + tail_bytes`, otherwise only
+    the first `head_bytes` and the last `tail_bytes`."""
+
+    def __init__(self, head_bytes: int | None = None, tail_bytes: int | None = None) -> None:
+        self.total = 0
+        self._head_bytes = MAX_OUTPUT_HEAD_BYTES if head_bytes is None else head_bytes
+        self._tail_bytes = MAX_OUTPUT_TAIL_BYTES if tail_bytes is None else tail_bytes
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.total += len(data)
+        room = self._head_bytes - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        if data:
+            self._tail += data[-self._tail_bytes:] if self._tail_bytes else b""
+            if len(self._tail) > self._tail_bytes:
+                del self._tail[:len(self._tail) - self._tail_bytes]
+
+    def __bool__(self) -> bool:
+        return self.total > 0
+
+    def text(self) -> str:
+        """Returns the output decoded as UTF-8, with a marker where bytes were omitted."""
+        omitted = self.total - len(self._head) - len(self._tail)
+        if omitted == 0:
+            return (self._head + self._tail).decode("utf-8", errors="replace")
+
+        # Don't show characters cut in half at the edges of the omitted bytes as invalid
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        head = decoder.decode(bytes(self._head), final=False)
+        start = 0
+        while start < min(len(self._tail), 3) and self._tail[start] & 0xC0 == 0x80:
+            start += 1
+        tail = self._tail[start:].decode("utf-8", errors="replace")
+        omitted += len(decoder.getstate()[0]) + start
+        return f"{head}\n[... {omitted} bytes omitted ...]\n{tail}"
+
+
+def read_output(
+    stdout_fd: int,
+    stderr_fd: int,
+    deadline: float,
+    kill: Callable[[], None],
+    max_bytes: int | None = None,
+) -> tuple[BoundedOutput, BoundedOutput, bool]:
+    """Reads both pipes until they're closed. If more than `max_bytes` (by default `MAX_OUTPUT_BYTES`)
+    are written in total, calls `kill` and reads what's left.
+
+    Returns the output of each pipe, and whether the limit was exceeded.
+    Raises `TimeoutError` if reading takes past the `deadline` (a `time.monotonic()` value).
+    """
+    max_bytes = MAX_OUTPUT_BYTES if max_bytes is None else max_bytes
+    outputs = {stdout_fd: BoundedOutput(), stderr_fd: BoundedOutput()}
+    exceeded = False
+    with selectors.DefaultSelector() as selector:
+        for fd in outputs:
+            selector.register(fd, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError()
+            for key, _ in selector.select(remaining):
+                data = os.read(key.fd, READ_SIZE)
+                if not data:
+                    selector.unregister(key.fd)
+                    continue
+                outputs[key.fd].write(data)
+                if not exceeded and sum(captured.total for captured in outputs.values()) > max_bytes:
+                    exceeded = True
+                    kill()
+    return outputs[stdout_fd], outputs[stderr_fd], exceeded
+
+
+async def read_output_async(
+    stdout: asyncio.StreamReader,
+    stderr: asyncio.StreamReader,
+    kill: Callable[[], None],
+    max_bytes: int | None = None,
+) -> tuple[BoundedOutput, BoundedOutput, bool]:
+    """Same as `read_output`, for the streams of an asyncio subprocess.
+    The caller is responsible for the timeout."""
+    max_bytes = MAX_OUTPUT_BYTES if max_bytes is None else max_bytes
+    outputs = (BoundedOutput(), BoundedOutput())
+    exceeded = False
+
+    async def read(stream: asyncio.StreamReader, output: BoundedOutput) -> None:
+        nonlocal exceeded
+        while data := await stream.read(READ_SIZE):
+            output.write(data)
+            if not exceeded and sum(captured.total for captured in outputs) > max_bytes:
+                exceeded = True
+                kill()
+
+    await asyncio.gather(read(stdout, outputs[0]), read(stderr, outputs[1]))
+    return outputs[0], outputs[1], exceeded
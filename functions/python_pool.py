@@ -0,0 +1,237 @@
+"""Pool of warm Python interpreters, used by `run_python_file` when enabled in the config.
+
+Starting a new interpreter for every script means paying every time for interpreter
+startup and for importing the modules the project uses (e.g. `unittest` for a test suite).
+Each worker of the pool is a zygote process (see `zygote.py`) that imports those modules
+once, then forks a child for every script it runs: the child starts from the warm
+interpreter, and exits when the script completes, so runs are isolated from each other.
+
+The script output is read from pipes created here, as for a new process.
+A worker that can't be used raises `WorkerError`, so that the caller can fall back
+to running the script in a new process. A worker failing once the script may have
+started raises `WorkerLostError` instead: running the script again would repeat its side effects.
+"""
+import atexit
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+from functions.process_output import BoundedOutput, read_output
+
+ZYGOTE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zygote.py")
+
+STARTUP_TIMEOUT_SECONDS = 30
+"""Time allowed to a zygote to import the project modules."""
+
+EXIT_TIMEOUT_SECONDS = 5
+"""Time allowed to a killed script to be reaped by its zygote."""
+
+
+class WorkerError(Exception):
+    """The worker could not run the script, it should be run in a new process instead."""
+
+
+class WorkerLostError(Exception):
+    """The worker failed after receiving the script, which may have run (partly or completely):
+    it must not be run again."""
+
+
+class _Zygote:
+    """A zygote process, and the socket used to send it requests."""
+
+    def __init__(self, working_directory: str) -> None:
+        parent_socket, child_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._process = subprocess.Popen(
+                ["python3", ZYGOTE_PATH, working_directory, str(child_socket.fileno())],
+                pass_fds=[child_socket.fileno()],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                # Not interrupted together with the agent, it exits when the socket is closed
+                start_new_session=True,
+            )
+        except OSError as exc:
+            parent_socket.close()
+            raise WorkerError(f"Cannot start worker: {exc}") from exc
+        finally:
+            child_socket.close()
+        self._socket = parent_socket
+        self._receive(STARTUP_TIMEOUT_SECONDS)
+
+    def run(self, script: str, args: list[str], timeout: float) -> tuple[BoundedOutput, BoundedOutput, int, bool, bool]:
+        """Runs the script in a child of the zygote, returns its stdout, stderr, exit code,
+        whether it was killed for exceeding the output limit, and whether the zygote is stale
+        and should be replaced.
+
+        Raises `TimeoutError` if the script doesn't complete in time, after killing it,
+        `WorkerError` if the script was not sent to the zygote, or `WorkerLostError`
+        if the zygote failed after receiving it.
+        """
+        request = json.dumps({"script": script, "args": args}).encode("utf-8")
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        try:
+            try:
+                socket.send_fds(self._socket, [request], [stdout_write, stderr_write])
+            except OSError as exc:
+                self.close()
+                raise WorkerError(f"Cannot send request to worker: {exc}") from exc
+            finally:
+                # The child has its own copies, reading stops when it closes them
+                os.close(stdout_write)
+                os.close(stderr_write)
+            # The zygote forks the child before replying: from here on the script may be running
+            try:
+                started = self._receive(STARTUP_TIMEOUT_SECONDS)
+            except WorkerError as exc:
+                raise WorkerLostError(f"Worker failed while starting the script: {exc}") from exc
+
+            deadline = time.monotonic() + timeout
+            try:
+                stdout, stderr, exceeded = read_output(stdout_read, stderr_read, deadline, lambda: _kill(started["pid"]))
+                exit_code = self._receive(deadline - time.monotonic(), on_timeout=TimeoutError)["exit_code"]
+            except TimeoutError:
+                _kill(started["pid"])
+                try:
+                    self._receive(EXIT_TIMEOUT_SECONDS)
+                except WorkerError:
+                    # Closed, it will be replaced
+                    pass
+                raise
+            except WorkerError as exc:
+                raise WorkerLostError(f"Worker failed while running the script: {exc}") from exc
+        finally:
+            os.close(stdout_read)
+            os.close(stderr_read)
+        return stdout, stderr, exit_code, exceeded, started["stale"]
+
+    def close(self) -> None:
+        # The zygote exits as soon as it sees the socket closed
+        self._socket.close()
+        try:
+            self._process.wait(EXIT_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+    def alive(self) -> bool:
+        return self._socket.fileno() != -1 and self._process.poll() is None
+
+    def _receive(self, timeout: float, on_timeout: type[Exception] = WorkerError) -> dict:
+        # With no time left the socket is non-blocking: only a reply already received is read
+        self._socket.settimeout(max(timeout, 0))
+        try:
+            data = self._socket.recv(65536)
+        except (TimeoutError, BlockingIOError) as exc:
+            if on_timeout is TimeoutError:
+                raise TimeoutError("Worker did not reply in time") from exc
+            self.close()
+            raise WorkerError("Worker did not reply in time") from exc
+        except OSError as exc:
+            self.close()
+            raise WorkerError(f"Cannot receive reply from worker: {exc}") from exc
+        if not data:
+            self.close()
+            raise WorkerError(f"Worker exited with code {self._process.poll()}")
+        return json.loads(data)
+
+
+class PythonWorkerPool:
+    """A fixed number of zygotes for the scripts of a working directory.
+
+    Zygotes are started in the background when the pool is created, and replaced in the
+    background when they become stale, so that the scripts rarely wait for one to start.
+    """
+
+    def __init__(self, working_directory: str, size: int) -> None:
+        self._working_directory = os.path.abspath(working_directory)
+        # One item for each zygote: either the zygote, or None if it must be started on use
+        self._idle: queue.Queue[_Zygote | None] = queue.Queue()
+        self._closed = False
+        for _ in range(size):
+            self._replace()
+
+    def run(self, script: str, args: list[str], timeout: float) -> tuple[BoundedOutput, BoundedOutput, int, bool]:
+        """Runs the script with the given arguments, returns its stdout, stderr, exit code,
+        and whether it was killed for exceeding the output limit.
+
+        Raises `TimeoutError` if the script doesn't complete in time, `WorkerError` if it
+        could not be run in a worker, or `WorkerLostError` if the worker failed while running it.
+        """
+        args = [os.fsdecode(os.fsencode(arg)) for arg in args]
+        zygote = self._idle.get()
+        try:
+            if zygote is None or not zygote.alive():
+                zygote = _Zygote(self._working_directory)
+            stdout, stderr, exit_code, exceeded, stale = zygote.run(script, args, timeout)
+        except TimeoutError:
+            # Killed, the zygote itself is fine
+            self._idle.put(zygote)
+            raise
+        except BaseException:
+            self._idle.put(None)
+            raise
+        if stale:
+            zygote.close()
+            self._replace()
+        else:
+            self._idle.put(zygote)
+        return stdout, stderr, exit_code, exceeded
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                zygote = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            if zygote is not None:
+                zygote.close()
+
+    def _replace(self) -> None:
+        """Starts a new zygote in the background, adding it to the idle ones when ready."""
+        def start() -> None:
+            try:
+                zygote = None if self._closed else _Zygote(self._working_directory)
+            except WorkerError:
+                zygote = None
+            self._idle.put(zygote)
+
+        threading.Thread(target=start, name="python_pool_start", daemon=True).start()
+
+
+def _kill(pid: int) -> None:
+    try:
+        # The child leads its own process group, which includes any process it started
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Not yet in its own group, or already exited
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+_pools: dict[str, PythonWorkerPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(working_directory: str, size: int) -> PythonWorkerPool:
+    """Returns the pool for the working directory, creating it on first use."""
+    working_directory = os.path.abspath(working_directory)
+    with _pools_lock:
+        if working_directory not in _pools:
+            _pools[working_directory] = PythonWorkerPool(working_directory, size)
+        return _pools[working_directory]
+
+
+@atexit.register
+def _close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
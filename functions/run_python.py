@@ -1,8 +1,12 @@
+import asyncio
 import os
 import subprocess
+import time
 from google.genai import types
 
-from config import SUBCOMMAND_TIMEOUT_SECONDS
+from config import SUBCOMMAND_TIMEOUT_SECONDS, PYTHON_POOL_ENABLED, PYTHON_POOL_SIZE
+from functions import process_output, python_pool
+from functions.process_output import BoundedOutput, read_output, read_output_async
 
 
 def run_python_file(
@@ -17,6 +21,94 @@ def run_python_file(
     but nothing stops the executed script from accessing the rest of the filesystem.
     You've been warned.
     """
+    command_parts = _command_parts(working_directory, file_path, args)
+    if isinstance(command_parts, str):
+        return command_parts
+
+    if PYTHON_POOL_ENABLED:
+        pool = python_pool.get_pool(working_directory, PYTHON_POOL_SIZE)
+        try:
+            stdout, stderr, returncode, exceeded = pool.run(command_parts[1], command_parts[2:], SUBCOMMAND_TIMEOUT_SECONDS)
+        except python_pool.WorkerError:
+            # Not started, run it in a new process instead
+            pass
+        except python_pool.WorkerLostError as exc:
+            return f"Error: executing Python file: {exc}. The script may have run, check its effects before running it again"
+        except TimeoutError:
+            return _timeout_error()
+        except Exception as exc:
+            return f"Error: executing Python file: {exc}"
+        else:
+            return _format_output(stdout, stderr, returncode, exceeded)
+
+    try:
+        process = subprocess.Popen(
+            command_parts,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except Exception as exc:
+        return f"Error: executing Python file: {exc}"
+
+    with process:
+        deadline = time.monotonic() + SUBCOMMAND_TIMEOUT_SECONDS
+        try:
+            stdout, stderr, exceeded = read_output(process.stdout.fileno(), process.stderr.fileno(), deadline, process.kill)
+            # The script may close its output before exiting
+            process.wait(max(deadline - time.monotonic(), 0))
+        except (TimeoutError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+            return _timeout_error()
+
+    return _format_output(stdout, stderr, process.returncode, exceeded)
+
+
+async def run_python_file_async(
+    working_directory: str,
+    file_path: str,
+    args: list | None = None
+) -> str:
+    """Same as `run_python_file`, but the script runs as an asyncio subprocess
+    so the event loop is not blocked while waiting for it to finish."""
+    if PYTHON_POOL_ENABLED:
+        # Workers are waited for from a thread, as for the other functions
+        return await asyncio.to_thread(run_python_file, working_directory, file_path, args)
+
+    command_parts = _command_parts(working_directory, file_path, args)
+    if isinstance(command_parts, str):
+        return command_parts
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command_parts,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except Exception as exc:
+        return f"Error: executing Python file: {exc}"
+
+    async def communicate():
+        output = await read_output_async(process.stdout, process.stderr, process.kill)
+        await process.wait()
+        return output
+
+    try:
+        stdout, stderr, exceeded = await asyncio.wait_for(communicate(), SUBCOMMAND_TIMEOUT_SECONDS)
+    except TimeoutError:
+        process.kill()
+        await process.wait()
+        return _timeout_error()
+
+    return _format_output(stdout, stderr, process.returncode, exceeded)
+
+
+def _command_parts(
+    working_directory: str,
+    file_path: str,
+    args: list | None,
+) -> list[str] | str:
+    """Returns the command that executes the script, or an error as a string."""
     # Prevent accessing anything outside of the working directory
     workdir_abspath = os.path.abspath(working_directory)
     file_abspath = os.path.abspath(os.path.join(working_directory, file_path))
@@ -29,29 +121,29 @@ def run_python_file(
         return f'Error: "{file_path}" is not a Python file.'
 
     script_arguments = [] if args is None else args
-    command_parts = ["python3", file_abspath] + script_arguments
-    try:
-        completed_process = subprocess.run(
-            command_parts,
-            capture_output=True,
-            timeout=SUBCOMMAND_TIMEOUT_SECONDS,
-        )
-    except Exception as exc:
-        return f"Error: executing Python file: {exc}"
+    return ["python3", file_abspath] + script_arguments
+
 
+def _format_output(stdout: BoundedOutput, stderr: BoundedOutput, returncode: int | None, exceeded: bool = False) -> str:
     lines: list[str] = []
-    if completed_process.stdout:
-        lines.append("STDOUT: " + str(completed_process.stdout))
-    if completed_process.stderr:
-        lines.append("STDERR: " + str(completed_process.stderr))
-    if completed_process.returncode != 0:
-        lines.append(f"Process exited with code {completed_process.returncode}")
+    if stdout:
+        lines.append("STDOUT: " + stdout.text())
+    if stderr:
+        lines.append("STDERR: " + stderr.text())
+    if exceeded:
+        lines.append(f"Process was killed after writing more than {process_output.MAX_OUTPUT_BYTES} bytes of output")
+    elif returncode != 0:
+        lines.append(f"Process exited with code {returncode}")
     if len(lines) == 0:
         lines.append("No output produced.")
 
     return "\n".join(lines)
 
 
+def _timeout_error() -> str:
+    return f"Error: executing Python file: timed out after {SUBCOMMAND_TIMEOUT_SECONDS} seconds"
+
+
 # The `working_directory` is intentionally not listed as we won't allow the AI to specify that argument.
 schema_run_python_file = types.FunctionDeclaration(
     name="run_python_file",
@@ -0,0 +1,128 @@
+import os
+import re
+from google.genai import types
+
+from config import SEARCH_MAX_RESULTS
+from functions import code_index
+from functions.arguments import optional_int
+
+
+# Long lines (e.g. minified files) are cut, the agent can read them with get_file_content
+MAX_LINE_LENGTH = 200
+
+
+def search_code(
+    working_directory: str,
+    pattern: str,
+    is_regex: bool = False,
+    whole_word: bool = False,
+    ignore_case: bool = False,
+    directory: str = "",
+    max_results: int | None = None,
+) -> str:
+    """Returns the lines of the files in the working directory that match a pattern,
+    as `path:line number: line`, sorted by path. When there are more than `max_results`,
+    which ones are returned depends on the order the files were indexed.
+
+    - working_directory: relative path from cwd to a project directory
+    - pattern: the text to search for
+    - is_regex: the pattern is a Python regular expression, instead of a literal text
+    - whole_word: only match the pattern as a whole identifier, e.g. `add` doesn't match `add_item`
+    - ignore_case: match both lower and upper case
+    - directory: only search in this directory, relative to the working directory
+    - max_results: stop after this many matching lines, at most `SEARCH_MAX_RESULTS`
+
+    Files are found through the index in `code_index`, so that only files containing the
+    pattern (or the literal parts of a regular expression) are read.
+    """
+    # Prevent accessing anything outside of the working directory
+    workdir_abspath = os.path.abspath(working_directory)
+    subdir_abspath = os.path.abspath(os.path.join(working_directory, directory))
+
+    if not subdir_abspath.startswith(workdir_abspath):
+        return f'Error: Cannot search "{directory}" as it is outside the permitted working directory'
+    if not os.path.isdir(subdir_abspath):
+        return f'Error: "{directory}" is not a directory'
+    if not pattern:
+        return "Error: the pattern must not be empty"
+
+    try:
+        max_results = optional_int("max_results", max_results, minimum=1)
+    except ValueError as exc:
+        return f"Error: {exc}"
+    max_results = SEARCH_MAX_RESULTS if max_results is None else min(max_results, SEARCH_MAX_RESULTS)
+
+    regex_source = pattern if is_regex else re.escape(pattern)
+    if whole_word:
+        regex_source = rf"(?<![\w])(?:{regex_source})(?![\w])"
+    try:
+        regex = re.compile(regex_source, re.IGNORECASE if ignore_case else 0)
+    except re.error as exc:
+        return f"Error: invalid regular expression: {exc}"
+    literals = code_index.required_literals(pattern) if is_regex else [pattern]
+
+    try:
+        index = code_index.get_index(workdir_abspath)
+        matches = []
+        truncated = False
+        relative_directory = os.path.relpath(subdir_abspath, workdir_abspath)
+        for match in index.search(regex, literals or [], "" if relative_directory == "." else relative_directory):
+            if len(matches) == max_results:
+                truncated = True
+                break
+            matches.append(match)
+    except Exception as exc:
+        # Allow the agent to handle unexpected errors instead of crashing
+        return f"Error: cannot search files: {exc}"
+
+    lines = []
+    for path, number, line in sorted(matches):
+        if len(line) > MAX_LINE_LENGTH:
+            line = line[:MAX_LINE_LENGTH] + "[...]"
+        lines.append(f"{path}:{number}: {line}")
+    if not lines:
+        return f'No matches for "{pattern}"'
+    if truncated:
+        lines.append(f"[...Showing the first {max_results} matching lines: search in a directory, or use a more specific pattern]")
+    return "\n".join(lines)
+
+
+# The `working_directory` is intentionally not listed as we won't allow the AI to specify that argument.
+schema_search_code = types.FunctionDeclaration(
+    name="search_code",
+    description=(
+        "Search the files in the working directory for a text or a regular expression, e.g. to find where a function is defined or used."
+        f" Returns up to {SEARCH_MAX_RESULTS} matching lines, as path:line number: line."
+        " Much faster than reading files one by one. Files ignored by .gitignore are not searched."
+    ),
+    parameters=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "pattern": types.Schema(
+                type=types.Type.STRING,
+                description="The text to search for, or a Python regular expression if is_regex is true.",
+            ),
+            "is_regex": types.Schema(
+                type=types.Type.BOOLEAN,
+                description="Whether the pattern is a regular expression. Defaults to false, the pattern is searched as it is.",
+            ),
+            "whole_word": types.Schema(
+                type=types.Type.BOOLEAN,
+                description="Only match whole identifiers, e.g. searching \"add\" doesn't match \"add_item\". Defaults to false.",
+            ),
+            "ignore_case": types.Schema(
+                type=types.Type.BOOLEAN,
+                description="Match both lower and upper case. Defaults to false.",
+            ),
+            "directory": types.Schema(
+                type=types.Type.STRING,
+                description="Only search in this directory, relative to the working directory. If not provided, searches the whole working directory.",
+            ),
+            "max_results": types.Schema(
+                type=types.Type.INTEGER,
+                description="Maximum number of matching lines to return.",
+            ),
+        },
+        required=["pattern"],
+    )
+)
@@ -1,4 +1,6 @@
 import os
+import secrets
+import stat
 from google.genai import types
 
 
@@ -25,13 +27,50 @@ def write_file(
         return f'Error: "{file_path}" exists but it\'s not a regular file'
 
     try:
-        with open(file_abspath, "w", encoding="utf-8") as f:
-            f.write(content)
+        write_atomically(file_abspath, content)
         return f'Successfully wrote to "{file_path}" ({len(content)} characters written)'
     except Exception as exc:
         return f'Error: cannot write to file "{file_path}": {exc}'
 
 
+def write_atomically(file_abspath: str, content: str) -> None:
+    """Writes the content to a temporary file in the same directory, then renames it over the file.
+    Anyone reading the file, even after a crash, sees either the old content or the new one, never a partial write.
+
+    Permissions of an existing file are kept. A symlink is not replaced, its target is written instead.
+    """
+    file_abspath = os.path.realpath(file_abspath)
+    directory, name = os.path.split(file_abspath)
+    try:
+        mode = stat.S_IMODE(os.stat(file_abspath).st_mode)
+    except FileNotFoundError:
+        mode = None
+
+    while True:
+        temp_path = os.path.join(directory, f".{name}.{secrets.token_hex(4)}.tmp")
+        try:
+            # Created with the default permissions of a new file, i.e. the umask applies
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            # On disk before the rename, so that a crash can't leave an empty or partial file
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, file_abspath)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
 # The `working_directory` is intentionally not listed as we won't allow the AI to specify that argument.
 schema_write_file = types.FunctionDeclaration(
     name="write_file",
@@ -0,0 +1,212 @@
+"""Fork server for the warm Python worker pool, see `python_pool.py`.
+
+Started as `python3 zygote.py <working directory> <socket fd>`. It imports the modules
+used by the project in the working directory, then for each request received on the
+socket forks a child that runs the requested script, as `python3 <script> <args>` would.
+Each run gets a fresh copy of the warmed up interpreter, so no state is shared between runs.
+
+Only standard library and installed modules are imported in advance, never the project's
+own: those would run project code in the zygote, once per worker, outside of any script run.
+Installed packages may still run code when imported (e.g. register plugins, read the
+environment), that's a limitation of forking from a warm interpreter.
+
+The child runs with resource limits (CPU time, memory, file size and number of processes)
+and with only a few environment variables, see `CHILD_ENVIRONMENT`.
+
+If any of the imported project modules (e.g. imported by an installed package) changed since
+they were imported, they're all removed from the child's modules, so that the script imports
+them again from disk, and the zygote reports that it's stale and should be replaced.
+
+Protocol, one JSON message per packet on a SOCK_SEQPACKET socket:
+- the zygote sends {"ready": true} once modules are imported
+- the pool sends {"script": "/abs/path.py", "args": [...]} with the stdout and stderr fds
+- the zygote replies {"pid": 123, "stale": false} after forking,
+  then {"exit_code": 0} when the child exits
+"""
+import ast
+import atexit
+import importlib.util
+import json
+import os
+import resource
+import runpy
+import socket
+import sys
+import traceback
+
+CHILD_LIMITS = {
+    resource.RLIMIT_CPU: 60,
+    resource.RLIMIT_AS: 2 * 1024 ** 3,
+    resource.RLIMIT_FSIZE: 100 * 1024 ** 2,
+    resource.RLIMIT_NPROC: 1024,
+}
+"""Resource limits of the scripts, only ever lowered: CPU seconds (the timeout of the pool
+usually stops scripts earlier), bytes of address space, bytes written to a single file,
+and processes of the user."""
+
+CHILD_ENVIRONMENT = ("PATH", "HOME", "TMPDIR", "LANG", "LC_ALL", "LC_CTYPE", "TZ")
+"""Environment variables kept for the scripts, all the others (e.g. API keys) are removed."""
+
+
+def main() -> None:
+    working_directory = os.path.abspath(sys.argv[1])
+    sock = socket.socket(fileno=int(sys.argv[2]))
+
+    sys.path[0] = working_directory
+    project_modules = _preimport(working_directory)
+    project_files = {
+        sys.modules[name].__file__: _file_signature(sys.modules[name].__file__)
+        for name in project_modules
+        if getattr(sys.modules[name], "__file__", None)
+    }
+    sock.send(json.dumps({"ready": True}).encode("utf-8"))
+
+    while True:
+        try:
+            data, fds, _, _ = socket.recv_fds(sock, 65536, 2)
+        except OSError:
+            return
+        if not data:
+            # The pool was closed
+            return
+        request = json.loads(data)
+        stale = any(_file_signature(path) != signature for path, signature in project_files.items())
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            if stale or os.path.dirname(request["script"]) != working_directory:
+                # Project modules would be outdated, or imported from a different directory
+                for name in project_modules:
+                    sys.modules.pop(name, None)
+            _run_child(request["script"], request["args"], fds)
+        for fd in fds:
+            os.close(fd)
+        sock.send(json.dumps({"pid": pid, "stale": stale}).encode("utf-8"))
+        _, status = os.waitpid(pid, 0)
+        sock.send(json.dumps({"exit_code": os.waitstatus_to_exitcode(status)}).encode("utf-8"))
+
+
+def _preimport(working_directory: str) -> set[str]:
+    """Imports the modules imported by the Python files in the working directory,
+    except the project's own. Returns the names of the imported modules that belong to the project."""
+    names = set()
+    for directory, subdirectories, files in os.walk(working_directory):
+        subdirectories[:] = [name for name in subdirectories if not name.startswith((".", "__"))]
+        for file in files:
+            if not file.endswith(".py"):
+                continue
+            try:
+                with open(os.path.join(directory, file), "rb") as source:
+                    tree = ast.parse(source.read())
+            except (OSError, SyntaxError, ValueError):
+                continue
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    names.update(alias.name for alias in node.names)
+                elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                    names.add(node.module)
+
+    working_directory = os.path.join(working_directory, "")
+    for name in sorted(names):
+        try:
+            # Only finds the top level package, without importing anything
+            spec = importlib.util.find_spec(name.partition(".")[0])
+            if spec is None or _in_directory(spec, working_directory):
+                continue
+            __import__(name)
+        except BaseException:
+            # Not importable from the working directory, the script will find out by itself
+            pass
+
+    project_modules = set()
+    for name, module in sys.modules.items():
+        # Namespace packages have no file, only a path
+        paths = [getattr(module, "__file__", None) or "", *(getattr(module, "__path__", None) or [])]
+        if any(path.startswith(working_directory) for path in paths):
+            project_modules.add(name)
+    return project_modules
+
+
+def _in_directory(spec, directory: str) -> bool:
+    # Namespace packages have no origin, only search locations
+    paths = [spec.origin or "", *(spec.submodule_search_locations or [])]
+    return any(path.startswith(directory) for path in paths)
+
+
+def _file_signature(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _run_child(script: str, args: list[str], fds: list[int]) -> None:
+    exit_code = 1
+    try:
+        os.setsid()
+        _limit_resources()
+        _minimal_environment()
+        stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        for fd, target in ((stdin_fd, 0), (fds[0], 1), (fds[1], 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        sys.path[0] = os.path.dirname(script)
+        sys.argv = [script, *args]
+
+        runpy.run_path(script, run_name="__main__")
+        exit_code = 0
+    except SystemExit as exc:
+        exit_code = _system_exit_code(exc)
+    except BaseException as exc:
+        _print_exception(exc, script)
+    finally:
+        try:
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def _limit_resources() -> None:
+    for limit, value in CHILD_LIMITS.items():
+        _, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        # Also the hard limit, so that the script can't raise it again
+        resource.setrlimit(limit, (value, value))
+
+
+def _minimal_environment() -> None:
+    kept = {name: os.environ[name] for name in CHILD_ENVIRONMENT if name in os.environ}
+    # Also unsets them for the processes started by the script
+    os.environ.clear()
+    os.environ.update(kept)
+
+
+def _system_exit_code(exc: SystemExit) -> int:
+    """Returns the exit code of the interpreter for this `SystemExit`, as `sys.exit()` documents."""
+    if exc.code is None:
+        return 0
+    if isinstance(exc.code, int):
+        return exc.code & 0xFF
+    print(exc.code, file=sys.stderr)
+    return 1
+
+
+def _print_exception(exc: BaseException, script: str) -> None:
+    """Prints the traceback starting from the script, hiding the frames of this module and runpy.
+    Syntax errors in the script have no frames left, as when the interpreter reports them."""
+    tb = exc.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != script:
+        tb = tb.tb_next
+    traceback.print_exception(type(exc), exc, tb)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,143 +1,151 @@
+import argparse
 import os
 import sys
-from dotenv import load_dotenv
-from google import genai
-from google.genai import types
 
+# Only modules needed by every command are imported here. The agent, the API client
+# and the tools are imported only when needed, so that commands like `stats` start quickly.
 import stats
-from config import MODEL_ID, MAX_ITERATIONS
-from call_function import (
-    call_function,
-    available_functions,
-    system_prompt,
-)
+from config import BATCH_CONCURRENCY, TRACE_FILE_NAME
 
 
 def main():
-    # Load API key
-    load_dotenv()
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if api_key is None:
-        print("API key not found, you need to specify it in a .env file. See the README for instructions.")
-        sys.exit(1)
-
-    # Parse CLI arguments
-    verbose = False
-    if sys.argv[-1] == "--verbose":
-        verbose = True
-        sys.argv.pop()
-    # Stats command, should print and exit with no error
-    if sys.argv[1] == "stats":
-        stats.print_usage()
-        return
-
-    if len(sys.argv) != 2:
-        print("ERROR: you need to provide the prompt as an argument")
-        print("Usage: uv run main.py \"Is this a prompt?\" [--verbose]")
-        sys.exit(1)
-
-    prompt = sys.argv[1]
-
+    match sys.argv[1:2]:
+        # Stats command, should print and exit with no error
+        case ["stats"]:
+            stats.print_usage()
+            return
+        case ["serve"]:
+            import daemon
+            from agent import agent_request
+            daemon.serve(_load_api_key(), agent_request)
+            return
+        case ["trace"]:
+            args = _parse_trace_args(sys.argv[2:])
+            import tracing
+            print(tracing.summary(args.file))
+            return
+        case ["batch"]:
+            args = _parse_batch_args(sys.argv[2:])
+            import batch
+            batch.run_batch(args.input, args.output, _load_api_key(), concurrency=args.concurrency, verbose=args.verbose)
+            return
+
+    args = _parse_args(sys.argv[1:])
+    if args.trace:
+        import tracing
+        tracing.enable()
+
+    session = None
     try:
-        response = agent_request(prompt, api_key, verbose)
+        if args.daemon:
+            # The daemon uses its own API key
+            import daemon
+            response = daemon.send_prompt(args.prompt, args.verbose, stream=args.stream)
+        else:
+            import sessions
+            from agent import agent_request
+            session = sessions.Session.create() if args.resume is None else sessions.Session.load(args.resume)
+            response = agent_request(args.prompt, _load_api_key(), args.verbose, stream=args.stream, session=session)
     except Exception as exc:
+        if session is not None:
+            print(f"The conversation was saved, continue it with: main.py --resume {session.conversation_id}", file=sys.stderr)
         raise Exception(f"Agent cannot generate a response: {exc}") from exc
-    print(response)
-
-
-def agent_request(
-    prompt: str,
-    api_key: str,
-    verbose: bool,
-) -> str:
-    """Starts the agent, which will iterate over the user prompt and the result
-    of available functions (called by the agent) until one of these things happen,
-    whichever comes first;
-    - the agent believes it satisfied the user request
-    - the agent concludes it cannot satisfy the user request
-    - the max number of iterations is reached
-
-    Return's the agent final answer, or raises an exception.
-
-    WARNING: Note that the agent is able to use some tools that can edit existing files
-    and execute Python scripts, there are some basic safeguards but the wrong prompt
-    can wreak havoc. You've been warned.
-    """
-    # Will contain all messages in the conversation, which will be provided
-    # with each request to the LLM so it can use the whole thing as context.
-    messages: list[types.Content] = [
-        types.Content(role="user", parts=[types.Part(text=prompt)]),
-    ]
+    if args.stream:
+        # The response was already printed while it was being generated
+        print()
+    else:
+        print(response)
 
-    client = genai.Client(api_key=api_key)
 
-    if verbose:
-        print(f"User prompt: {prompt}")
-
-    for iteration in range(MAX_ITERATIONS):
-        if verbose:
-            if iteration > 0:
-                print("\n------------------------------\n")
-            print("Sending request.")
-
-        response = client.models.generate_content(
-            model=MODEL_ID,
-            contents=messages,
-            config=types.GenerateContentConfig(
-                tools=[available_functions],
-                system_instruction=system_prompt,
-            )
-        )
-
-        stats.add(response.usage_metadata)
-
-        if verbose:
-            print("Response received.")
-            if response.usage_metadata:
-                print("\nSTATS:")
-                print(f"Prompt tokens: {response.usage_metadata.prompt_token_count}")
-                print(f"Response tokens: {response.usage_metadata.candidates_token_count}")
-                print(f"Total tokens: {response.usage_metadata.total_token_count}")
-            else:
-                print("ERROR: API usage data not available")
-
-        # A list of response variations, usually just one.
-        if response.candidates is None:
-            print("WARNING: No response candidate found.")
-        else:
-            for candidate in response.candidates:
-                if candidate.content:
-                    messages.append(candidate.content)
-                    if verbose:
-                        print(f"Appending a response candidate to messages list:")
-                        print(f" - Role: {candidate.content.role}")
-                        if candidate.content.parts:
-                            for i, part in enumerate(candidate.content.parts):
-                                print(f" - Part {i}")
-                                if part.text:
-                                    print("   - Includes text")
-                                if part.function_call:
-                                    print("   - Includes a function call // " + (part.function_call.name or ""))
-                        print("")
-
-        if response.function_calls:
-            for called_function in response.function_calls:
-                function_call_result = call_function(called_function, verbose)
-                messages.append(types.Content(
-                    role="user",
-                    parts=function_call_result.parts,
-                ))
-                if verbose:
-                    try:
-                        print(f"-> {function_call_result.parts[0].function_response.response}") # type: ignore
-                    except Exception as exc:
-                        raise ValueError(f"Invalid result structure for function \"{called_function.name}\"") from exc
-        else:
-            # This was the final message from the AI, no further action is needed.
-            if response.text:
-                return response.text
-
-    raise Exception("Agent loop was terminated due to reaching the max iterations limit.")
+def _load_api_key() -> str:
+    from dotenv import load_dotenv
+    load_dotenv()
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if api_key is None:
+        print("API key not found, you need to specify it in a .env file. See the README for instructions.")
+        sys.exit(1)
+    return api_key
+
+
+def _parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="main.py",
+        description=(
+            "A simple AI coding agent."
+            " Run `main.py stats` to print API usage stats,"
+            " `main.py serve` to start a daemon that answers prompts sent with --daemon,"
+            " `main.py batch` to run many prompts from a file,"
+            " or `main.py trace summary` to print the time spent in each stage of traced runs."
+        ),
+    )
+    parser.add_argument("prompt", nargs="?", default="", help="the request for the agent, optional with --resume")
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print details about each request and function call",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="print the response while it is generated, and execute function calls as soon as they are received",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="send the prompt to the agent daemon started with `main.py serve`, instead of starting a new agent",
+    )
+    parser.add_argument(
+        "--resume",
+        type=int,
+        metavar="ID",
+        help="continue a saved conversation, e.g. one that reached the max iterations, with the prompt if given",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="record how long each model request and function call takes, see `main.py trace summary`",
+    )
+    args = parser.parse_args(argv)
+    if args.resume is not None and args.daemon:
+        parser.error("--resume cannot be used with --daemon")
+    if not args.prompt and args.resume is None:
+        parser.error("the prompt is required, unless continuing a conversation with --resume")
+    return args
+
+
+def _parse_batch_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="main.py batch",
+        description=(
+            "Run the prompts of a JSONL file, one {\"id\": ..., \"prompt\": ...} object per line,"
+            " and append the results to another JSONL file as they complete."
+            " Running it again with the same output file resumes the batch."
+        ),
+    )
+    parser.add_argument("input", help="the JSONL file with the prompts")
+    parser.add_argument("output", help="the JSONL file where results are appended")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=BATCH_CONCURRENCY,
+        help=f"number of prompts to run at the same time (default: {BATCH_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print details about each request and function call",
+    )
+    return parser.parse_args(argv)
+
+
+def _parse_trace_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="main.py trace",
+        description="Print the number of spans, total time and p50/p95 latency of each stage of a trace recorded with --trace.",
+    )
+    parser.add_argument("command", choices=["summary"])
+    parser.add_argument("file", nargs="?", default=TRACE_FILE_NAME, help=f"the trace file (default: {TRACE_FILE_NAME})")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+import asyncio
+import contextlib
+import math
+import threading
+import time
+from datetime import timedelta
+from typing import Callable
+
+import stats
+import tracing
+from config import (
+    STATS_MAX_REQUESTS_PER_DAY,
+    STATS_MAX_REQUESTS_PER_MINUTE,
+    STATS_MAX_TOKENS_PER_DAY,
+    RATE_LIMIT_MAX_WAIT_SECONDS,
+)
+
+
+POLL_INTERVAL_SECONDS = 1.0
+"""While waiting, quotas are checked again at least this often,
+as other processes may send requests in the meantime."""
+
+
+class RateLimitExceeded(Exception):
+    """The request cannot be sent without exceeding a quota, and waiting would take too long."""
+
+
+class Reservation:
+    """A request allowed by the rate limiter, counted against the quotas until it's recorded."""
+
+    def __init__(self, limiter: "RateLimiter | None" = None) -> None:
+        self._limiter = limiter
+
+    def record(self, add: Callable[[], object]) -> None:
+        """Records the request in the stats database with `add` (e.g. a call to `stats.add()`)
+        and releases the reservation at the same time, so that the request is never counted
+        both as recorded and as reserved. Without a limiter, only calls `add`."""
+        if self._limiter is None:
+            add()
+        else:
+            self._limiter._record(self, add)
+
+
+class RateLimiter:
+    """Delays requests so that they stay within the configured quotas, instead of being
+    rejected by the API.
+
+    Usage is read from the stats database, so requests sent by other processes are accounted
+    for as soon as they are recorded. Requests of this process that have been allowed but not
+    recorded yet are kept as reservations, so that concurrent sessions don't exceed the quotas.
+    A reservation becomes a recorded request atomically, see `Reservation.record()`.
+    """
+
+    def __init__(
+        self,
+        db: stats.Database,
+        max_requests_per_minute: int = STATS_MAX_REQUESTS_PER_MINUTE,
+        max_requests_per_day: int = STATS_MAX_REQUESTS_PER_DAY,
+        max_tokens_per_day: int = STATS_MAX_TOKENS_PER_DAY,
+        max_wait_seconds: float = RATE_LIMIT_MAX_WAIT_SECONDS,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self._db = db
+        self._max_requests_per_minute = max_requests_per_minute
+        self._max_requests_per_day = max_requests_per_day
+        self._max_tokens_per_day = max_tokens_per_day
+        self._max_wait_seconds = max_wait_seconds
+        self._sleep = sleep
+        # Estimated tokens of the requests allowed but not recorded yet
+        self._reservations: dict[Reservation, int] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def request(self, estimated_tokens: int):
+        """Waits until a request of the given size can be sent, and reserves it until the context exits.
+        The context returns the `Reservation`, the request should be recorded with its `record()`
+        before exiting the context.
+
+        Raises `RateLimitExceeded` if the wait would be longer than `max_wait_seconds`.
+        """
+        reservation = None
+        waited = False
+        with tracing.span("rate_limit.wait", estimated_tokens=estimated_tokens):
+            while reservation is None:
+                reservation, wait = self._try_reserve(estimated_tokens)
+                if wait > 0:
+                    if not waited:
+                        print(f"Waiting {wait:.1f} seconds to stay within the API quotas.")
+                        waited = True
+                    self._sleep(min(wait, POLL_INTERVAL_SECONDS))
+        try:
+            yield reservation
+        finally:
+            self._release(reservation)
+
+    @contextlib.asynccontextmanager
+    async def request_async(self, estimated_tokens: int):
+        """Same as `request`, but waits without blocking the event loop:
+        the quotas are read from the database in a worker thread.
+        Record the request with `asyncio.to_thread(reservation.record, ...)`."""
+        reservation = None
+        waited = False
+        with tracing.span("rate_limit.wait", estimated_tokens=estimated_tokens):
+            while reservation is None:
+                reservation, wait = await asyncio.to_thread(self._try_reserve, estimated_tokens)
+                if wait > 0:
+                    if not waited:
+                        print(f"Waiting {wait:.1f} seconds to stay within the API quotas.")
+                        waited = True
+                    await asyncio.sleep(min(wait, POLL_INTERVAL_SECONDS))
+        try:
+            yield reservation
+        finally:
+            self._release(reservation)
+
+    def wait_time(self, estimated_tokens: int) -> float:
+        """Returns the number of seconds to wait before a request of the given size can be sent
+        without exceeding any quota (`math.inf` if it never can)."""
+        reserved_requests = len(self._reservations)
+        reserved_tokens = sum(self._reservations.values())
+        now = time.time()
+        return max(
+            self._requests_wait(timedelta(minutes=1), self._max_requests_per_minute, reserved_requests, now),
+            self._requests_wait(timedelta(days=1), self._max_requests_per_day, reserved_requests, now),
+            self._tokens_wait(timedelta(days=1), self._max_tokens_per_day, estimated_tokens + reserved_tokens, now),
+        )
+
+    def _try_reserve(self, estimated_tokens: int) -> tuple[Reservation | None, float]:
+        """Returns a reservation if the request can be sent now, otherwise how long to wait before trying again."""
+        with self._lock:
+            wait = self.wait_time(estimated_tokens)
+            if wait <= 0:
+                reservation = Reservation(self)
+                self._reservations[reservation] = estimated_tokens
+                return reservation, 0
+        if wait > self._max_wait_seconds:
+            raise RateLimitExceeded(
+                "Sending the request now would exceed the API quotas, and waiting would take "
+                + ("forever" if wait == math.inf else f"{wait:.0f} seconds")
+            )
+        return None, wait
+
+    def _record(self, reservation: Reservation, add: Callable[[], object]) -> None:
+        # Quotas are computed holding the lock, so they see either the reservation or the record
+        with self._lock:
+            try:
+                add()
+            finally:
+                self._reservations.pop(reservation, None)
+
+    def _release(self, reservation: Reservation) -> None:
+        with self._lock:
+            # Already released if it was recorded
+            self._reservations.pop(reservation, None)
+
+    def _requests_wait(self, window: timedelta, limit: int, reserved: int, now: float) -> float:
+        # The oldest `limit` requests are enough to know whether the quota is reached,
+        # and if so when enough of them will be out of the window.
+        times = self._db.request_times_since(window, limit)
+        excess = len(times) + reserved - limit + 1
+        if excess <= 0:
+            return 0
+        if excess > len(times):
+            # Requests in flight alone reach the quota, wait for them to be recorded
+            return POLL_INTERVAL_SECONDS
+        return max(times[excess - 1] / 1_000_000 + window.total_seconds() - now, 0.001)
+
+    def _tokens_wait(self, window: timedelta, limit: int, tokens: int, now: float) -> float:
+        if tokens > limit:
+            return math.inf
+        _, used = self._db.usage_since(window)
+        excess = used + tokens - limit
+        if excess <= 0:
+            return 0
+        # Per minute totals are much faster to read than single requests, at the cost
+        # of waiting until the end of the minute that brings usage under the quota.
+        expired = 0
+        for minute_start, minute_tokens in self._db.tokens_per_minute_since(window):
+            expired += minute_tokens
+            if expired >= excess:
+                return max(minute_start / 1_000_000 + 60 + window.total_seconds() - now, 0.001)
+        # Requests in flight alone reach the quota, wait for them to be recorded
+        return POLL_INTERVAL_SECONDS
+
+
+rate_limiter = RateLimiter(stats.database())
@@ -0,0 +1,299 @@
+"""Retries for model calls that fail with transient errors, and hedged requests for slow ones.
+
+A call that fails with a rate limit, server error or connection error is retried after
+an exponential backoff with full jitter (or the delay requested by the server, if any).
+
+With hedging enabled, a call that takes longer than most previous calls (a configured
+latency percentile) is sent again without cancelling the first one, and whichever
+response arrives first is used. This cuts tail latency at the cost of some duplicate
+requests, which count towards the quotas too: the caller is given the discarded responses,
+to record their usage.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import email.utils
+import random
+import re
+import threading
+import time
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+from google.genai import errors
+
+from config import (
+    RETRY_MAX_ATTEMPTS,
+    RETRY_INITIAL_DELAY_SECONDS,
+    RETRY_MAX_DELAY_SECONDS,
+    HEDGING_ENABLED,
+    HEDGING_LATENCY_PERCENTILE,
+    HEDGING_MIN_SAMPLES,
+)
+
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+LATENCY_SAMPLES = 1000
+"""Number of recent call latencies used to compute percentiles."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Returns whether the call that raised this exception may succeed if sent again."""
+    if isinstance(exc, errors.APIError):
+        return exc.code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+
+def retry_after_seconds(exc: BaseException) -> float | None:
+    """Returns the delay requested by the server before retrying, if any.
+
+    Both the `Retry-After` header (seconds or HTTP date) and the `RetryInfo`
+    detail of Google APIs errors (e.g. `"retryDelay": "30s"`) are supported.
+    """
+    if not isinstance(exc, errors.APIError):
+        return None
+
+    headers = getattr(exc.response, "headers", None) or {}
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+
+    details = exc.details if isinstance(exc.details, dict) else {}
+    details = details.get("error", details)
+    for detail in details.get("details", None) or []:
+        if not isinstance(detail, dict) or not detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+            continue
+        match = re.fullmatch(r"(\d+(?:\.\d+)?)s", str(detail.get("retryDelay", "")))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class CallMetrics:
+    """Counts attempts, retries and hedged requests, and keeps recent latencies of successful calls."""
+
+    def __init__(self, max_samples: int = LATENCY_SAMPLES) -> None:
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies: collections.deque[float] = collections.deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def samples(self) -> int:
+        return len(self._latencies)
+
+    def percentile(self, percent: float) -> float | None:
+        """Returns the latency (in seconds) under which `percent`% of the recent calls completed."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        # Nearest rank
+        rank = max(int(-(-percent * len(latencies) // 100)), 1)
+        return latencies[rank - 1]
+
+    def summary(self) -> str:
+        latencies = [self.percentile(percent) for percent in (50, 95, 99)]
+        if latencies[0] is None:
+            latency_text = "no successful calls"
+        else:
+            latency_text = "latency p50 {:.2f}s, p95 {:.2f}s, p99 {:.2f}s".format(*latencies)
+        return (
+            f"{self.calls} calls, {self.retries} retries, {self.failures} failures, "
+            f"{self.hedges} hedged ({self.hedge_wins} won), {latency_text}"
+        )
+
+
+class ResilientCaller:
+    """Calls a function, retrying it on transient errors and hedging it when it's slow."""
+
+    def __init__(
+        self,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        initial_delay_seconds: float = RETRY_INITIAL_DELAY_SECONDS,
+        max_delay_seconds: float = RETRY_MAX_DELAY_SECONDS,
+        hedging: bool = HEDGING_ENABLED,
+        hedging_percentile: float = HEDGING_LATENCY_PERCENTILE,
+        hedging_min_samples: int = HEDGING_MIN_SAMPLES,
+        metrics: CallMetrics | None = None,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.initial_delay_seconds = initial_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.hedging = hedging
+        self.hedging_percentile = hedging_percentile
+        self.hedging_min_samples = hedging_min_samples
+        self.metrics = metrics or CallMetrics()
+        self._sleep = sleep
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
+
+    def call(
+        self,
+        function: Callable[[], T],
+        hedge: bool = True,
+        discarded: Callable[[T | None], None] | None = None,
+    ) -> T:
+        """Returns the result of `function()`, retrying on transient errors.
+        Set `hedge` to False for calls with side effects, that must not run twice at the same time.
+
+        When a call is hedged, `discarded` is called with the result of the slower request
+        once it completes (from a worker thread), so that its usage can be recorded too.
+        """
+        self.metrics.count("calls")
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                hedge_after = self.hedge_after_seconds() if hedge else None
+                if hedge_after is None:
+                    return self._timed(function)
+                return self._hedged(function, hedge_after, discarded)
+            except Exception as exc:
+                self._before_retry(exc, attempt)
+                self._sleep(self.backoff_seconds(attempt, exc))
+        raise AssertionError("unreachable")
+
+    async def call_async(
+        self,
+        function: Callable[[], Awaitable[T]],
+        hedge: bool = True,
+        discarded: Callable[[T | None], None] | None = None,
+    ) -> T:
+        """Same as `call`, for a function returning an awaitable. The slower hedged request
+        is cancelled: if it didn't complete yet, `discarded` is called with None, as the server
+        may have processed (and billed) it anyway, but its usage is unknown."""
+        self.metrics.count("calls")
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                hedge_after = self.hedge_after_seconds() if hedge else None
+                if hedge_after is None:
+                    return await self._timed_async(function)
+                return await self._hedged_async(function, hedge_after, discarded)
+            except Exception as exc:
+                self._before_retry(exc, attempt)
+                await asyncio.sleep(self.backoff_seconds(attempt, exc))
+        raise AssertionError("unreachable")
+
+    def backoff_seconds(self, attempt: int, exc: BaseException | None = None) -> float:
+        """Returns how long to wait after the given failed attempt (starting from 1).
+
+        Full jitter: a random delay up to the exponential backoff, so that clients that failed
+        together don't retry together. A delay requested by the server is waited in full.
+        """
+        requested = retry_after_seconds(exc) if exc is not None else None
+        if requested is not None:
+            return min(requested, self.max_delay_seconds)
+        return random.uniform(0, min(self.initial_delay_seconds * 2 ** (attempt - 1), self.max_delay_seconds))
+
+    def hedge_after_seconds(self) -> float | None:
+        """Returns after how long a call should be hedged, or None if it should not."""
+        if not self.hedging or self.metrics.samples() < self.hedging_min_samples:
+            return None
+        return self.metrics.percentile(self.hedging_percentile)
+
+    def _before_retry(self, exc: Exception, attempt: int) -> None:
+        if not is_retryable(exc) or attempt == self.max_attempts:
+            self.metrics.count("failures")
+            raise exc
+        self.metrics.count("retries")
+
+    def _timed(self, function: Callable[[], T]) -> T:
+        start = time.perf_counter()
+        result = function()
+        self.metrics.record_latency(time.perf_counter() - start)
+        return result
+
+    async def _timed_async(self, function: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        result = await function()
+        self.metrics.record_latency(time.perf_counter() - start)
+        return result
+
+    def _hedged(self, function: Callable[[], T], hedge_after: float, discarded: Callable[[T | None], None] | None) -> T:
+        executor = self._get_executor()
+        first = executor.submit(self._timed, function)
+        done, _ = concurrent.futures.wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+
+        self.metrics.count("hedges")
+        second = executor.submit(self._timed, function)
+        pending = {first, second}
+        while True:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.metrics.count("hedge_wins")
+                    # Requests running in a thread can't be cancelled, the other one is left to complete
+                    other = first if future is second else second
+                    if discarded is not None:
+                        other.add_done_callback(lambda other: _report_discarded(other, discarded))
+                    return future.result()
+            # A failed request is only reported if the other one fails too
+            if not pending:
+                return first.result()
+
+    async def _hedged_async(self, function: Callable[[], Awaitable[T]], hedge_after: float, discarded: Callable[[T | None], None] | None) -> T:
+        first = asyncio.ensure_future(self._timed_async(function))
+        done, _ = await asyncio.wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+
+        self.metrics.count("hedges")
+        second = asyncio.ensure_future(self._timed_async(function))
+        pending = {first, second}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.metrics.count("hedge_wins")
+                        other = first if task is second else second
+                        if discarded is not None and not other.done():
+                            # Still running, it's cancelled below
+                            discarded(None)
+                        elif discarded is not None:
+                            _report_discarded(other, discarded)
+                        return task.result()
+                if not pending:
+                    return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="hedged_call")
+            return self._executor
+
+
+def _report_discarded(future: "concurrent.futures.Future[T] | asyncio.Future[T]", discarded: Callable[[T | None], None]) -> None:
+    # A failed request has no usage to record
+    if not future.cancelled() and future.exception() is None:
+        discarded(future.result())
+
+
+resilient_caller = ResilientCaller()
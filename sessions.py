@@ -0,0 +1,159 @@
+"""Conversations saved on disk, so that an interrupted agent run (because it reached the max
+iterations, or because of an error) can be continued instead of starting again from the prompt.
+
+Each conversation has an append-only log, `<id>.jsonl`, with a line per iteration: the messages
+added to the conversation (the model response and the function results) and the usage of the request.
+Every `SESSION_SNAPSHOT_INTERVAL` iterations the whole conversation is also written to
+`<id>.snapshot.json`, together with the size of the log at that point, so that loading a session
+reads the snapshot and only the log lines written after it.
+
+The id of a conversation is the `conversation_id` recorded in the usage stats.
+"""
+import json
+import os
+
+from google.genai import types
+
+from config import SESSIONS_DIRECTORY, SESSION_SNAPSHOT_INTERVAL
+from functions.write_file import write_atomically
+
+
+class SessionError(Exception):
+    """The session doesn't exist, or cannot be read."""
+
+
+class Session:
+    """A conversation saved on disk. Create a new one with `create()`,
+    or continue an existing one with `load()`."""
+
+    def __init__(
+        self,
+        conversation_id: int,
+        directory: str,
+        messages: list[types.Content],
+        usage: dict[str, int],
+        log_size: int,
+    ) -> None:
+        self.conversation_id = conversation_id
+        self.messages = messages
+        # Totals of all the saved iterations, see `_add_usage()`
+        self.usage = usage
+        self._directory = directory
+        self._saved_messages = len(messages)
+        self._log_size = log_size
+
+    @classmethod
+    def create(cls, directory: str = SESSIONS_DIRECTORY) -> "Session":
+        """Starts a new conversation, with the next free id."""
+        os.makedirs(directory, exist_ok=True)
+        while True:
+            conversation_id = _last_id(directory) + 1
+            try:
+                # Fails if another process took the same id in the meantime
+                fd = os.open(_log_path(directory, conversation_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                continue
+            os.close(fd)
+            return cls(conversation_id, directory, [], _empty_usage(), 0)
+
+    @classmethod
+    def load(cls, conversation_id: int, directory: str = SESSIONS_DIRECTORY) -> "Session":
+        """Reads a saved conversation, from its latest snapshot and the log lines written after it."""
+        log_path = _log_path(directory, conversation_id)
+        if not os.path.isfile(log_path):
+            raise SessionError(f"conversation {conversation_id} not found in \"{directory}\"")
+
+        messages: list[types.Content] = []
+        usage = _empty_usage()
+        log_size = 0
+        try:
+            with open(_snapshot_path(directory, conversation_id), encoding="utf-8") as f:
+                snapshot = json.load(f)
+            messages = [types.Content.model_validate(message) for message in snapshot["messages"]]
+            usage.update(snapshot["usage"])
+            log_size = snapshot["log_size"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as exc:
+            raise SessionError(f"invalid snapshot of conversation {conversation_id}: {exc}") from exc
+
+        with open(log_path, "r+b") as f:
+            f.seek(log_size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Partially written when the process was killed, the iteration wasn't saved
+                    break
+                try:
+                    entry = json.loads(line)
+                    messages += [types.Content.model_validate(message) for message in entry["messages"]]
+                except (ValueError, KeyError) as exc:
+                    raise SessionError(f"invalid log of conversation {conversation_id} at byte {log_size}: {exc}") from exc
+                _add_usage(usage, entry.get("usage") or {})
+                log_size += len(line)
+            # The next iteration is appended after the last complete line
+            f.truncate(log_size)
+
+        return cls(conversation_id, directory, messages, usage, log_size)
+
+    @property
+    def finished(self) -> bool:
+        """Whether the conversation ends with the final answer of the model, rather than a prompt or function results."""
+        return bool(self.messages) and self.messages[-1].role == "model"
+
+    def record(
+        self,
+        messages: list[types.Content],
+        usage_metadata: types.GenerateContentResponseUsageMetadata | None,
+    ) -> None:
+        """Saves an iteration: the messages added to the conversation since the previous one, and the usage of its request."""
+        new_messages = messages[self._saved_messages:]
+        usage = usage_metadata.model_dump(mode="json", exclude_none=True) if usage_metadata else {}
+        entry = {
+            "messages": [message.model_dump(mode="json", exclude_none=True) for message in new_messages],
+            "usage": usage,
+        }
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+        with open(_log_path(self._directory, self.conversation_id), "ab") as f:
+            f.write(line)
+
+        self.messages = messages
+        self._saved_messages = len(messages)
+        self._log_size += len(line)
+        _add_usage(self.usage, usage)
+        if self.usage["iterations"] % SESSION_SNAPSHOT_INTERVAL == 0:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Saves the whole conversation, so that loading it doesn't need to read the log written so far."""
+        snapshot = {
+            "conversation_id": self.conversation_id,
+            "messages": [message.model_dump(mode="json", exclude_none=True) for message in self.messages[:self._saved_messages]],
+            "usage": self.usage,
+            "log_size": self._log_size,
+        }
+        write_atomically(_snapshot_path(self._directory, self.conversation_id), json.dumps(snapshot, separators=(",", ":")))
+
+
+def _empty_usage() -> dict[str, int]:
+    return {"iterations": 0, "prompt_tokens": 0, "response_tokens": 0, "total_tokens": 0}
+
+
+def _add_usage(totals: dict[str, int], usage: dict) -> None:
+    """Adds the usage of a request, as saved in the log, to the totals."""
+    totals["iterations"] += 1
+    totals["prompt_tokens"] += usage.get("prompt_token_count") or 0
+    totals["response_tokens"] += usage.get("candidates_token_count") or 0
+    totals["total_tokens"] += usage.get("total_token_count") or 0
+
+
+def _log_path(directory: str, conversation_id: int) -> str:
+    return os.path.join(directory, f"{conversation_id}.jsonl")
+
+
+def _snapshot_path(directory: str, conversation_id: int) -> str:
+    return os.path.join(directory, f"{conversation_id}.snapshot.json")
+
+
+def _last_id(directory: str) -> int:
+    ids = [int(name.removesuffix(".jsonl")) for name in os.listdir(directory) if name.endswith(".jsonl") and name.removesuffix(".jsonl").isdigit()]
+    return max(ids, default=0)
@@ -1,10 +1,18 @@
+import atexit
+import dataclasses
+import re
 import sqlite3
-from datetime import datetime, timezone
-
-from google.genai import types
-from pydantic import BaseModel, Field
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
 
 import config
+import tracing
+
+if TYPE_CHECKING:
+    # Not imported at runtime so that `main.py stats` starts quickly
+    from google.genai import types
 
 
 def _now_utc() -> str:
@@ -23,81 +31,410 @@ def datetime_to_string(dt: datetime) -> str:
     return dt.strftime(r"%F %T.%f")
 
 
-class Record(BaseModel):
+def string_to_epoch_us(ts: str) -> int:
+    """Returns the number of microseconds since the Unix epoch for a UTC time
+    in the format returned by `datetime_to_string()`."""
+    dt = datetime.fromisoformat(ts).replace(tzinfo=timezone.utc)
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+
+_EPOCH = datetime.fromtimestamp(0, tz=timezone.utc)
+
+_TIMESTAMP_PATTERN = re.compile(r"\d{4}-[01]\d-[0-3]\d \d{2}:\d{2}:\d{2}.\d{3}")
+
+
+@dataclasses.dataclass(kw_only=True)
+class Record:
     """Represents data for a single request, to be stored in the database.
 
     If 'ts' is not specified, current UTC time will be used.
     """
-    ts: str = Field(
-        pattern=r"\d{4}-[01]\d-[0-3]\d \d{2}:\d{2}:\d{2}.\d{3}",
-        default_factory=_now_utc
-    )
+    ts: str = dataclasses.field(default_factory=_now_utc)
     conversation_id: int | None = None
+    # Index of the request in its agent session, starting from 0
+    iteration: int | None = None
+    model_id: str | None = None
+    # Time between sending the request and receiving the whole response, retries included
+    latency_us: int | None = None
     tokens_prompt: int
     tokens_candidates: int
     # Computed field, can delete column
     tokens_total: int
 
+    def __post_init__(self):
+        if not _TIMESTAMP_PATTERN.match(self.ts):
+            raise ValueError(f"Invalid timestamp: {self.ts!r}")
+
+
+@dataclasses.dataclass(kw_only=True)
+class ToolCall:
+    """A function call executed for the agent, to be stored in the database.
+    The conversation and iteration are those of the request that asked for it."""
+    ts_us: int = dataclasses.field(default_factory=lambda: time.time_ns() // 1000)
+    conversation_id: int | None = None
+    iteration: int | None = None
+    function: str
+    duration_us: int
+    # Size of the result sent to the model, as UTF-8
+    result_bytes: int
+    cached: bool = False
+    error: bool = False
+
+
+_US_PER_MINUTE = 60 * 1_000_000
+_US_PER_HOUR = 60 * _US_PER_MINUTE
+
+_MIGRATIONS: list[list[str]] = [
+    # 1: initial schema
+    [
+        """
+        CREATE TABLE IF NOT EXISTS stats (
+            ts                TEXT    NOT NULL,
+            conversation_id   INT,
+            tokens_prompt     INT     NOT NULL,
+            tokens_candidates INT     NOT NULL,
+            tokens_total      INT     NOT NULL
+        )
+        """,
+    ],
+    # 2: indexed integer timestamps (microseconds since the epoch), and per-minute/per-hour
+    # totals kept up to date by a trigger, so that window queries read only a few rows
+    [
+        "ALTER TABLE stats ADD COLUMN ts_us INT",
+        "UPDATE stats SET ts_us = CAST(ROUND((julianday(ts) - 2440587.5) * 86400000000) AS INT)",
+        "CREATE INDEX stats_ts_us ON stats (ts_us)",
+        """
+        CREATE TABLE stats_minute (
+            minute   INT PRIMARY KEY,
+            requests INT NOT NULL,
+            tokens   INT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE stats_hour (
+            hour     INT PRIMARY KEY,
+            requests INT NOT NULL,
+            tokens   INT NOT NULL
+        )
+        """,
+        f"""
+        INSERT INTO stats_minute
+        SELECT ts_us / {_US_PER_MINUTE}, COUNT(*), SUM(tokens_total) FROM stats GROUP BY 1
+        """,
+        f"""
+        INSERT INTO stats_hour
+        SELECT ts_us / {_US_PER_HOUR}, COUNT(*), SUM(tokens_total) FROM stats GROUP BY 1
+        """,
+        f"""
+        CREATE TRIGGER stats_rollup AFTER INSERT ON stats
+        BEGIN
+            INSERT INTO stats_minute VALUES (NEW.ts_us / {_US_PER_MINUTE}, 1, NEW.tokens_total)
+                ON CONFLICT (minute) DO UPDATE SET requests = requests + 1, tokens = tokens + NEW.tokens_total;
+            INSERT INTO stats_hour VALUES (NEW.ts_us / {_US_PER_HOUR}, 1, NEW.tokens_total)
+                ON CONFLICT (hour) DO UPDATE SET requests = requests + 1, tokens = tokens + NEW.tokens_total;
+        END
+        """,
+    ],
+    # 3: details of each request, and the function calls executed for it
+    [
+        "ALTER TABLE stats ADD COLUMN iteration INT",
+        "ALTER TABLE stats ADD COLUMN model_id TEXT",
+        "ALTER TABLE stats ADD COLUMN latency_us INT",
+        # Covering indexes for the reports, which group by these columns
+        "CREATE INDEX stats_conversation ON stats (conversation_id, tokens_prompt, tokens_candidates, latency_us) WHERE conversation_id IS NOT NULL",
+        "CREATE INDEX stats_iteration ON stats (iteration, tokens_total) WHERE iteration IS NOT NULL",
+        """
+        CREATE TABLE tool_calls (
+            ts_us           INT  NOT NULL,
+            conversation_id INT,
+            iteration       INT,
+            function        TEXT NOT NULL,
+            duration_us     INT  NOT NULL,
+            result_bytes    INT  NOT NULL,
+            cached          INT  NOT NULL,
+            error           INT  NOT NULL
+        )
+        """,
+        "CREATE INDEX tool_calls_function ON tool_calls (function, duration_us, result_bytes)",
+        "CREATE INDEX tool_calls_conversation ON tool_calls (conversation_id, duration_us) WHERE conversation_id IS NOT NULL",
+    ],
+]
+"""Schema changes, applied in order. The index of the last applied migration
+(starting from 1) is stored in the database `user_version`."""
+
+_INSERT_RECORD = """
+INSERT INTO stats (ts, conversation_id, iteration, model_id, latency_us, tokens_prompt, tokens_candidates, tokens_total, ts_us)
+VALUES (:ts, :conversation_id, :iteration, :model_id, :latency_us, :tokens_prompt, :tokens_candidates, :tokens_total, :ts_us)
+"""
+
+_INSERT_TOOL_CALL = """
+INSERT INTO tool_calls (ts_us, conversation_id, iteration, function, duration_us, result_bytes, cached, error)
+VALUES (:ts_us, :conversation_id, :iteration, :function, :duration_us, :result_bytes, :cached, :error)
+"""
+
+# The conversations that used the most tokens, with the time spent waiting for the model and for function calls
+_SELECT_CONVERSATIONS = """
+SELECT
+    conversation_id,
+    COUNT(*),
+    SUM(tokens_prompt),
+    SUM(tokens_candidates),
+    TOTAL(latency_us),
+    (SELECT COUNT(*) FROM tool_calls t WHERE t.conversation_id = s.conversation_id),
+    (SELECT TOTAL(duration_us) FROM tool_calls t WHERE t.conversation_id = s.conversation_id)
+FROM stats s
+WHERE conversation_id IS NOT NULL
+GROUP BY conversation_id
+ORDER BY SUM(tokens_prompt) * :prompt_price + SUM(tokens_candidates) * :response_price DESC
+LIMIT :limit
+"""
+
+_SELECT_TOOLS = """
+SELECT function, COUNT(*), AVG(duration_us), MAX(duration_us), AVG(result_bytes)
+FROM tool_calls
+GROUP BY function
+ORDER BY AVG(duration_us) DESC
+LIMIT :limit
+"""
+
+_SELECT_ITERATIONS = """
+SELECT iteration, COUNT(*), AVG(tokens_total)
+FROM stats
+WHERE iteration IS NOT NULL
+GROUP BY iteration
+ORDER BY iteration
+LIMIT :limit
+"""
+
+# Requests and tokens from `start`: rows before the first full minute are read from the
+# stats table, then minute totals up to the first full hour, then hour totals.
+# There are no future records, so there's no need for an upper bound.
+_SELECT_WINDOW = """
+SELECT COUNT(*), TOTAL(tokens_total) FROM stats WHERE ts_us >= :start AND ts_us < :first_minute * :us_per_minute
+UNION ALL
+SELECT TOTAL(requests), TOTAL(tokens) FROM stats_minute WHERE minute >= :first_minute AND minute < :first_hour * 60
+UNION ALL
+SELECT TOTAL(requests), TOTAL(tokens) FROM stats_hour WHERE hour >= :first_hour
+"""
+
 
 class Database:
-    def __init__(self, db_name) -> None:
+    """Usage stats stored in a SQLite database.
+
+    A single connection is kept open for the lifetime of the object, and shared
+    by all threads (access is serialized by a lock). Statements are always the same
+    strings, so they're compiled once and then reused from the connection statement cache.
+
+    With `write_behind` enabled, added records are kept in memory and written in a single
+    transaction when `flush_max_records` are buffered, `flush_interval_seconds` after the
+    first buffered record, before every query, and when the program exits.
+    Records still in the buffer are lost if the process is killed.
+    """
+
+    def __init__(
+        self,
+        db_name,
+        write_behind: bool = False,
+        flush_interval_seconds: float = config.STATS_FLUSH_INTERVAL_SECONDS,
+        flush_max_records: int = config.STATS_FLUSH_MAX_RECORDS,
+    ) -> None:
         self._db_name = db_name
-        with sqlite3.connect(self._db_name) as connection:
-            cur = connection.cursor()
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS stats (
-                ts                TEXT    NOT NULL,
-                conversation_id   INT,
-                tokens_prompt     INT     NOT NULL,
-                tokens_candidates INT     NOT NULL,
-                tokens_total      INT     NOT NULL
-            );
-            """)
+        self._write_behind = write_behind
+        self._flush_interval_seconds = flush_interval_seconds
+        self._flush_max_records = flush_max_records
+        self._buffer: list[dict] = []
+        self._tool_call_buffer: list[dict] = []
+        self._flush_timer: threading.Timer | None = None
+        self._lock = threading.RLock()
+
+        self._connection = sqlite3.connect(self._db_name, check_same_thread=False)
+        with self._lock, self._connection:
+            # Readers don't block the writer, and commits don't wait for a full disk sync
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+        if write_behind:
+            atexit.register(self.close)
 
     def add(self, record: Record):
-        with sqlite3.connect(self._db_name) as connection:
-            cur = connection.cursor()
-            cur.execute(
-                """
-                INSERT INTO stats
-                VALUES (:ts, :conversation_id, :tokens_prompt, :tokens_candidates, :tokens_total)
-                """,
-                record.model_dump(),
-            )
-            connection.commit()
+        with self._lock:
+            if not self._write_behind:
+                with tracing.span("stats.write", records=1), self._connection:
+                    self._connection.execute(_INSERT_RECORD, _record_row(record))
+                return
+
+            self._buffer.append(_record_row(record))
+            if len(self._buffer) >= self._flush_max_records:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_interval_seconds, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def add_tool_calls(self, tool_calls: list[ToolCall]) -> None:
+        """Adds the function calls executed for a request, buffered as records are with `write_behind`."""
+        if not tool_calls:
+            return
+        rows = [dataclasses.asdict(tool_call) for tool_call in tool_calls]
+        with self._lock:
+            if not self._write_behind:
+                with tracing.span("stats.write", tool_calls=len(rows)), self._connection:
+                    self._connection.executemany(_INSERT_TOOL_CALL, rows)
+                return
+
+            self._tool_call_buffer += rows
+            if len(self._buffer) + len(self._tool_call_buffer) >= self._flush_max_records:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self._flush_interval_seconds, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self) -> None:
+        """Writes all buffered records to the database."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._buffer and not self._tool_call_buffer:
+                return
+            with tracing.span("stats.write", records=len(self._buffer), tool_calls=len(self._tool_call_buffer)), self._connection:
+                self._connection.executemany(_INSERT_RECORD, self._buffer)
+                self._connection.executemany(_INSERT_TOOL_CALL, self._tool_call_buffer)
+            self._buffer.clear()
+            self._tool_call_buffer.clear()
+
+    def close(self) -> None:
+        """Flushes buffered records and closes the connection."""
+        with self._lock:
+            if self._connection is None:
+                return
+            self.flush()
+            self._connection.close()
+            self._connection = None # type: ignore
 
     def tokens_last_24h(self) -> int:
-        with sqlite3.connect(self._db_name) as connection:
-            cur = connection.cursor()
-            cur.execute("SELECT SUM(tokens_total) FROM stats WHERE ts >= datetime('now', '-1 days')")
-            result = cur.fetchone()
-            return result[0] or 0
+        return self.usage_since(timedelta(days=1))[1]
 
     def requests_last_24h(self) -> int:
-        with sqlite3.connect(self._db_name) as connection:
-            cur = connection.cursor()
-            cur.execute("SELECT COUNT(*) FROM stats WHERE ts >= datetime('now', '-1 days')")
-            result = cur.fetchone()
-            return result[0] or 0
+        return self.usage_since(timedelta(days=1))[0]
 
     def requests_last_minute(self) -> int:
-        with sqlite3.connect(self._db_name) as connection:
-            cur = connection.cursor()
-            cur.execute("SELECT COUNT(*) FROM stats WHERE ts >= datetime('now', '-1 minutes')")
-            result = cur.fetchone()
-            return result[0] or 0
+        return self.usage_since(timedelta(minutes=1))[0]
+
+    def usage_since(self, window: timedelta) -> tuple[int, int]:
+        """Returns the number of requests and the total tokens in the given window of time,
+        up to now. Reads at most a few hundred rows, no matter how many records are stored."""
+        start = string_to_epoch_us(_now_utc()) - window // timedelta(microseconds=1)
+        first_minute = -(-start // _US_PER_MINUTE)
+        first_hour = -(-first_minute // 60)
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(_SELECT_WINDOW, {
+                "start": start,
+                "first_minute": first_minute,
+                "first_hour": first_hour,
+                "us_per_minute": _US_PER_MINUTE,
+            }).fetchall()
+        return int(sum(row[0] for row in rows)), int(sum(row[1] for row in rows))
+
+    def request_times_since(self, window: timedelta, limit: int) -> list[int]:
+        """Returns the times (microseconds since the epoch) of the oldest `limit` requests
+        in the given window of time up to now, oldest first."""
+        start = string_to_epoch_us(_now_utc()) - window // timedelta(microseconds=1)
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                "SELECT ts_us FROM stats WHERE ts_us >= ? ORDER BY ts_us LIMIT ?",
+                (start, limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def tokens_per_minute_since(self, window: timedelta) -> list[tuple[int, int]]:
+        """Returns the start time (microseconds since the epoch) and total tokens of every minute
+        with some requests in the given window of time up to now, oldest first.
+        The first minute may start before the window."""
+        start = string_to_epoch_us(_now_utc()) - window // timedelta(microseconds=1)
+        with self._lock:
+            self.flush()
+            rows = self._connection.execute(
+                "SELECT minute, tokens FROM stats_minute WHERE minute >= ? ORDER BY minute",
+                (start // _US_PER_MINUTE,),
+            ).fetchall()
+        return [(minute * _US_PER_MINUTE, tokens) for minute, tokens in rows]
+
+    def conversation_costs(self, limit: int) -> list[tuple[int, int, int, int, float, int, float]]:
+        """Returns the conversations that cost the most, with their id, number of requests,
+        prompt and response tokens, total model latency (microseconds), number of function calls
+        and their total duration (microseconds)."""
+        with self._lock:
+            self.flush()
+            return self._connection.execute(_SELECT_CONVERSATIONS, {
+                "prompt_price": config.STATS_PRICE_PER_MILLION_PROMPT_TOKENS,
+                "response_price": config.STATS_PRICE_PER_MILLION_RESPONSE_TOKENS,
+                "limit": limit,
+            }).fetchall()
+
+    def slowest_tools(self, limit: int) -> list[tuple[str, int, float, int, float]]:
+        """Returns the functions with the longest average duration, with their number of calls,
+        average and maximum duration (microseconds) and average result size (bytes)."""
+        with self._lock:
+            self.flush()
+            return self._connection.execute(_SELECT_TOOLS, {"limit": limit}).fetchall()
+
+    def tokens_per_iteration(self, limit: int) -> list[tuple[int, int, float]]:
+        """Returns the number of requests and the average total tokens of each iteration index,
+        i.e. how the requests grow as the conversations get longer."""
+        with self._lock:
+            self.flush()
+            return self._connection.execute(_SELECT_ITERATIONS, {"limit": limit}).fetchall()
+
+    def _migrate(self) -> None:
+        for version, statements in enumerate(_MIGRATIONS, start=1):
+            with self._lock:
+                # Take the write lock before checking the version, in case another process is migrating too
+                self._connection.execute("BEGIN IMMEDIATE")
+                try:
+                    if self._connection.execute("PRAGMA user_version").fetchone()[0] < version:
+                        for statement in statements:
+                            self._connection.execute(statement)
+                        self._connection.execute(f"PRAGMA user_version = {version}")
+                    self._connection.commit()
+                except BaseException:
+                    self._connection.rollback()
+                    raise
+
 
+def _record_row(record: Record) -> dict:
+    row = dataclasses.asdict(record)
+    row["ts_us"] = string_to_epoch_us(record.ts)
+    return row
 
-_db = Database(config.STATS_DB_NAME)
 
+_db = Database(config.STATS_DB_NAME, write_behind=config.STATS_WRITE_BEHIND)
 
-def add(response_usage: types.GenerateContentResponseUsageMetadata | None):
+
+def database() -> Database:
+    """Returns the database where usage stats are recorded."""
+    return _db
+
+
+def add(
+    response_usage: "types.GenerateContentResponseUsageMetadata | None",
+    conversation_id: int | None = None,
+    iteration: int | None = None,
+    model_id: str | None = None,
+    latency_seconds: float | None = None,
+):
     if response_usage is None:
         return
 
     record = Record(
-        # TODO implement
-        conversation_id=None,
+        conversation_id=conversation_id,
+        iteration=iteration,
+        model_id=model_id,
+        latency_us=round(latency_seconds * 1_000_000) if latency_seconds is not None else None,
         tokens_prompt=response_usage.prompt_token_count or 0,
         tokens_candidates=response_usage.candidates_token_count or 0,
         tokens_total=response_usage.total_token_count or 0,
@@ -106,6 +443,21 @@ def add(response_usage: types.GenerateContentResponseUsageMetadata | None):
     _db.add(record)
 
 
+async def add_async(response_usage: "types.GenerateContentResponseUsageMetadata | None", *args, **kwargs):
+    """Same as `add`, but the database write happens in a worker thread
+    so that it doesn't block the event loop."""
+    import asyncio
+    await asyncio.to_thread(add, response_usage, *args, **kwargs)
+
+
+def add_tool_calls(tool_calls: list[ToolCall], conversation_id: int | None = None, iteration: int | None = None):
+    """Records the function calls executed for the request of the given iteration."""
+    _db.add_tool_calls([
+        dataclasses.replace(tool_call, conversation_id=conversation_id, iteration=iteration)
+        for tool_call in tool_calls
+    ])
+
+
 def print_usage():
     tok_24h = _db.tokens_last_24h()
     req_24h = _db.requests_last_24h()
@@ -121,3 +473,36 @@ def print_usage():
     print(f"Tokens 24h:      {percent(tok_24h, config.STATS_MAX_TOKENS_PER_DAY)}    {tok_24h} / {config.STATS_MAX_TOKENS_PER_DAY}")
     print(f"Requests 24h:    {percent(req_24h, config.STATS_MAX_REQUESTS_PER_DAY)}    {req_24h} / {config.STATS_MAX_REQUESTS_PER_DAY}")
     print(f"Requests 60s:    {percent(req_60s, config.STATS_MAX_REQUESTS_PER_MINUTE)}    {req_60s} / {config.STATS_MAX_REQUESTS_PER_MINUTE}")
+
+    conversations = _db.conversation_costs(config.STATS_REPORT_ROWS)
+    if conversations:
+        print("\nMost expensive conversations:")
+        print("     id  requests   prompt tok  response tok     cost $   model s  tool calls   tools s")
+        for conversation_id, requests, prompt_tokens, response_tokens, latency_us, tool_calls, tools_us in conversations:
+            print(
+                f"{conversation_id:>7}  {requests:>8}  {prompt_tokens:>11}  {response_tokens:>12}"
+                f"  {cost(prompt_tokens, response_tokens):>9.4f}  {latency_us / 1e6:>8.1f}  {tool_calls:>10}  {tools_us / 1e6:>8.1f}"
+            )
+
+    tools = _db.slowest_tools(config.STATS_REPORT_ROWS)
+    if tools:
+        print("\nSlowest tools:")
+        print("function                calls    avg ms    max ms   avg bytes")
+        for function, calls, average_us, max_us, average_bytes in tools:
+            print(f"{function:<20}  {calls:>7}  {average_us / 1e3:>8.1f}  {max_us / 1e3:>8.1f}  {average_bytes:>10.0f}")
+
+    iterations = _db.tokens_per_iteration(config.STATS_REPORT_ROWS)
+    if iterations:
+        print("\nTokens per iteration:")
+        largest = max(average for _, _, average in iterations)
+        for iteration, requests, average in iterations:
+            bar = "#" * round(40 * average / largest) if largest else ""
+            print(f"{iteration:>4}  {average:>9.0f}  {bar:<40}  ({requests} requests)")
+
+
+def cost(prompt_tokens: int, response_tokens: int) -> float:
+    """Returns the price in USD of the given tokens, with the prices in `config`."""
+    return (
+        prompt_tokens * config.STATS_PRICE_PER_MILLION_PROMPT_TOKENS
+        + response_tokens * config.STATS_PRICE_PER_MILLION_RESPONSE_TOKENS
+    ) / 1_000_000
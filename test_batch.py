@@ -0,0 +1,110 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from google.genai import types
+
+import agent
+import batch
+from stats import add
+
+
+class _FakeModels:
+    """Answers each prompt with a text response, or fails if the prompt is "fail"."""
+
+    def __init__(self) -> None:
+        self.prompts: list[str] = []
+        self.lock = threading.Lock()
+
+    def generate_content(self, model, contents, config):
+        prompt = contents[0].parts[0].text
+        with self.lock:
+            self.prompts.append(prompt)
+        if prompt == "fail":
+            raise ValueError("something went wrong")
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=f"Answer to: {prompt}")]))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=10, candidates_token_count=5, total_token_count=15,
+            ),
+        )
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(agent, "RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(agent.stats, "add", lambda response_usage, *args: None)
+    # Conversations are saved in the sessions directory, relative to the current one
+    monkeypatch.chdir(tmp_path)
+    return SimpleNamespace(models=_FakeModels())
+
+
+def _write_prompts(path, prompts: list[dict]) -> None:
+    path.write_text("".join(json.dumps(prompt) + "\n" for prompt in prompts))
+
+
+def _read_results(path) -> dict[str, dict]:
+    return {result["id"]: result for result in map(json.loads, path.read_text().splitlines())}
+
+
+def test_batch(tmp_path, client):
+    input_path, output_path = tmp_path / "prompts.jsonl", tmp_path / "results.jsonl"
+    _write_prompts(input_path, [{"id": "a", "prompt": "first"}, {"prompt": "second"}, {"id": "c", "prompt": "fail"}])
+
+    counts = batch.run_batch(str(input_path), str(output_path), "fake_api_key", concurrency=2, client=client)
+    assert counts == {"ok": 2, "error": 1, "skipped": 0}
+
+    results = _read_results(output_path)
+    assert results["a"]["response"] == "Answer to: first"
+    assert results["a"]["iterations"] == 1
+    assert results["a"]["total_tokens"] == 15
+    assert results["a"]["wall_time_seconds"] >= 0
+    # Default id is the line number
+    assert results["2"]["response"] == "Answer to: second"
+    assert results["c"]["status"] == "error"
+    assert "something went wrong" in results["c"]["error"]
+
+
+def test_conversations_are_recorded(tmp_path, client, monkeypatch):
+    db = agent.stats.Database(str(tmp_path / "stats.db"))
+    monkeypatch.setattr(agent.stats, "_db", db)
+    monkeypatch.setattr(agent.stats, "add", add)
+    input_path, output_path = tmp_path / "prompts.jsonl", tmp_path / "results.jsonl"
+    _write_prompts(input_path, [{"id": "a", "prompt": "first"}, {"id": "b", "prompt": "second"}])
+
+    batch.run_batch(str(input_path), str(output_path), "fake_api_key", client=client)
+    results = _read_results(output_path)
+    assert sorted(result["conversation_id"] for result in results.values()) == [1, 2]
+    # Each prompt has its own row in the per-conversation report
+    assert sorted(row[0] for row in db.conversation_costs(10)) == [1, 2]
+    db.close()
+
+
+def test_resume(tmp_path, client):
+    input_path, output_path = tmp_path / "prompts.jsonl", tmp_path / "results.jsonl"
+    _write_prompts(input_path, [{"id": "a", "prompt": "first"}, {"id": "b", "prompt": "second"}, {"id": "c", "prompt": "third"}])
+    # A crash left a failed prompt and an incomplete line
+    output_path.write_text(
+        json.dumps({"id": "a", "status": "ok", "response": "Answer to: first"}) + "\n"
+        + json.dumps({"id": "b", "status": "error", "error": "crash"}) + "\n"
+        + '{"id": "c", "sta'
+    )
+
+    counts = batch.run_batch(str(input_path), str(output_path), "fake_api_key", client=client)
+    assert counts == {"ok": 2, "error": 0, "skipped": 1}
+    assert sorted(client.models.prompts) == ["second", "third"]
+    assert batch.completed_ids(str(output_path)) == {"a", "b", "c"}
+
+    assert batch.run_batch(str(input_path), str(output_path), "fake_api_key", client=client)["skipped"] == 3
+
+
+def test_invalid_input(tmp_path):
+    input_path = tmp_path / "prompts.jsonl"
+    _write_prompts(input_path, [{"id": "a", "prompt": "first"}, {"id": "a", "prompt": "second"}])
+    with pytest.raises(ValueError, match="Duplicate prompt id"):
+        batch.read_prompts(str(input_path))
+
+    input_path.write_text('{"id": "a"}\n')
+    with pytest.raises(ValueError, match="line 1"):
+        batch.read_prompts(str(input_path))
@@ -0,0 +1,235 @@
+import asyncio
+import os
+from google.genai import types
+
+from config import WORKING_DIRECTORY
+import call_function as call_function_module
+from functions import code_index
+from call_function import (
+    call_function,
+    call_functions,
+    call_functions_async,
+    tool_cache,
+    FunctionCallDispatcher,
+    ResultDeduplicator,
+    ToolResultCache,
+)
+
+
+def _call(name: str, **args) -> types.FunctionCall:
+    return types.FunctionCall(name=name, args=args)
+
+
+def _result(content: types.Content):
+    return content.parts[0].function_response.response # type: ignore
+
+
+class TestCallFunction:
+    def test_known_function(self):
+        result = call_function(_call("get_file_content", file_path="main.py"))
+        assert result.role == "tool"
+        assert "sys.argv" in _result(result)["result"]
+
+    def test_unknown_function(self):
+        result = call_function(_call("rm_rf"))
+        assert _result(result) == {"error": "Unknown function: rm_rf"}
+
+    def test_executed_calls(self):
+        executed_calls = []
+        tool_cache.clear()
+        call_function(_call("get_file_content", file_path="main.py"), executed_calls=executed_calls)
+        call_function(_call("get_file_content", file_path="main.py"), executed_calls=executed_calls)
+        call_function(_call("rm_rf"), executed_calls=executed_calls)
+        first, cached, unknown = executed_calls
+        assert first.function == "get_file_content" and not first.cached and not first.error
+        assert first.result_bytes == len(_result(call_function(_call("get_file_content", file_path="main.py")))["result"].encode())
+        assert first.duration_us > 0
+        assert cached.cached and cached.result_bytes == first.result_bytes
+        assert unknown.function == "rm_rf" and unknown.error
+
+
+class TestCallFunctions:
+    file_path = "__test_dispatch_file"
+
+    def _remove_test_file(self):
+        abspath = os.path.join(WORKING_DIRECTORY, self.file_path)
+        if os.path.exists(abspath):
+            os.remove(abspath)
+
+    def test_results_keep_call_order(self):
+        calls = [
+            _call("run_python_file", file_path="main.py", args=["1 + 1"]),
+            _call("get_file_content", file_path="main.py"),
+            _call("run_python_file", file_path="main.py", args=["2 * 3"]),
+            _call("get_files_info", directory="pkg"),
+        ]
+        results = call_functions(calls)
+        assert [r.parts[0].function_response.name for r in results] == [c.name for c in calls] # type: ignore
+        assert " 2 " in _result(results[0])["result"]
+        assert " 6 " in _result(results[2])["result"]
+        assert "render.py" in _result(results[3])["result"]
+
+    def test_writes_are_sequential(self):
+        self._remove_test_file()
+        calls = [
+            _call("get_file_content", file_path=self.file_path),
+            _call("write_file", file_path=self.file_path, content="first"),
+            _call("get_file_content", file_path=self.file_path),
+            _call("write_file", file_path=self.file_path, content="second"),
+            _call("get_file_content", file_path=self.file_path),
+        ]
+        try:
+            results = [_result(r)["result"] for r in call_functions(calls)]
+        finally:
+            self._remove_test_file()
+        assert results[0].startswith("Error: File not found")
+        assert results[2] == "first"
+        assert results[4] == "second"
+
+    def test_write_updates_code_index(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(code_index, "CODE_INDEX_DB_NAME", str(tmp_path / "index.db"))
+        monkeypatch.setattr(code_index, "CODE_INDEX_REFRESH_SECONDS", 3600)
+        monkeypatch.setattr(code_index, "_indexes", {})
+        self._remove_test_file()
+        try:
+            search = _call("search_code", pattern="unique_marker_name")
+            assert _result(call_function(search))["result"] == 'No matches for "unique_marker_name"'
+            call_function(_call("write_file", file_path=self.file_path, content="unique_marker_name = 1"))
+            assert _result(call_function(search))["result"] == f"{self.file_path}:1: unique_marker_name = 1"
+        finally:
+            self._remove_test_file()
+
+    def test_async_results_keep_call_order(self):
+        self._remove_test_file()
+        calls = [
+            _call("run_python_file", file_path="main.py", args=["2 * 3"]),
+            _call("write_file", file_path=self.file_path, content="first"),
+            _call("get_file_content", file_path=self.file_path),
+            _call("run_python_file", file_path="main.py", args=["1 + 1"]),
+        ]
+        try:
+            results = [_result(r)["result"] for r in asyncio.run(call_functions_async(calls))]
+        finally:
+            self._remove_test_file()
+        assert " 6 " in results[0]
+        assert results[1].startswith("Successfully wrote")
+        assert results[2] == "first"
+        assert " 2 " in results[3]
+
+
+class TestResultDeduplicator:
+    file_path = "__test_dedup_file"
+
+    def setup_method(self):
+        with open(os.path.join(WORKING_DIRECTORY, self.file_path), "w") as f:
+            f.write("x" * 1000)
+
+    def teardown_method(self):
+        os.remove(os.path.join(WORKING_DIRECTORY, self.file_path))
+
+    def _dispatch(self, deduplicator: ResultDeduplicator, *calls: types.FunctionCall) -> tuple[list[str], list]:
+        dispatcher = FunctionCallDispatcher(deduplicator=deduplicator)
+        for call in calls:
+            dispatcher.submit(call)
+        return [_result(content)["result"] for content in dispatcher.results()], dispatcher.executed_calls
+
+    def test_repeated_result_is_a_reference(self):
+        deduplicator = ResultDeduplicator(previous_calls=2)
+        read = _call("get_file_content", file_path=self.file_path)
+        (first, listing), _ = self._dispatch(deduplicator, read, _call("get_files_info"))
+        assert first == "x" * 1000
+        (second, other_listing), executed_calls = self._dispatch(deduplicator, read, _call("get_files_info"))
+        # Numbered after the calls already in the conversation
+        assert second.startswith("[Unchanged] Identical to the result of call #3 ")
+        assert other_listing.startswith("[Unchanged] Identical to the result of call #4 ")
+        assert executed_calls[0].result_bytes == len(second)
+
+    def test_changed_file_is_sent_again(self):
+        deduplicator = ResultDeduplicator()
+        read = _call("get_file_content", file_path=self.file_path)
+        write = _call("write_file", file_path=self.file_path, content="y" * 1000)
+        results, _ = self._dispatch(deduplicator, read, write, read, read)
+        assert results[2] == "y" * 1000
+        assert results[3].startswith("[Unchanged] Identical to the result of call #3 ")
+
+    def test_scripts_and_short_results_are_not_replaced(self):
+        deduplicator = ResultDeduplicator()
+        run = _call("run_python_file", file_path="main.py", args=["1 + 1"])
+        missing = _call("get_file_content", file_path="missing.py")
+        results, _ = self._dispatch(deduplicator, run, missing, run, missing)
+        assert results[0] == results[2]
+        assert results[1] == results[3]
+
+    def test_async(self):
+        deduplicator = ResultDeduplicator()
+        read = _call("get_file_content", file_path=self.file_path)
+        executed_calls = []
+        results = asyncio.run(call_functions_async([read, read], executed_calls=executed_calls, deduplicator=deduplicator))
+        assert _result(results[1])["result"].startswith("[Unchanged] Identical to the result of call #1 ")
+        assert [tool_call.result_bytes for tool_call in executed_calls] == [1000, len(_result(results[1])["result"])]
+
+
+class TestToolResultCache:
+    file_path = "__test_cache_file"
+
+    def _abspath(self):
+        return os.path.join(WORKING_DIRECTORY, self.file_path)
+
+    def setup_method(self):
+        tool_cache.clear()
+        with open(self._abspath(), "w") as f:
+            f.write("cached content")
+
+    def teardown_method(self):
+        tool_cache.clear()
+        if os.path.exists(self._abspath()):
+            os.remove(self._abspath())
+
+    def test_repeated_read_is_cached(self, monkeypatch):
+        first = _result(call_function(_call("get_file_content", file_path=self.file_path)))
+        monkeypatch.setattr(call_function_module, "get_file_content", _fail)
+        second = _result(call_function(_call("get_file_content", file_path=self.file_path)))
+        assert first == second == {"result": "cached content"}
+
+    def test_write_invalidates(self):
+        call_function(_call("get_files_info"))
+        call_function(_call("get_file_content", file_path=self.file_path))
+        assert len(tool_cache) == 2
+        call_function(_call("write_file", file_path=self.file_path, content="new content"))
+        assert len(tool_cache) == 0
+        result = _result(call_function(_call("get_file_content", file_path=self.file_path)))
+        assert result == {"result": "new content"}
+
+    def test_external_change_is_detected(self):
+        call_function(_call("get_file_content", file_path=self.file_path))
+        with open(self._abspath(), "w") as f:
+            f.write("changed by someone else")
+        result = _result(call_function(_call("get_file_content", file_path=self.file_path)))
+        assert result == {"result": "changed by someone else"}
+
+    def test_errors_are_not_cached(self):
+        call_function(_call("get_file_content", file_path="fake_file"))
+        assert len(tool_cache) == 0
+
+    def test_lru_eviction(self):
+        cache = ToolResultCache(WORKING_DIRECTORY, max_entries=2, max_characters=1000)
+        keys = [cache.key("get_file_content", {"file_path": path}) for path in ("main.py", "tests.py", "pkg/render.py")]
+        cache.put(keys[0], "a")
+        cache.put(keys[1], "b")
+        cache.get(keys[0])
+        cache.put(keys[2], "c")
+        assert cache.get(keys[0]) == "a"
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) == "c"
+
+    def test_size_bound(self):
+        cache = ToolResultCache(WORKING_DIRECTORY, max_entries=10, max_characters=5)
+        keys = [cache.key("get_file_content", {"file_path": path}) for path in ("main.py", "tests.py")]
+        cache.put(keys[0], "abc")
+        cache.put(keys[1], "def")
+        assert len(cache) == 1
+        assert cache.get(keys[1]) == "def"
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError("the cached result should have been used")
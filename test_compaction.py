@@ -0,0 +1,172 @@
+from google.genai import types
+
+import tokens
+from compaction import COMPACTED_PREFIX, ContextCompactor, back_reference, tool_exchanges
+
+
+def _turn(*calls: tuple[str, dict, str]) -> list[types.Content]:
+    """A model message with the given function calls, followed by their results."""
+    messages = [types.Content(role="model", parts=[
+        types.Part(function_call=types.FunctionCall(name=name, args=args)) for name, args, _ in calls
+    ])]
+    for name, _, result in calls:
+        messages.append(types.Content(role="user", parts=[
+            types.Part.from_function_response(name=name, response={"result": result}),
+        ]))
+    return messages
+
+
+def _conversation(*turns: list[types.Content]) -> list[types.Content]:
+    messages = [types.Content(role="user", parts=[types.Part(text="fix the bug")])]
+    for turn in turns:
+        messages += turn
+    return messages
+
+
+def _results(messages: list[types.Content]) -> list[str]:
+    return [exchange.response(messages)["result"] for exchange in tool_exchanges(messages)]
+
+
+def _compact(messages: list[types.Content], token_budget=1_000_000) -> list[types.Content]:
+    return ContextCompactor(token_budget=token_budget).compact(messages)
+
+
+def test_superseded_read():
+    messages = _conversation(
+        _turn(("get_file_content", {"file_path": "main.py"}, "old content")),
+        _turn(("get_file_content", {"file_path": "./main.py"}, "new content")),
+    )
+    results = _results(_compact(messages))
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert results[1] == "new content"
+
+
+def test_write_supersedes_read_and_read_supersedes_write():
+    messages = _conversation(
+        _turn(("get_file_content", {"file_path": "main.py"}, "old content")),
+        _turn(("write_file", {"file_path": "main.py", "content": "x" * 1000}, "Successfully wrote")),
+        _turn(("get_file_content", {"file_path": "main.py"}, "x" * 1000)),
+    )
+    compacted = _compact(messages)
+    results = _results(compacted)
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert results[2] == "x" * 1000
+    write_call = compacted[3].parts[0].function_call # type: ignore
+    assert write_call.args["content"].startswith(COMPACTED_PREFIX) # type: ignore
+
+
+def test_patch_supersedes_read_and_read_supersedes_patch():
+    patch = "<<<<<<< SEARCH\nold\n=======\nnew\n>>>>>>> REPLACE\n"
+    messages = _conversation(
+        _turn(("get_file_content", {"file_path": "main.py"}, "old content")),
+        _turn(("apply_patch", {"file_path": "main.py", "patch": patch}, "Successfully patched")),
+        _turn(("get_file_content", {"file_path": "main.py"}, "new content")),
+    )
+    compacted = _compact(messages)
+    results = _results(compacted)
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert results[2] == "new content"
+    patch_call = compacted[3].parts[0].function_call # type: ignore
+    assert patch_call.args["patch"].startswith(COMPACTED_PREFIX) # type: ignore
+
+
+def test_superseded_listing():
+    messages = _conversation(
+        _turn(("get_files_info", {}, "- main.py")),
+        _turn(("get_files_info", {"directory": "pkg"}, "- render.py")),
+        _turn(("get_files_info", {"directory": "."}, "- main.py\n- tests.py")),
+    )
+    results = _results(_compact(messages))
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert results[1] == "- render.py"
+    assert results[2] == "- main.py\n- tests.py"
+
+
+def test_superseded_recursive_listing():
+    messages = _conversation(
+        _turn(("get_files_info", {"recursive": True}, "- pkg\n- pkg/render.py")),
+        _turn(("get_files_info", {}, "- pkg")),
+        _turn(("write_file", {"file_path": "pkg/new.py", "content": "x"}, "Successfully wrote")),
+        _turn(("get_files_info", {"directory": "pkg"}, "- render.py")),
+    )
+    results = _results(_compact(messages))
+    # A write in a subdirectory makes the recursive listing outdated, but not the other one
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert results[1] == "- pkg"
+    assert results[3] == "- render.py"
+
+
+def test_back_reference_does_not_supersede():
+    messages = _conversation(
+        _turn(("get_file_content", {"file_path": "main.py"}, "content")),
+        _turn(("get_file_content", {"file_path": "main.py"}, back_reference(1, "get_file_content"))),
+        _turn(("get_files_info", {}, "- main.py")),
+        _turn(("get_files_info", {}, back_reference(3, "get_files_info"))),
+    )
+    assert _results(_compact(messages)) == _results(messages)
+
+
+def test_referenced_result_is_restored():
+    messages = _conversation(
+        _turn(("get_file_content", {"file_path": "a.py"}, "a" * 4000)),
+        _turn(("get_file_content", {"file_path": "b.py"}, "b" * 4000)),
+        _turn(("get_file_content", {"file_path": "a.py"}, back_reference(1, "get_file_content"))),
+        _turn(("get_files_info", {}, "- a.py")),
+    )
+    # Omitted for the budget, the content takes the place of the reference
+    results = _results(_compact(messages, token_budget=1_500))
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert results[2] == "a" * 4000
+
+
+def test_old_outputs_are_truncated():
+    long_output = "STDOUT: " + "a" * 10_000
+    messages = _conversation(
+        _turn(("run_python_file", {"file_path": "tests.py"}, long_output)),
+        _turn(("run_python_file", {"file_path": "tests.py"}, long_output)),
+    )
+    results = _results(_compact(messages))
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert "STDOUT: aaa" in results[0]
+    assert len(results[0]) < 3_000
+    assert results[1] == long_output
+
+
+def test_token_budget_compacts_oldest_first():
+    messages = _conversation(
+        _turn(("get_file_content", {"file_path": "a.py"}, "a" * 4000)),
+        _turn(("get_file_content", {"file_path": "b.py"}, "b" * 4000)),
+        _turn(("get_file_content", {"file_path": "c.py"}, "c" * 4000)),
+    )
+    compacted = _compact(messages, token_budget=2_500)
+    results = _results(compacted)
+    assert results[0].startswith(COMPACTED_PREFIX)
+    assert results[1] == "b" * 4000
+    assert results[2] == "c" * 4000
+    assert tokens.estimate_tokens(compacted) <= 2_500
+
+
+def test_recent_results_are_never_compacted():
+    messages = _conversation(
+        _turn(("get_file_content", {"file_path": "a.py"}, "a" * 4000)),
+    )
+    assert _results(_compact(messages, token_budget=10)) == ["a" * 4000]
+
+
+def test_pairing_and_original_messages_are_preserved():
+    messages = _conversation(
+        _turn(
+            ("get_files_info", {}, "- main.py"),
+            ("get_file_content", {"file_path": "main.py"}, "old content"),
+        ),
+        _turn(
+            ("get_files_info", {}, "- main.py"),
+            ("get_file_content", {"file_path": "main.py"}, "new content"),
+        ),
+    )
+    original = [message.model_dump() for message in messages]
+    compacted = _compact(messages)
+    assert [message.model_dump() for message in messages] == original
+    assert len(compacted) == len(messages)
+    for before, after in zip(tool_exchanges(messages), tool_exchanges(compacted)):
+        assert (before.name, before.message_index, before.part_index) == (after.name, after.message_index, after.part_index)
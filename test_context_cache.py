@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from google.genai import types
+
+import agent
+import call_function
+from context_cache import ContextCache
+
+
+class FakeCaches:
+    """Local stand-in for the `client.caches` API."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created: list[types.CreateCachedContentConfig] = []
+        self.updated: list[str] = []
+        self.deleted: list[str] = []
+        self.ttl_seconds = 600
+
+    def create(self, *, model, config):
+        if self.fail:
+            raise RuntimeError("Cached content is too small")
+        self.created.append(config)
+        return self._cached_content(f"cachedContents/{len(self.created)}")
+
+    def update(self, *, name, config):
+        self.updated.append(name)
+        return self._cached_content(name)
+
+    def delete(self, *, name):
+        self.deleted.append(name)
+
+    def _cached_content(self, name):
+        expire_time = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        return types.CachedContent(name=name, expire_time=expire_time)
+
+
+def _cache(fake: FakeCaches, **kwargs) -> ContextCache:
+    return ContextCache(SimpleNamespace(caches=fake), **kwargs) # type: ignore
+
+
+def _messages(count: int) -> list[types.Content]:
+    return [types.Content(role="user", parts=[types.Part(text=f"message {i}")]) for i in range(count)]
+
+
+def test_cache_is_reused():
+    fake = FakeCaches()
+    cache = _cache(fake)
+    for count in (1, 3, 5):
+        config, contents = cache.request(_messages(count))
+        assert config.cached_content == "cachedContents/1"
+        assert config.tools is None and config.system_instruction is None
+        assert len(contents) == count
+    assert len(fake.created) == 1
+    assert fake.created[0].system_instruction == call_function.system_prompt
+
+
+def test_ttl_is_extended_before_expiring():
+    fake = FakeCaches()
+    fake.ttl_seconds = 10
+    cache = _cache(fake)
+    cache.request(_messages(1))
+    cache.request(_messages(2))
+    assert fake.updated == ["cachedContents/1"]
+    assert len(fake.created) == 1
+
+
+def test_schema_change_recreates_cache(monkeypatch):
+    fake = FakeCaches()
+    cache = _cache(fake)
+    cache.request(_messages(1))
+    new_tool = types.Tool(function_declarations=call_function.available_functions.function_declarations[:1])
+    monkeypatch.setattr(call_function, "available_functions", new_tool)
+    config, _ = cache.request(_messages(1))
+    assert config.cached_content == "cachedContents/2"
+    assert fake.created[1].tools == [new_tool]
+    assert fake.deleted == ["cachedContents/1"]
+
+
+def test_prefix_messages_are_cached():
+    fake = FakeCaches()
+    cache = _cache(fake, prefix_messages=1)
+    messages = _messages(3)
+    _, contents = cache.request(messages)
+    assert contents == messages[1:]
+    assert fake.created[0].contents == messages[:1]
+    # Same prefix, no new cache
+    cache.request(_messages(5))
+    assert len(fake.created) == 1
+
+
+def test_failure_falls_back_to_full_request():
+    fake = FakeCaches(fail=True)
+    cache = _cache(fake)
+    messages = _messages(2)
+    config, contents = cache.request(messages)
+    assert config.cached_content is None
+    assert config.system_instruction == call_function.system_prompt
+    assert contents == messages
+    # Not retried right away
+    fake.fail = False
+    config, _ = cache.request(messages)
+    assert config.cached_content is None
+    assert fake.created == []
+
+
+class FakeModels:
+    """Answers every request right away, keeping the config it was sent with."""
+
+    def __init__(self):
+        self.configs: list[types.GenerateContentConfig] = []
+
+    def generate_content(self, model, contents, config):
+        self.configs.append(config)
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text="Done")]))],
+        )
+
+
+def test_cache_is_shared_by_sessions(monkeypatch):
+    monkeypatch.setattr(agent, "CONTEXT_CACHE_ENABLED", True)
+    monkeypatch.setattr(agent, "RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(agent.stats, "add", lambda response_usage, *args: None)
+    monkeypatch.setattr(agent.stats, "add_tool_calls", lambda *args: None)
+    fake = FakeCaches()
+    client = SimpleNamespace(caches=fake, models=FakeModels())
+
+    for prompt in ("first session", "second session"):
+        assert agent.agent_request(prompt, "fake_api_key", False, client=client) == "Done" # type: ignore
+    assert [config.cached_content for config in client.models.configs] == ["cachedContents/1", "cachedContents/1"]
+    assert len(fake.created) == 1
+
+    agent.close_context_caches()
+    assert fake.deleted == ["cachedContents/1"]
+    assert agent._context_caches == {}
+
+
+def test_cached_content_per_prefix():
+    fake = FakeCaches()
+    cache = _cache(fake, prefix_messages=1, max_cached_contents=2)
+    first, second, third = ([types.Content(role="user", parts=[types.Part(text=f"prompt {i}")])] + _messages(2) for i in range(3))
+    # Two conversations, each keeps its own cached content
+    for messages in (first, second, first, second):
+        cache.request(messages)
+    assert len(fake.created) == 2
+    # The least recently used is deleted beyond the limit
+    cache.request(third)
+    assert fake.deleted == ["cachedContents/1"]
+    cache.close()
+    assert fake.deleted == ["cachedContents/1", "cachedContents/2", "cachedContents/3"]
@@ -0,0 +1,66 @@
+import sys
+import threading
+
+import pytest
+from google.genai import types
+
+import daemon
+from call_function import call_functions
+
+
+def _fake_agent_request(prompt: str, api_key: str, verbose: bool, stream=False, client=None, session=None) -> str:
+    if session is None:
+        raise ValueError("missing session")
+    if prompt == "fail":
+        raise ValueError("something went wrong")
+    print(f"User prompt: {prompt}")
+    # Printed from a worker thread
+    call_functions([types.FunctionCall(name="get_files_info", args={"directory": "pkg"})])
+    return f"Answer to: {prompt}"
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "agent.sock")
+    monkeypatch.setattr(sys, "stdout", daemon._ContextStdout(sys.stdout))
+    server = daemon._AgentServer(path, "fake_api_key", _fake_agent_request, sessions_directory=str(tmp_path / "sessions"))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_prompt_and_output_are_forwarded(socket_path, capsys):
+    result = daemon.send_prompt("hello", verbose=False, socket_path=socket_path)
+    assert result == "Answer to: hello"
+    output = capsys.readouterr().out
+    assert "User prompt: hello\n" in output
+    assert " - Calling function: get_files_info\n" in output
+
+
+def test_concurrent_prompts(socket_path, tmp_path):
+    results = {}
+
+    def send(prompt):
+        results[prompt] = daemon.send_prompt(prompt, verbose=False, socket_path=socket_path)
+
+    threads = [threading.Thread(target=send, args=(f"prompt {i}",)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {f"prompt {i}": f"Answer to: prompt {i}" for i in range(5)}
+    # Each prompt is a conversation of its own
+    assert sorted(path.name for path in (tmp_path / "sessions").iterdir()) == [f"{i}.jsonl" for i in range(1, 6)]
+
+
+def test_error_is_forwarded(socket_path):
+    with pytest.raises(Exception, match="something went wrong"):
+        daemon.send_prompt("fail", verbose=False, socket_path=socket_path)
+
+
+def test_daemon_not_running(tmp_path):
+    with pytest.raises(ConnectionError, match="main.py serve"):
+        daemon.send_prompt("hello", verbose=False, socket_path=str(tmp_path / "missing.sock"))
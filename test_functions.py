@@ -1,8 +1,18 @@
+import asyncio
 import os
+import re
+
+import pytest
+
+from functions import apply_patch as apply_patch_module, code_index, get_file_content as get_file_content_module, get_symbols as get_symbols_module, process_output, python_pool, run_python
 from functions.get_files_info import get_files_info
+from functions.gitignore import IgnoreRules
 from functions.get_file_content import get_file_content
-from functions.write_file import write_file
-from functions.run_python import run_python_file
+from functions.write_file import write_file, write_atomically
+from functions.apply_patch import apply_patch
+from functions.run_python import run_python_file, run_python_file_async
+from functions.get_symbols import get_symbols
+from functions.search_code import search_code
 
 
 class TestGetFilesInfo:
@@ -38,6 +48,68 @@ class TestGetFilesInfo:
         expected = "Error: Cannot list \"../\" as it is outside the permitted working directory"
         assert result == expected
 
+    @pytest.fixture
+    def tree(self, tmp_path):
+        (tmp_path / ".gitignore").write_text("# Build outputs\n*.log\nbuild/\n/notes.txt\n!keep.log\n")
+        (tmp_path / "notes.txt").write_text("ignored")
+        (tmp_path / "main.py").write_text("print()")
+        (tmp_path / "keep.log").write_text("kept")
+        (tmp_path / "debug.log").write_text("ignored")
+        (tmp_path / "build").mkdir()
+        (tmp_path / "build" / "out.bin").write_text("ignored")
+        (tmp_path / "src" / "pkg" / "__pycache__").mkdir(parents=True)
+        (tmp_path / "src" / ".gitignore").write_text("generated_*.py\n")
+        (tmp_path / "src" / "app.py").write_text("print('app')")
+        (tmp_path / "src" / "generated_parser.py").write_text("ignored")
+        (tmp_path / "src" / "notes.txt").write_text("not anchored to src")
+        (tmp_path / "src" / "pkg" / "b.py").write_text("b")
+        (tmp_path / "src" / "pkg" / "a.log").write_text("ignored")
+        return tmp_path
+
+    @staticmethod
+    def _paths(result):
+        return [line.split(":")[0][2:] for line in result.splitlines()]
+
+    def test_gitignore(self, tree):
+        assert self._paths(get_files_info(str(tree))) == ["src", ".gitignore", "keep.log", "main.py"]
+        assert self._paths(get_files_info(str(tree), "build")) == ["out.bin"]
+
+    def test_recursive(self, tree):
+        result = get_files_info(str(tree), recursive=True)
+        assert self._paths(result) == [
+            "src", "src/pkg", "src/pkg/b.py", "src/.gitignore", "src/app.py", "src/notes.txt",
+            ".gitignore", "keep.log", "main.py",
+        ]
+        assert "- src/app.py: file_size=12 bytes, is_dir=False" in result.splitlines()
+        assert self._paths(get_files_info(str(tree), "src", recursive=True)) == ["pkg", "pkg/b.py", ".gitignore", "app.py", "notes.txt"]
+
+    def test_max_depth(self, tree):
+        assert self._paths(get_files_info(str(tree), max_depth=2)) == [
+            "src", "src/pkg", "src/.gitignore", "src/app.py", "src/notes.txt", ".gitignore", "keep.log", "main.py",
+        ]
+
+    def test_max_entries(self, tree):
+        result = get_files_info(str(tree), recursive=True, max_entries=4)
+        # The shallowest entries are kept
+        assert self._paths(result)[:-1] == ["src", ".gitignore", "keep.log", "main.py"]
+        assert result.splitlines()[-1].startswith("[...Listing truncated at 4 entries")
+        assert get_files_info(str(tree), max_entries=0) == "Error: max_entries must be an integer not smaller than 1"
+
+    def test_gitignore_wildcards(self):
+        rules = IgnoreRules().extend(["docs/**/*.md", "**/tmp", "a?c", "[!x]y", "\\#hash", "dist/**"], "")
+        assert rules.ignored("docs/index.md", False)
+        assert rules.ignored("docs/api/v1/index.md", False)
+        assert not rules.ignored("src/docs/index.md", False)
+        assert rules.ignored("tmp", True) and rules.ignored("src/deep/tmp", False)
+        assert rules.ignored("abc", False) and not rules.ignored("a/c", False)
+        assert rules.ignored("ay", False) and not rules.ignored("xy", False)
+        assert rules.ignored("#hash", False)
+        assert rules.ignored("dist/x/y", False) and not rules.ignored("dist", True)
+
+    def test_recursive_symlink_loop(self, tree):
+        os.symlink(tree / "src", tree / "src" / "pkg" / "loop")
+        assert "src/pkg/loop" in self._paths(get_files_info(str(tree), recursive=True))
+
     # TODO make this work
     # def test_nonexistent_working_directory(self):
     #     result = get_files_info("banana", ".")
@@ -78,6 +150,46 @@ class TestGetFileContent:
         expected = 'Error: Cannot read "../main.py" as it is outside the permitted working directory'
         assert result == expected
 
+    @pytest.fixture
+    def log_file(self, tmp_path):
+        (tmp_path / "app.log").write_text("".join(f"line {i}\n" for i in range(1, 1001)))
+        return tmp_path
+
+    def test_truncated_with_offset(self, log_file, monkeypatch):
+        monkeypatch.setattr(get_file_content_module, "MAX_LENGTH", 14)
+        result = get_file_content(str(log_file), "app.log")
+        assert result == 'line 1\nline 2\n[...File "app.log" truncated at 14 characters, 8879 more bytes: continue reading with offset=14]'
+        assert get_file_content(str(log_file), "app.log", offset=14).startswith("line 3\nline 4\n[...")
+
+    def test_offset_past_end(self, log_file):
+        assert get_file_content(str(log_file), "app.log", offset=10**9).startswith("Error: offset 1000000000 is past the end")
+
+    def test_offset_in_the_middle_of_a_character(self, tmp_path):
+        (tmp_path / "unicode.txt").write_text("é" * 10)
+        assert get_file_content(str(tmp_path), "unicode.txt", offset=3) == "é" * 8
+
+    def test_line_range(self, log_file):
+        assert get_file_content(str(log_file), "app.log", start_line=10, end_line=12) == "line 10\nline 11\nline 12\n"
+        assert get_file_content(str(log_file), "app.log", start_line=999) == "line 999\nline 1000\n"
+        assert get_file_content(str(log_file), "app.log", end_line=2) == "line 1\nline 2\n"
+        assert get_file_content(str(log_file), "app.log", start_line=999, end_line=5000) == "line 999\nline 1000\n"
+        assert get_file_content(str(log_file), "app.log", start_line=1001) == 'Error: "app.log" has fewer than 1001 lines'
+
+    def test_tail_lines(self, log_file, monkeypatch):
+        assert get_file_content(str(log_file), "app.log", tail_lines=2) == "line 999\nline 1000\n"
+        assert get_file_content(str(log_file), "app.log", tail_lines=5000).startswith("line 1\n")
+        monkeypatch.setattr(get_file_content_module, "MAX_LENGTH", 10)
+        assert get_file_content(str(log_file), "app.log", tail_lines=5) == (
+            '[...File "app.log" truncated, showing its last 10 characters]\nline 1000\n'
+        )
+
+    def test_invalid_ranges(self, log_file):
+        assert get_file_content(str(log_file), "app.log", offset=-1) == "Error: offset must be an integer not smaller than 0"
+        assert get_file_content(str(log_file), "app.log", offset=1, tail_lines=1).startswith("Error: specify only one of")
+        assert get_file_content(str(log_file), "app.log", start_line=5, end_line=4).startswith("Error: end_line must not")
+        # Numbers may be received as floats
+        assert get_file_content(str(log_file), "app.log", start_line=2.0, end_line=2.0) == "line 2\n"
+
     # TODO create a test TXT for this, needs to override the MAX_LENGTH
     # def test_truncated(self):
     #     # set MAX_LENGTH to 3
@@ -151,6 +263,326 @@ class TestWriteFile:
         assert result == expected
 
 
+class TestWriteAtomically:
+    def test_keeps_permissions_and_leaves_no_temporary_file(self, tmp_path):
+        path = tmp_path / "script.sh"
+        path.write_text("old")
+        path.chmod(0o750)
+        write_atomically(str(path), "new")
+        assert path.read_text() == "new"
+        assert path.stat().st_mode & 0o777 == 0o750
+        assert os.listdir(tmp_path) == ["script.sh"]
+
+    def test_writes_symlink_target(self, tmp_path):
+        (tmp_path / "target.txt").write_text("old")
+        (tmp_path / "link.txt").symlink_to("target.txt")
+        write_atomically(str(tmp_path / "link.txt"), "new")
+        assert (tmp_path / "link.txt").is_symlink()
+        assert (tmp_path / "target.txt").read_text() == "new"
+
+    def test_failed_write_keeps_old_content(self, tmp_path):
+        path = tmp_path / "data.txt"
+        path.write_text("old")
+        with pytest.raises(UnicodeEncodeError):
+            write_atomically(str(path), "invalid \udc80 surrogate")
+        assert path.read_text() == "old"
+        assert os.listdir(tmp_path) == ["data.txt"]
+
+
+class TestApplyPatch:
+    source = "def add(a, b):\n    return a + b\n\n\ndef sub(a, b):\n    return a - b\n"
+
+    @pytest.fixture
+    def project(self, tmp_path):
+        (tmp_path / "ops.py").write_text(self.source)
+        return tmp_path
+
+    def test_search_replace(self, project):
+        patch = (
+            "<<<<<<< SEARCH\n    return a + b\n=======\n    return sum((a, b))\n>>>>>>> REPLACE\n"
+            "<<<<<<< SEARCH\ndef sub(a, b):\n=======\ndef subtract(a, b):\n>>>>>>> REPLACE\n"
+        )
+        result = apply_patch(str(project), "ops.py", patch)
+        assert result.startswith('Successfully patched "ops.py" (2 changes')
+        assert (project / "ops.py").read_text() == self.source.replace("a + b", "sum((a, b))").replace("def sub", "def subtract")
+
+    def test_search_replace_errors(self, project):
+        not_found = "<<<<<<< SEARCH\n    return a * b\n=======\n    return 0\n>>>>>>> REPLACE\n"
+        assert "search block 1 was not found" in apply_patch(str(project), "ops.py", not_found)
+        ambiguous = (
+            "<<<<<<< SEARCH\n    return a + b\n=======\n    return b + a\n>>>>>>> REPLACE\n"
+            "<<<<<<< SEARCH\n(a, b):\n=======\n(x, y):\n>>>>>>> REPLACE\n"
+        )
+        result = apply_patch(str(project), "ops.py", ambiguous)
+        assert result == 'Error: cannot apply patch to "ops.py": search block 2 appears 2 times, include more lines to make it unique. The file was not modified'
+        # The first block matched, but nothing was written
+        assert (project / "ops.py").read_text() == self.source
+
+    def test_unified_diff(self, project):
+        patch = (
+            "--- a/ops.py\n"
+            "+++ b/ops.py\n"
+            "@@ -1,2 +1,3 @@\n"
+            " def add(a, b):\n"
+            "+    \"\"\"Adds.\"\"\"\n"
+            "     return a + b\n"
+            "@@ -5,2 +6,2 @@\n"
+            " def sub(a, b):\n"
+            "-    return a - b\n"
+            "+    return -(b - a)\n"
+        )
+        assert apply_patch(str(project), "ops.py", patch).startswith('Successfully patched "ops.py" (2 changes')
+        assert (project / "ops.py").read_text() == (
+            'def add(a, b):\n    """Adds."""\n    return a + b\n\n\ndef sub(a, b):\n    return -(b - a)\n'
+        )
+
+    def test_unified_diff_moved_lines_and_missing_final_newline(self, project):
+        (project / "ops.py").write_text("# header\n\n" + self.source.rstrip("\n"))
+        # Line numbers of the original file, 2 lines were added since
+        patch = "@@ -6,1 +6,1 @@\n-    return a - b\n+    return a - b - 0\n"
+        assert apply_patch(str(project), "ops.py", patch).startswith("Successfully patched")
+        assert (project / "ops.py").read_text().endswith("def sub(a, b):\n    return a - b - 0")
+
+    def test_unified_diff_insertion_after_changed_lines(self, project):
+        patch = (
+            "@@ -1,1 +1,3 @@\n"
+            " def add(a, b):\n"
+            "+    \"\"\"Adds.\n"
+            "+    \"\"\"\n"
+            "@@ -4,0 +7,1 @@\n"
+            "+# Subtraction\n"
+        )
+        assert apply_patch(str(project), "ops.py", patch).startswith('Successfully patched "ops.py" (2 changes')
+        assert (project / "ops.py").read_text() == (
+            'def add(a, b):\n    """Adds.\n    """\n    return a + b\n\n\n# Subtraction\ndef sub(a, b):\n    return a - b\n'
+        )
+
+    def test_unified_diff_errors(self, project):
+        patch = "@@ -1,2 +1,2 @@\n def add(a, b):\n-    return a * b\n+    return 0\n"
+        result = apply_patch(str(project), "ops.py", patch)
+        assert result.startswith('Error: cannot apply patch to "ops.py": hunk 1 does not match the current content near line 1')
+        two_files = "--- a/ops.py\n+++ b/ops.py\n@@ -1 +1 @@\n-x\n+y\n--- a/b.py\n+++ b/b.py\n@@ -1 +1 @@\n-x\n+y\n"
+        assert "modifies several files" in apply_patch(str(project), "ops.py", two_files)
+        assert apply_patch(str(project), "ops.py", "return 0").startswith("Error: the patch must be a unified diff")
+        assert apply_patch(str(project), "new.py", patch).startswith("Error: File not found")
+        assert apply_patch(str(project), "../ops.py", patch).startswith("Error: Cannot write to")
+        assert (project / "ops.py").read_text() == self.source
+
+    def test_metrics(self, project, monkeypatch):
+        metrics = apply_patch_module.PatchMetrics()
+        monkeypatch.setattr(apply_patch_module, "patch_metrics", metrics)
+        patch = "<<<<<<< SEARCH\na - b\n=======\nb - a\n>>>>>>> REPLACE\n"
+        apply_patch(str(project), "ops.py", patch)
+        assert metrics.patches == 1
+        assert metrics.rewrite_characters == len(self.source)
+        assert metrics.saved_tokens() == -(-(len(self.source) - len(patch)) // 4)
+        assert metrics.summary().startswith(f"1 patches, about {metrics.saved_tokens()} output tokens saved")
+
+
+class TestSearchCode:
+    @pytest.fixture(autouse=True)
+    def index_db(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(code_index, "CODE_INDEX_DB_NAME", str(tmp_path / "index.db"))
+        monkeypatch.setattr(code_index, "_indexes", {})
+
+    @pytest.fixture
+    def project(self, tmp_path):
+        project = tmp_path / "project"
+        (project / "pkg").mkdir(parents=True)
+        (project / "build").mkdir()
+        (project / ".gitignore").write_text("build/\n")
+        (project / "main.py").write_text("from pkg.shapes import Square\n\nprint(Square(2).area())\n")
+        (project / "pkg" / "shapes.py").write_text(
+            "class Square:\n"
+            "    def __init__(self, side):\n"
+            "        self.side = side\n"
+            "\n"
+            "    def area(self):\n"
+            "        return self.side ** 2\n"
+            "\n"
+            "    def area_label(self):\n"
+            "        return f'area: {self.area()}'\n"
+        )
+        (project / "pkg" / "data.bin").write_bytes(b"\0def area")
+        (project / "build" / "shapes.py").write_text("def area(): pass\n")
+        return project
+
+    def test_literal(self, project):
+        result = search_code(str(project), "def area")
+        assert result == "pkg/shapes.py:5:     def area(self):\npkg/shapes.py:8:     def area_label(self):"
+
+    def test_regex(self, project):
+        assert search_code(str(project), r"def \w+\(self\):", is_regex=True).splitlines() == [
+            "pkg/shapes.py:5:     def area(self):",
+            "pkg/shapes.py:8:     def area_label(self):",
+        ]
+        # Alternatives have no required literal, every file is searched
+        assert search_code(str(project), "Square|side =", is_regex=True).splitlines() == [
+            "main.py:1: from pkg.shapes import Square",
+            "main.py:3: print(Square(2).area())",
+            "pkg/shapes.py:1: class Square:",
+            "pkg/shapes.py:3:         self.side = side",
+        ]
+        assert search_code(str(project), "(", is_regex=True).startswith("Error: invalid regular expression")
+
+    def test_whole_word_and_case(self, project):
+        assert search_code(str(project), "area", whole_word=True, directory="pkg").splitlines() == [
+            "pkg/shapes.py:5:     def area(self):",
+            "pkg/shapes.py:9:         return f'area: {self.area()}'",
+        ]
+        assert search_code(str(project), "SQUARE") == 'No matches for "SQUARE"'
+        assert len(search_code(str(project), "SQUARE", ignore_case=True).splitlines()) == 3
+
+    def test_max_results(self, project):
+        result = search_code(str(project), "area", max_results=2).splitlines()
+        assert result[:2] == ["main.py:3: print(Square(2).area())", "pkg/shapes.py:5:     def area(self):"]
+        assert result[2].startswith("[...Showing the first 2 matching lines")
+
+    def test_outside(self, project):
+        assert search_code(str(project), "area", directory="..") == 'Error: Cannot search ".." as it is outside the permitted working directory'
+
+    def test_incremental_refresh(self, project):
+        index = code_index.get_index(str(project))
+        assert search_code(str(project), "perimeter") == 'No matches for "perimeter"'
+        (project / "pkg" / "shapes.py").write_text("def perimeter(side):\n    return 4 * side\n")
+        (project / "main.py").unlink()
+        # Not checked again until the refresh interval has passed
+        assert search_code(str(project), "perimeter") == 'No matches for "perimeter"'
+        index.mark_stale()
+        assert search_code(str(project), "perimeter") == "pkg/shapes.py:1: def perimeter(side):"
+        assert search_code(str(project), "Square") == 'No matches for "Square"'
+
+        (project / "pkg" / "circle.py").write_text("def perimeter(radius):\n")
+        (project / "build" / "circle.py").write_text("def perimeter(radius):\n")
+        code_index.file_written(str(project), "pkg/circle.py")
+        code_index.file_written(str(project), "build/circle.py")
+        assert search_code(str(project), "perimeter").splitlines() == [
+            "pkg/circle.py:1: def perimeter(radius):",
+            "pkg/shapes.py:1: def perimeter(side):",
+        ]
+
+    def test_index_is_persisted(self, project):
+        search_code(str(project), "area")
+        code_index.get_index(str(project)).close()
+        code_index._indexes.clear()
+        (project / "main.py").write_text("area = 1\n")
+        assert search_code(str(project), "area =") == "main.py:1: area = 1"
+
+    def test_required_literals(self):
+        assert code_index.required_literals(r"def \w+_handler\(") == ["def ", "_handler("]
+        assert code_index.required_literals(r"colou?r\.get") == ["colo", "r.get"]
+        assert code_index.required_literals(r"get_(user|group)s+ id") == ["get_", "s", " id"]
+        assert code_index.required_literals(r"[abc]+xyz") == ["xyz"]
+        assert code_index.required_literals(r"a|b") is None
+        assert code_index.required_literals(r"def\s+\w{1,30}\(") == ["def", "("]
+        assert code_index.required_literals(r"ab{0}c") == ["a", "c"]
+        assert code_index.required_literals(r"\x41rea") == ["rea"]
+        assert code_index.required_literals(r"\u0041rea") == ["rea"]
+        # Not a quantifier, but the pattern is not clear enough to rely on its literals
+        assert code_index.required_literals(r"area{") is None
+
+    def test_literals_never_miss_matches(self, project):
+        (project / "pkg" / "upper.py").write_text("AREA = 10\nAAAA = 0\n")
+        code_index.file_written(str(project), "pkg/upper.py")
+        index = code_index.get_index(str(project))
+        for pattern in [r"def\s+\w{1,30}\(", r"def areax{0}", r"\x41REA", r"\u0041REA", r"A{2,}", r"\N{LATIN CAPITAL LETTER A}REA", r"side{1}"]:
+            regex = re.compile(pattern)
+            unfiltered = list(index.search(regex, []))
+            assert unfiltered, pattern
+            assert list(index.search(regex, code_index.required_literals(pattern) or [])) == unfiltered, pattern
+
+
+class TestGetSymbols:
+    source = (
+        "import functools\n"
+        "\n"
+        "class Shape(abc.ABC, metaclass=Meta):\n"
+        "    \"\"\"A shape.\n"
+        "\n"
+        "    With more details.\"\"\"\n"
+        "\n"
+        "    @property\n"
+        "    def area(self) -> float:\n"
+        "        def helper():\n"
+        "            pass\n"
+        "        return 0.0\n"
+        "\n"
+        "if True:\n"
+        "    async def fetch(url, *args, timeout=10, **kwargs):\n"
+        "        pass\n"
+    )
+
+    def test_file(self, tmp_path):
+        (tmp_path / "shapes.py").write_text(self.source)
+        assert get_symbols(str(tmp_path), "shapes.py") == "\n".join([
+            "shapes.py",
+            "  class Shape(abc.ABC, metaclass=Meta): lines 3-12  # A shape.",
+            "    @property def area(self) -> float: lines 8-12",
+            "  async def fetch(url, *args, timeout=10, **kwargs): lines 15-16",
+        ])
+
+    def test_compound_statements(self, tmp_path):
+        (tmp_path / "compound.py").write_text(
+            "try:\n"
+            "    def in_try(): pass\n"
+            "except* ValueError:\n"
+            "    def in_handler(): pass\n"
+            "finally:\n"
+            "    def in_finally(): pass\n"
+            "async def main():\n"
+            "    pass\n"
+            "async with lock:\n"
+            "    def in_async_with(): pass\n"
+        )
+        assert get_symbols(str(tmp_path), "compound.py").splitlines()[1:] == [
+            "  def in_try(): lines 2-2",
+            "  def in_handler(): lines 4-4",
+            "  def in_finally(): lines 6-6",
+            "  async def main(): lines 7-8",
+            "  def in_async_with(): lines 10-10",
+        ]
+
+    def test_truncated(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(get_symbols_module, "MAX_LENGTH", 30)
+        (tmp_path / "a.py").write_text("def a(): pass\ndef b(): pass\n")
+        assert get_symbols(str(tmp_path), "a.py").splitlines()[:-1] == ["a.py", "  def a(): lines 1-1"]
+        # No whole line fits
+        (tmp_path / "a_module_name_longer_than_the_limit.py").write_text("")
+        result = get_symbols(str(tmp_path), "a_module_name_longer_than_the_limit.py")
+        assert result.startswith("a_module_name_longer_than_the_\n[...Outline truncated at 30 characters")
+
+    def test_syntax_error(self, tmp_path):
+        (tmp_path / "broken.py").write_text("def f(:\n")
+        assert get_symbols(str(tmp_path), "broken.py").startswith("broken.py\n  SyntaxError: ")
+
+    def test_directory(self, tmp_path):
+        (tmp_path / "pkg").mkdir()
+        (tmp_path / "pkg" / "a.py").write_text("def a(): pass\n")
+        (tmp_path / "pkg" / "empty.py").write_text("")
+        (tmp_path / "pkg" / "notes.txt").write_text("def not_python(): pass\n")
+        (tmp_path / "generated.py").write_text("def ignored(): pass\n")
+        (tmp_path / ".gitignore").write_text("generated.py\n")
+        assert get_symbols(str(tmp_path)) == "pkg/a.py\n  def a(): lines 1-1\npkg/empty.py"
+        assert get_symbols(str(tmp_path), "pkg") == get_symbols(str(tmp_path))
+        assert get_symbols(str(tmp_path), "missing") == 'Error: "missing" does not exist'
+        assert get_symbols(str(tmp_path), "..").startswith("Error: Cannot read")
+
+    def test_cached_by_content(self, tmp_path, monkeypatch):
+        (tmp_path / "a.py").write_text("def unique_cached_name(): pass\n")
+        (tmp_path / "b.py").write_text("def unique_cached_name(): pass\n")
+        get_symbols(str(tmp_path), "a.py")
+        monkeypatch.setattr(get_symbols_module, "outline", None)
+        # Same content, not parsed again
+        assert get_symbols(str(tmp_path), "b.py") == "b.py\n  def unique_cached_name(): lines 1-1"
+
+    def test_many_files(self, tmp_path):
+        for i in range(10):
+            (tmp_path / f"m{i}.py").write_text(f"class Parallel{i}:\n    def method_{i}(self): pass\n")
+        result = get_symbols(str(tmp_path)).splitlines()
+        assert len(result) == 30
+        assert result[-3:] == ["m9.py", "  class Parallel9: lines 1-2", "    def method_9(self): lines 2-2"]
+
+
 class TestRunPythonFile:
     def test_non_existing(self):
         filename = "fake_file"
@@ -188,3 +620,172 @@ class TestRunPythonFile:
         result = run_python_file("calculator", "../main.py")
         expected = 'Error: Cannot execute "../main.py" as it is outside the permitted working directory'
         assert result == expected
+
+
+class TestRunPythonFileAsync:
+    def test_execute_stdout_only(self):
+        result = asyncio.run(run_python_file_async("calculator", "main.py", ["13 * 7"]))
+        assert result == run_python_file("calculator", "main.py", ["13 * 7"])
+
+    def test_execution_failure(self):
+        result = asyncio.run(run_python_file_async("calculator", "main.py", [1234]))
+        assert result.startswith("Error: executing Python file: expected str")
+
+    def test_outside_relative(self):
+        result = asyncio.run(run_python_file_async("calculator", "../main.py"))
+        expected = 'Error: Cannot execute "../main.py" as it is outside the permitted working directory'
+        assert result == expected
+
+
+class TestPythonWorkerPool:
+    @pytest.fixture
+    def project(self, tmp_path):
+        (tmp_path / "helper.py").write_text("VALUE = 1\n")
+        (tmp_path / "main.py").write_text(
+            "import sys\n"
+            "import helper\n"
+            "print(helper.VALUE, *sys.argv[1:])\n"
+            "helper.VALUE += 1\n"
+        )
+        (tmp_path / "fail.py").write_text("import sys\nprint('before')\nsys.exit(sys.argv[1] if sys.argv[1:] else 3)\n")
+        (tmp_path / "crash.py").write_text("def f():\n    raise ValueError('boom')\n\nf()\n")
+        (tmp_path / "slow.py").write_text("import time\nprint('started', flush=True)\ntime.sleep(60)\n")
+        return tmp_path
+
+    @pytest.fixture
+    def warm(self, monkeypatch):
+        def run(working_directory, file_path, args=None):
+            monkeypatch.setattr(run_python, "PYTHON_POOL_ENABLED", True)
+            try:
+                return run_python_file(str(working_directory), file_path, args)
+            finally:
+                monkeypatch.setattr(run_python, "PYTHON_POOL_ENABLED", False)
+        return run
+
+    @pytest.mark.parametrize("file_path, args", [
+        ("main.py", ["a", "b"]),
+        ("fail.py", None),
+        ("fail.py", ["message"]),
+        ("crash.py", None),
+        ("main.py", [1234]),
+    ])
+    def test_same_result_as_new_process(self, project, warm, file_path, args):
+        assert warm(project, file_path, args) == run_python_file(str(project), file_path, args)
+
+    def test_calculator(self, warm):
+        def without_duration(result):
+            return re.sub(r"Ran (\d+) tests in [\d.]+s", r"Ran \1 tests", result)
+
+        assert without_duration(warm("calculator", "tests.py")) == without_duration(run_python_file("calculator", "tests.py"))
+        assert warm("calculator", "main.py", ["13 * 7"]) == run_python_file("calculator", "main.py", ["13 * 7"])
+
+    def test_runs_are_isolated(self, project, warm):
+        # Module state changed by a run is not seen by the next one
+        assert warm(project, "main.py") == "STDOUT: 1\n"
+        assert warm(project, "main.py") == "STDOUT: 1\n"
+
+    def test_changed_modules_are_imported_again(self, project, warm):
+        assert warm(project, "main.py") == "STDOUT: 1\n"
+        (project / "helper.py").write_text("VALUE = 100\n")
+        for _ in range(3):
+            assert warm(project, "main.py") == "STDOUT: 100\n"
+
+    def test_project_modules_are_not_imported_in_advance(self, project):
+        (project / "side_effect.py").write_text(f"open({str(project / 'imported.txt')!r}, 'a').close()\n")
+        (project / "main_with_side_effect.py").write_text("import side_effect\n")
+        zygote = python_pool._Zygote(str(project))
+        zygote.close()
+        assert not (project / "imported.txt").exists()
+
+    def test_limits_and_environment(self, project, warm, monkeypatch):
+        (project / "limits.py").write_text(
+            "import os, resource\n"
+            "print(resource.getrlimit(resource.RLIMIT_CPU), resource.getrlimit(resource.RLIMIT_FSIZE))\n"
+            "print(sorted(name for name in os.environ if name.startswith('AGENT_TEST')))\n"
+        )
+        monkeypatch.setenv("AGENT_TEST_SECRET", "secret")
+        result = warm(project, "limits.py")
+        assert result == "STDOUT: (60, 60) (104857600, 104857600)\n[]\n"
+        assert "AGENT_TEST_SECRET" in run_python_file(str(project), "limits.py")
+
+    def test_lost_worker_does_not_run_the_script_again(self, project, warm, monkeypatch):
+        (project / "append.py").write_text("with open('runs.txt', 'a') as f:\n    f.write('run\\n')\n")
+        receive = python_pool._Zygote._receive
+
+        def lose_exit_code(zygote, timeout, on_timeout=python_pool.WorkerError):
+            if on_timeout is TimeoutError:
+                zygote.close()
+                raise python_pool.WorkerError("Cannot receive reply from worker")
+            return receive(zygote, timeout, on_timeout)
+
+        monkeypatch.setattr(python_pool._Zygote, "_receive", lose_exit_code)
+        monkeypatch.chdir(project)
+        assert warm(project, "append.py").startswith("Error: executing Python file: Worker failed while running the script")
+        assert (project / "runs.txt").read_text() == "run\n"
+
+    def test_no_time_left_for_the_exit_code(self, project):
+        zygote = python_pool._Zygote(str(project))
+        try:
+            # Nothing to receive, and no time to wait for it
+            with pytest.raises(TimeoutError):
+                zygote._receive(0, on_timeout=TimeoutError)
+            assert zygote.alive()
+        finally:
+            zygote.close()
+
+    def test_timeout(self, project, warm, monkeypatch):
+        monkeypatch.setattr(run_python, "SUBCOMMAND_TIMEOUT_SECONDS", 0.5)
+        assert warm(project, "slow.py") == "Error: executing Python file: timed out after 0.5 seconds"
+        # The worker can still be used
+        assert warm(project, "main.py") == "STDOUT: 1\n"
+
+
+class TestRunPythonFileOutput:
+    @pytest.fixture
+    def project(self, tmp_path):
+        (tmp_path / "chatty.py").write_text(
+            "for i in range(10_000):\n"
+            "    print(f'line {i}')\n"
+        )
+        (tmp_path / "runaway.py").write_text(
+            "import sys\n"
+            "print('start', flush=True)\n"
+            "while True:\n"
+            "    sys.stderr.write('x' * 1000)\n"
+        )
+        (tmp_path / "unicode.py").write_text("print('résumé ✓')\n", encoding="utf-8")
+        return tmp_path
+
+    @pytest.fixture(params=["cold", "async", "warm"])
+    def run(self, request, monkeypatch):
+        monkeypatch.setattr(process_output, "MAX_OUTPUT_HEAD_BYTES", 100)
+        monkeypatch.setattr(process_output, "MAX_OUTPUT_TAIL_BYTES", 100)
+        monkeypatch.setattr(process_output, "MAX_OUTPUT_BYTES", 1_000_000)
+        monkeypatch.setattr(run_python, "PYTHON_POOL_ENABLED", request.param == "warm")
+        if request.param == "async":
+            return lambda *args: asyncio.run(run_python_file_async(*args))
+        return run_python_file
+
+    def test_head_and_tail_are_kept(self, project, run):
+        result = run(str(project), "chatty.py")
+        assert result.startswith("STDOUT: line 0\nline 1\n")
+        assert result.endswith("line 9998\nline 9999\n")
+        assert " bytes omitted ...]\n" in result
+        assert len(result) < 400
+
+    def test_runaway_script_is_killed(self, project, run):
+        result = run(str(project), "runaway.py")
+        assert result.startswith("STDOUT: start\n")
+        assert "STDERR: xxx" in result
+        assert result.endswith("Process was killed after writing more than 1000000 bytes of output")
+
+    def test_output_is_decoded(self, project, run):
+        assert run(str(project), "unicode.py") == "STDOUT: résumé ✓\n"
+
+
+def test_bounded_output_keeps_characters_whole():
+    output = process_output.BoundedOutput(head_bytes=5, tail_bytes=5)
+    output.write("ééééé".encode("utf-8"))
+    output.write("ééééé".encode("utf-8"))
+    # Characters cut at the edges of the omitted bytes are not shown
+    assert output.text() == "éé\n[... 12 bytes omitted ...]\néé"
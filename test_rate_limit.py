@@ -0,0 +1,175 @@
+import asyncio
+import tempfile
+import threading
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+from rate_limit import RateLimiter, RateLimitExceeded
+from stats import Database, Record, datetime_to_string
+
+
+@pytest.fixture
+def test_db():
+    with tempfile.NamedTemporaryFile() as file:
+        db = Database(file.name)
+        yield db
+        db.close()
+
+
+def _add_request(db: Database, seconds_ago: float, tokens: int = 100) -> None:
+    db.add(Record(
+        ts=datetime_to_string(datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)),
+        tokens_prompt=tokens,
+        tokens_candidates=0,
+        tokens_total=tokens,
+    ))
+
+
+def _limiter(db: Database, sleeps: list[float] | None = None, **limits) -> RateLimiter:
+    limits = {
+        "max_requests_per_minute": 5,
+        "max_requests_per_day": 100,
+        "max_tokens_per_day": 10_000,
+        "max_wait_seconds": 120,
+    } | limits
+
+    def sleep(seconds: float) -> None:
+        if sleeps is None:
+            raise AssertionError("Unexpected wait")
+        sleeps.append(seconds)
+        # Requests slide out of the window while waiting
+        raise _Waited()
+
+    return RateLimiter(db, sleep=sleep, **limits)
+
+
+class _Waited(Exception):
+    pass
+
+
+def test_under_quota_does_not_wait(test_db):
+    for _ in range(4):
+        _add_request(test_db, seconds_ago=10)
+    limiter = _limiter(test_db)
+    assert limiter.wait_time(100) == 0
+    with limiter.request(100):
+        pass
+
+
+def test_requests_per_minute(test_db):
+    _add_request(test_db, seconds_ago=50)
+    for _ in range(4):
+        _add_request(test_db, seconds_ago=10)
+    limiter = _limiter(test_db)
+    # The oldest request leaves the window in about 10 seconds
+    assert limiter.wait_time(100) == pytest.approx(10, abs=1)
+
+
+def test_requests_per_day(test_db):
+    _add_request(test_db, seconds_ago=24 * 3600 - 30)
+    _add_request(test_db, seconds_ago=600)
+    limiter = _limiter(test_db, max_requests_per_day=2)
+    assert limiter.wait_time(100) == pytest.approx(30, abs=1)
+
+
+def test_tokens_per_day(test_db):
+    _add_request(test_db, seconds_ago=24 * 3600 - 100, tokens=3000)
+    _add_request(test_db, seconds_ago=600, tokens=6000)
+    limiter = _limiter(test_db)
+    # Fits in the remaining 1000 tokens
+    assert limiter.wait_time(1000) == 0
+    # Must wait for the oldest request to leave the window, rounded up to the end of its minute
+    assert 100 - 1 < limiter.wait_time(2000) <= 100 + 60
+    # Must wait for both requests to leave the window
+    assert limiter.wait_time(5000) > 23 * 3600
+    # Can never be sent
+    assert limiter.wait_time(20_000) == float("inf")
+
+
+def test_waits_before_sending(test_db):
+    for _ in range(5):
+        _add_request(test_db, seconds_ago=30)
+    sleeps = []
+    limiter = _limiter(test_db, sleeps=sleeps)
+    with pytest.raises(_Waited):
+        with limiter.request(100):
+            pass
+    # Waits are split, to check again if other processes sent requests in the meantime
+    assert sleeps == [1.0]
+
+
+def test_too_long_wait_raises(test_db):
+    for _ in range(5):
+        _add_request(test_db, seconds_ago=30)
+    limiter = _limiter(test_db, max_wait_seconds=10)
+    with pytest.raises(RateLimitExceeded):
+        with limiter.request(100):
+            pass
+
+
+def test_reservations_count_as_requests(test_db):
+    limiter = _limiter(test_db, max_requests_per_minute=2)
+    with limiter.request(100):
+        assert limiter.wait_time(100) == 0
+        with limiter.request(100):
+            # Both requests are in flight, and not recorded yet
+            assert limiter.wait_time(100) > 0
+            _add_request(test_db, seconds_ago=0)
+        _add_request(test_db, seconds_ago=0)
+    # Recorded, they're not counted twice
+    assert limiter.wait_time(100) == pytest.approx(60, abs=1)
+
+
+def test_recorded_reservation_is_released(test_db):
+    limiter = _limiter(test_db, max_requests_per_minute=2)
+    with limiter.request(100) as reservation:
+        reservation.record(lambda: _add_request(test_db, seconds_ago=0))
+        # Counted once, as recorded
+        assert limiter.wait_time(100) == 0
+    assert limiter.wait_time(100) == 0
+
+
+def test_reservations_count_as_tokens(test_db):
+    limiter = _limiter(test_db, max_tokens_per_day=1000)
+    with limiter.request(600):
+        assert limiter.wait_time(300) == 0
+        assert limiter.wait_time(500) > 0
+    assert limiter.wait_time(500) == 0
+
+
+def test_concurrent_requests_stay_within_quota(test_db):
+    limiter = _limiter(test_db, max_requests_per_minute=3, max_wait_seconds=0)
+    sent = []
+    rejected = []
+    barrier = threading.Barrier(10)
+
+    def send():
+        barrier.wait()
+        try:
+            with limiter.request(100) as reservation:
+                reservation.record(lambda: _add_request(test_db, seconds_ago=0))
+                sent.append(1)
+        except RateLimitExceeded:
+            rejected.append(1)
+
+    threads = [threading.Thread(target=send) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(sent) == 3
+    assert len(rejected) == 7
+
+
+def test_async_request(test_db):
+    limiter = _limiter(test_db, max_requests_per_minute=1)
+
+    async def send():
+        async with limiter.request_async(100) as reservation:
+            await asyncio.to_thread(reservation.record, lambda: _add_request(test_db, seconds_ago=0))
+
+    asyncio.run(send())
+    with pytest.raises(RateLimitExceeded):
+        limiter._max_wait_seconds = 10
+        asyncio.run(send())
@@ -0,0 +1,210 @@
+import asyncio
+import http.server
+import json
+import threading
+import time
+
+import pytest
+from google import genai
+from google.genai import errors, types
+
+import agent
+from config import MODEL_ID
+from retry import CallMetrics, ResilientCaller, retry_after_seconds
+
+
+class _FakeServer(http.server.ThreadingHTTPServer):
+    """Answers generateContent requests with scripted errors and delays, then with a text response."""
+
+    # Don't wait for the slower hedged requests
+    block_on_close = False
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _FakeHandler)
+        # Each request pops the first entry: (status, headers, delay in seconds)
+        self.script: list[tuple[int, dict, float]] = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class _FakeHandler(http.server.BaseHTTPRequestHandler):
+    server: _FakeServer
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.requests += 1
+            status, headers, delay = self.server.script.pop(0) if self.server.script else (200, {}, 0)
+        time.sleep(delay)
+
+        if status == 200:
+            body = {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": "Hello"}]}}],
+                "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 5, "totalTokenCount": 15},
+            }
+        else:
+            body = {"error": {"code": status, "message": "Injected error", "status": "UNAVAILABLE"}}
+        data = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # A cancelled hedged request
+            pass
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    server = _FakeServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def client(server):
+    host, port = server.server_address
+    return genai.Client(api_key="fake_api_key", http_options=types.HttpOptions(base_url=f"http://{host}:{port}/"))
+
+
+def _generate(client: genai.Client):
+    return lambda: client.models.generate_content(model=MODEL_ID, contents="Hi")
+
+
+def test_retries_transient_errors(server, client):
+    server.script = [(503, {}, 0), (500, {}, 0)]
+    sleeps = []
+    caller = ResilientCaller(initial_delay_seconds=1, sleep=sleeps.append)
+    response = caller.call(_generate(client))
+    assert response.text == "Hello"
+    assert server.requests == 3
+    assert caller.metrics.retries == 2
+    # Full jitter, below the exponential backoff
+    assert 0 <= sleeps[0] <= 1
+    assert 0 <= sleeps[1] <= 2
+
+
+def test_retry_after_header(server, client):
+    server.script = [(429, {"Retry-After": "7"}, 0)]
+    sleeps = []
+    caller = ResilientCaller(sleep=sleeps.append)
+    assert caller.call(_generate(client)).text == "Hello"
+    assert sleeps == [7]
+
+
+def test_client_errors_are_not_retried(server, client):
+    server.script = [(400, {}, 0)]
+    caller = ResilientCaller(sleep=pytest.fail)
+    with pytest.raises(errors.ClientError):
+        caller.call(_generate(client))
+    assert server.requests == 1
+    assert caller.metrics.failures == 1
+
+
+def test_gives_up_after_max_attempts(server, client):
+    server.script = [(503, {}, 0)] * 3
+    caller = ResilientCaller(max_attempts=3, sleep=lambda seconds: None)
+    with pytest.raises(errors.ServerError):
+        caller.call(_generate(client))
+    assert server.requests == 3
+    assert caller.metrics.retries == 2
+
+
+def test_retry_info_detail():
+    exc = errors.ClientError(429, {"error": {"code": 429, "details": [
+        {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "12s"},
+    ]}})
+    assert retry_after_seconds(exc) == 12
+
+
+def test_backoff_is_capped():
+    caller = ResilientCaller(initial_delay_seconds=1, max_delay_seconds=5)
+    assert all(caller.backoff_seconds(10) <= 5 for _ in range(100))
+
+
+def _warmed_up_metrics(latency: float) -> CallMetrics:
+    metrics = CallMetrics()
+    for _ in range(20):
+        metrics.record_latency(latency)
+    return metrics
+
+
+def test_slow_call_is_hedged(server, client):
+    server.script = [(200, {}, 2)]
+    caller = ResilientCaller(hedging=True, hedging_min_samples=20, metrics=_warmed_up_metrics(0.05))
+    start = time.perf_counter()
+    assert caller.call(_generate(client)).text == "Hello"
+    assert time.perf_counter() - start < 1.5
+    assert server.requests == 2
+    assert caller.metrics.hedges == 1
+    assert caller.metrics.hedge_wins == 1
+
+
+def test_discarded_response_is_reported(server, client):
+    server.script = [(200, {}, 0.5)]
+    caller = ResilientCaller(hedging=True, metrics=_warmed_up_metrics(0.05))
+    discarded = []
+    reported = threading.Event()
+    caller.call(_generate(client), discarded=lambda response: discarded.append(response) or reported.set())
+    # Reported when the slower request completes
+    assert reported.wait(timeout=5)
+    assert discarded[0].usage_metadata.total_token_count == 15
+
+
+def test_discarded_usage_is_recorded(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(agent.stats, "add", lambda usage_metadata, *args: recorded.append(usage_metadata))
+    record = agent._record_discarded(1000, 1, 0)
+    record(types.GenerateContentResponse(usage_metadata=types.GenerateContentResponseUsageMetadata(total_token_count=15)))
+    # Cancelled, the usage is estimated
+    record(None)
+    assert recorded[0].total_token_count == 15
+    assert recorded[1].prompt_token_count == 1000
+    assert recorded[1].total_token_count == 1000 + agent.RATE_LIMIT_EXPECTED_RESPONSE_TOKENS
+
+
+def test_no_hedging_without_enough_samples(server, client):
+    server.script = [(200, {}, 0.3)]
+    caller = ResilientCaller(hedging=True, hedging_min_samples=20)
+    caller.call(_generate(client))
+    assert server.requests == 1
+    assert caller.metrics.hedges == 0
+
+
+def test_async_retry_and_hedging(server, client):
+    server.script = [(503, {}, 0), (200, {}, 2)]
+    caller = ResilientCaller(initial_delay_seconds=0.01, hedging=True, metrics=_warmed_up_metrics(0.05))
+
+    discarded = []
+
+    async def generate():
+        return await caller.call_async(lambda: client.aio.models.generate_content(model=MODEL_ID, contents="Hi"), discarded=discarded.append)
+
+    start = time.perf_counter()
+    assert asyncio.run(generate()).text == "Hello"
+    assert time.perf_counter() - start < 1.5
+    assert caller.metrics.retries == 1
+    assert caller.metrics.hedge_wins == 1
+    # The slower request was cancelled before completing
+    assert discarded == [None]
+
+
+def test_percentiles():
+    metrics = CallMetrics()
+    for latency in range(1, 101):
+        metrics.record_latency(latency)
+    assert metrics.percentile(50) == 50
+    assert metrics.percentile(95) == 95
+    assert metrics.percentile(100) == 100
+    assert "p99 99.00s" in metrics.summary()
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import pytest
+from google.genai import types
+
+import agent
+import sessions
+from sessions import Session, SessionError
+
+
+def _usage(total: int) -> types.GenerateContentResponseUsageMetadata:
+    return types.GenerateContentResponseUsageMetadata(prompt_token_count=total - 1, candidates_token_count=1, total_token_count=total)
+
+
+def _iteration(number: int) -> list[types.Content]:
+    return [
+        types.Content(role="model", parts=[types.Part(function_call=types.FunctionCall(name="get_files_info", args={"directory": str(number)}))]),
+        types.Content(role="user", parts=[types.Part(function_response=types.FunctionResponse(name="get_files_info", response={"result": f"listing {number}"}))]),
+    ]
+
+
+def _record_iterations(session: Session, count: int) -> list[types.Content]:
+    messages = [types.Content(role="user", parts=[types.Part(text="prompt")])]
+    for number in range(count):
+        messages += _iteration(number)
+        session.record(messages, _usage(10))
+    return messages
+
+
+def test_ids_are_sequential(tmp_path):
+    assert Session.create(str(tmp_path)).conversation_id == 1
+    assert Session.create(str(tmp_path)).conversation_id == 2
+
+
+def test_load(tmp_path):
+    session = Session.create(str(tmp_path))
+    messages = _record_iterations(session, 3)
+
+    loaded = Session.load(session.conversation_id, str(tmp_path))
+    assert loaded.messages == messages
+    assert loaded.usage == {"iterations": 3, "prompt_tokens": 27, "response_tokens": 3, "total_tokens": 30}
+    assert not loaded.finished
+
+
+def test_load_from_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(sessions, "SESSION_SNAPSHOT_INTERVAL", 2)
+    session = Session.create(str(tmp_path))
+    messages = _record_iterations(session, 3)
+    assert (tmp_path / "1.snapshot.json").exists()
+
+    # The log before the snapshot is not read again
+    log_path = tmp_path / "1.jsonl"
+    log = log_path.read_bytes()
+    first_lines_size = log.index(b"\n", log.index(b"\n") + 1) + 1
+    log_path.write_bytes(b" " * first_lines_size + log[first_lines_size:])
+    loaded = Session.load(1, str(tmp_path))
+    assert loaded.messages == messages
+    assert loaded.usage["iterations"] == 3
+
+
+def test_partial_line_is_discarded(tmp_path):
+    session = Session.create(str(tmp_path))
+    messages = _record_iterations(session, 2)
+    with open(tmp_path / "1.jsonl", "ab") as f:
+        f.write(b'{"messages":[{"ro')
+
+    loaded = Session.load(1, str(tmp_path))
+    assert loaded.messages == messages
+    # The next iteration is appended after the last complete one
+    loaded.record(messages + _iteration(2), _usage(10))
+    assert Session.load(1, str(tmp_path)).messages == messages + _iteration(2)
+
+
+def test_missing_session(tmp_path):
+    with pytest.raises(SessionError):
+        Session.load(1, str(tmp_path))
+
+
+class _FakeModels:
+    """Calls a function on every request, then answers once `answer_after` requests were received."""
+
+    def __init__(self, answer_after: int) -> None:
+        self.answer_after = answer_after
+        self.requests: list[list[types.Content]] = []
+
+    def generate_content(self, model, contents, config):
+        self.requests.append(list(contents))
+        if len(self.requests) < self.answer_after:
+            part = types.Part(function_call=types.FunctionCall(name="no_such_function", args={}))
+        else:
+            part = types.Part(text="Done")
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))],
+            usage_metadata=_usage(10),
+        )
+
+
+def test_resume_agent_request(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, "RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(agent, "MAX_ITERATIONS", 2)
+    conversation_ids = []
+    monkeypatch.setattr(agent.stats, "add", lambda response_usage, conversation_id, *args: conversation_ids.append(conversation_id))
+    monkeypatch.setattr(agent.stats, "add_tool_calls", lambda *args: None)
+    client = SimpleNamespace(models=_FakeModels(answer_after=3))
+
+    session = Session.create(str(tmp_path))
+    with pytest.raises(Exception, match="max iterations"):
+        agent.agent_request("prompt", "fake_api_key", False, client=client, session=session)
+
+    resumed = Session.load(session.conversation_id, str(tmp_path))
+    assert resumed.usage["iterations"] == 2
+    assert agent.agent_request("", "fake_api_key", False, client=client, session=resumed) == "Done"
+    # The resumed request continues from the saved conversation
+    assert len(client.models.requests[2]) == 5
+    assert conversation_ids == [1, 1, 1]
+
+    finished = Session.load(session.conversation_id, str(tmp_path))
+    assert finished.finished
+    with pytest.raises(ValueError):
+        agent.agent_request("", "fake_api_key", False, client=client, session=finished)
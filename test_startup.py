@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+STATS_IMPORT_TIME_LIMIT_MS = 200
+"""Total time spent importing modules when running `main.py stats`.
+Currently about a tenth of it, while importing the API client alone takes several times as much."""
+
+STATS_FORBIDDEN_IMPORTS = ["google.genai", "pydantic", "dotenv", "agent", "call_function", "functions"]
+
+
+def _import_times(tmp_path, *args: str) -> dict[str, int]:
+    """Runs main.py with `-X importtime`, returns the time spent importing each module (in microseconds)."""
+    env = {key: value for key, value in os.environ.items() if key != "GEMINI_API_KEY"}
+    completed_process = subprocess.run(
+        [sys.executable, "-X", "importtime", MAIN_PATH, *args],
+        cwd=tmp_path,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=30,
+    )
+    assert completed_process.returncode == 0, completed_process.stderr
+
+    import_times: dict[str, int] = {}
+    for line in completed_process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_time, _, module = line.removeprefix("import time:").split("|")
+        import_times[module.strip()] = int(self_time)
+    return import_times
+
+
+def test_stats_cold_start(tmp_path):
+    import_times = _import_times(tmp_path, "stats")
+    imported = set(import_times)
+    for forbidden in STATS_FORBIDDEN_IMPORTS:
+        assert not any(module == forbidden or module.startswith(forbidden + ".") for module in imported), forbidden
+    total_ms = sum(import_times.values()) / 1000
+    assert total_ms < STATS_IMPORT_TIME_LIMIT_MS
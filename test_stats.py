@@ -1,19 +1,32 @@
 import pytest
+import sqlite3
 import tempfile
+import threading
+import time
 from datetime import datetime, timezone, timedelta
-from stats import Database, Record, datetime_to_string, _now_utc
+
+import stats
+from stats import Database, Record, ToolCall, datetime_to_string, string_to_epoch_us, _now_utc
 
 
 @pytest.fixture
 def test_db():
-    # Must use a temp file instead of a in-memory DB, because right now
-    # every method in the Database class creates a new connection
-    # and each connection to an in-memory DB creates a new database.
-    # There's workarounds, but this seems to be the simplest strategy.
+    # Use a temp file instead of a in-memory DB, to test the database
+    # as it's actually used (e.g. WAL mode is not available for in-memory DBs).
 
     # File is automatically deleted on context manager exit
     with tempfile.NamedTemporaryFile() as file:
-        yield Database(file.name)
+        db = Database(file.name)
+        yield db
+        db.close()
+
+
+@pytest.fixture
+def write_behind_db():
+    with tempfile.NamedTemporaryFile() as file:
+        db = Database(file.name, write_behind=True, flush_interval_seconds=0.1, flush_max_records=3)
+        yield db
+        db.close()
 
 
 def test_empty_db_returns_zero(test_db: Database):
@@ -86,6 +99,96 @@ def test_last_24_hours_boundary(test_db: Database):
     assert test_db.requests_last_minute() == 0
 
 
+class TestWriteBehind:
+    def _record(self) -> Record:
+        return Record(tokens_prompt=1, tokens_candidates=2, tokens_total=3)
+
+    def _persisted_count(self, db: Database) -> int:
+        # Read with another connection, which doesn't see the buffer
+        with sqlite3.connect(db._db_name) as connection:
+            return connection.execute("SELECT COUNT(*) FROM stats").fetchone()[0]
+
+    def test_records_are_buffered(self, write_behind_db: Database):
+        write_behind_db.add(self._record())
+        write_behind_db.add(self._record())
+        assert self._persisted_count(write_behind_db) == 0
+        # Queries always include buffered records
+        assert write_behind_db.requests_last_minute() == 2
+        assert self._persisted_count(write_behind_db) == 2
+
+    def test_flush_when_buffer_is_full(self, write_behind_db: Database):
+        for _ in range(3):
+            write_behind_db.add(self._record())
+        assert self._persisted_count(write_behind_db) == 3
+
+    def test_flush_on_timer(self, write_behind_db: Database):
+        write_behind_db.add(self._record())
+        time.sleep(0.3)
+        assert self._persisted_count(write_behind_db) == 1
+
+    def test_flush_on_close(self, write_behind_db: Database):
+        write_behind_db.add(self._record())
+        write_behind_db.close()
+        assert self._persisted_count(write_behind_db) == 1
+
+    def test_tool_calls_are_buffered(self, write_behind_db: Database):
+        write_behind_db.add_tool_calls([ToolCall(function="get_file_content", duration_us=1, result_bytes=1)])
+        write_behind_db.add(self._record())
+        assert self._persisted_count(write_behind_db) == 0
+        write_behind_db.add_tool_calls([ToolCall(function="get_file_content", duration_us=1, result_bytes=1)])
+        assert self._persisted_count(write_behind_db) == 1
+        assert write_behind_db.slowest_tools(10)[0][1] == 2
+
+
+class TestReports:
+    def _add_conversation(self, db: Database, conversation_id: int, iterations: int, tokens: int) -> None:
+        for iteration in range(iterations):
+            db.add(Record(
+                conversation_id=conversation_id, iteration=iteration, model_id="model", latency_us=1_000_000,
+                tokens_prompt=tokens * (iteration + 1), tokens_candidates=10, tokens_total=tokens * (iteration + 1) + 10,
+            ))
+            db.add_tool_calls([
+                ToolCall(conversation_id=conversation_id, iteration=iteration, function="run_python_file", duration_us=200_000, result_bytes=100),
+                ToolCall(conversation_id=conversation_id, iteration=iteration, function="get_file_content", duration_us=1_000, result_bytes=5000),
+            ])
+
+    def test_reports(self, test_db: Database):
+        self._add_conversation(test_db, 1, iterations=2, tokens=100)
+        self._add_conversation(test_db, 2, iterations=3, tokens=1000)
+        # Requests of sessions that are not saved
+        test_db.add(Record(tokens_prompt=5, tokens_candidates=5, tokens_total=10))
+
+        assert test_db.conversation_costs(10) == [
+            (2, 3, 6000, 30, 3_000_000, 6, 603_000),
+            (1, 2, 300, 20, 2_000_000, 4, 402_000),
+        ]
+        assert test_db.conversation_costs(1)[0][0] == 2
+        assert test_db.slowest_tools(10) == [
+            ("run_python_file", 5, 200_000, 200_000, 100),
+            ("get_file_content", 5, 1_000, 1_000, 5000),
+        ]
+        assert test_db.tokens_per_iteration(10) == [(0, 2, 560), (1, 2, 1110), (2, 1, 3010)]
+
+    def test_reports_use_indexes(self, test_db: Database):
+        for statement in (stats._SELECT_CONVERSATIONS, stats._SELECT_TOOLS, stats._SELECT_ITERATIONS):
+            plan = test_db._connection.execute(f"EXPLAIN QUERY PLAN {statement}", {"prompt_price": 1, "response_price": 1, "limit": 1}).fetchall()
+            details = " ".join(row[-1] for row in plan)
+            assert "COVERING INDEX" in details, details
+            assert "TEMP B-TREE FOR GROUP BY" not in details, details
+
+
+def test_concurrent_adds(test_db: Database):
+    threads = [
+        threading.Thread(target=lambda: [test_db.add(Record(tokens_prompt=1, tokens_candidates=1, tokens_total=2)) for _ in range(20)])
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert test_db.requests_last_24h() == 100
+
+
 class TestDatetimeFormatting:
     def test_datetime_to_string(self):
         assert datetime_to_string(datetime(2025, 5, 17, 11, 39))                      == "2025-05-17 11:39:00.000000"
@@ -104,3 +207,66 @@ class TestDatetimeFormatting:
         actual = _now_utc()
         expected = datetime_to_string(now_utc)
         assert datetime.fromisoformat(actual) - datetime.fromisoformat(expected) < timedelta(milliseconds=50)
+
+
+class TestMigration:
+    def _create_v1_db(self, db_name: str, timestamps: list[datetime]):
+        with sqlite3.connect(db_name) as connection:
+            connection.execute("""
+            CREATE TABLE stats (
+                ts                TEXT    NOT NULL,
+                conversation_id   INT,
+                tokens_prompt     INT     NOT NULL,
+                tokens_candidates INT     NOT NULL,
+                tokens_total      INT     NOT NULL
+            );
+            """)
+            connection.executemany(
+                "INSERT INTO stats VALUES (?, NULL, 1, 2, 3)",
+                [(datetime_to_string(ts),) for ts in timestamps],
+            )
+
+    def test_existing_records_are_migrated(self):
+        now = datetime.now(timezone.utc)
+        timestamps = [now - timedelta(seconds=30), now - timedelta(minutes=5), now - timedelta(hours=3), now - timedelta(days=2)]
+        with tempfile.NamedTemporaryFile() as file:
+            self._create_v1_db(file.name, timestamps)
+            db = Database(file.name)
+            assert db.requests_last_minute() == 1
+            assert db.requests_last_24h() == 3
+            assert db.tokens_last_24h() == 9
+            db.add(Record(tokens_prompt=10, tokens_candidates=10, tokens_total=20))
+            assert db.requests_last_minute() == 2
+            assert db.tokens_last_24h() == 29
+            db.close()
+
+            with sqlite3.connect(file.name) as connection:
+                assert connection.execute("PRAGMA user_version").fetchone()[0] >= 2
+                ts_us = [row[0] for row in connection.execute("SELECT ts_us FROM stats ORDER BY ts_us DESC LIMIT 4")]
+            expected = [string_to_epoch_us(datetime_to_string(ts)) for ts in timestamps[:3]]
+            # julianday() has millisecond precision
+            assert all(abs(actual - exp) < 1000 for actual, exp in zip(ts_us[1:], expected))
+
+    def test_migration_is_applied_once(self):
+        with tempfile.NamedTemporaryFile() as file:
+            Database(file.name).close()
+            db = Database(file.name)
+            db.add(Record(tokens_prompt=1, tokens_candidates=1, tokens_total=2))
+            assert db.requests_last_24h() == 1
+            db.close()
+
+
+def test_rollups_match_records(test_db: Database):
+    now = datetime.now(timezone.utc)
+    for minutes in range(0, 26 * 60, 7):
+        test_db.add(Record(
+            ts=datetime_to_string(now - timedelta(minutes=minutes, seconds=1)),
+            tokens_prompt=1,
+            tokens_candidates=1,
+            tokens_total=minutes,
+        ))
+    requests, tokens = test_db._connection.execute(
+        "SELECT COUNT(*), SUM(tokens_total) FROM stats WHERE ts_us >= ?",
+        (string_to_epoch_us(datetime_to_string(now - timedelta(days=1))),),
+    ).fetchone()
+    assert test_db.usage_since(timedelta(days=1)) == (requests, tokens)
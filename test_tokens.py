@@ -0,0 +1,103 @@
+import gc
+from types import SimpleNamespace
+
+import pytest
+from google.genai import types
+
+import agent
+import tokens
+from tokens import TokenBudgetExceeded, TokenEstimator
+
+
+def _result(text: str) -> types.Content:
+    return types.Content(role="user", parts=[types.Part.from_function_response(name="get_file_content", response={"result": text})])
+
+
+def test_parts_are_measured_once(monkeypatch):
+    measured = []
+    measure = tokens._measure
+    monkeypatch.setattr(tokens, "_measure", lambda part: measured.append(part) or measure(part))
+    messages = [_result("a" * 400), _result("b" * 800)]
+
+    first = tokens.estimate_tokens(messages)
+    messages.append(_result("c" * 40))
+    second = tokens.estimate_tokens(messages)
+    assert second > first
+    assert len(measured) == 3
+
+
+def test_collected_parts_are_forgotten():
+    count = len(tokens._part_characters)
+    tokens.estimate_tokens([_result("x" * 100) for _ in range(10)])
+    gc.collect()
+    assert len(tokens._part_characters) == count
+
+
+def test_calibration():
+    estimator = TokenEstimator(overhead_characters=1000)
+    messages = [_result("a" * 3000)]
+    assert estimator.estimate(messages) == pytest.approx(1000, abs=20)
+
+    # Fewer actual tokens than estimated, the estimate gets closer with every count
+    for _ in range(5):
+        estimator.calibrate(messages, 600)
+    assert estimator.estimate(messages) == pytest.approx(600, rel=0.05)
+
+    # Counts that would mean less than a character per token are bogus
+    estimator.calibrate(messages, 1_000_000)
+    assert estimator.estimate(messages) == pytest.approx(600, rel=0.05)
+
+
+def test_count():
+    client = SimpleNamespace(models=SimpleNamespace(count_tokens=lambda model, contents: SimpleNamespace(total_tokens=700)))
+    estimator = TokenEstimator(overhead_characters=400)
+    assert estimator.count(client, "model", [_result("a" * 3000)]) == 800
+
+
+def test_content_budget():
+    estimator = TokenEstimator(overhead_characters=400)
+    # 400 characters are always sent, the messages get the rest of the budget
+    assert estimator.content_budget(1100) == 1000
+    assert estimator.content_budget(10) == 0
+
+
+class TestTokenBudget:
+    def _messages(self) -> list[types.Content]:
+        messages = [types.Content(role="user", parts=[types.Part(text="fix the bug")])]
+        for i in range(10):
+            messages.append(types.Content(role="model", parts=[types.Part(function_call=types.FunctionCall(name="get_file_content", args={"file_path": f"{i}.py"}))]))
+            messages.append(_result("x" * 4000))
+        return messages
+
+    @pytest.fixture(autouse=True)
+    def estimator(self, monkeypatch):
+        monkeypatch.setattr(agent, "RATE_LIMIT_ENABLED", False)
+        monkeypatch.setattr(agent, "token_estimator", TokenEstimator())
+
+    def _client(self, total_tokens: int):
+        count_tokens = lambda model, contents: SimpleNamespace(total_tokens=total_tokens)
+        return SimpleNamespace(models=SimpleNamespace(count_tokens=count_tokens))
+
+    def test_within_budget(self, monkeypatch):
+        monkeypatch.setattr(agent, "MAX_REQUEST_TOKENS", 100_000)
+        messages = self._messages()
+        assert agent._check_token_budget(self._client(0), messages, messages, False) is messages
+
+    def test_compacted_to_budget(self, monkeypatch):
+        monkeypatch.setattr(agent, "MAX_REQUEST_TOKENS", 5_000)
+        messages = self._messages()
+        contents = agent._check_token_budget(self._client(0), messages, messages, False)
+        assert agent.token_estimator.estimate(contents) <= 5_000
+        assert len(contents) == len(messages)
+
+    def test_refused(self, monkeypatch):
+        monkeypatch.setattr(agent, "MAX_REQUEST_TOKENS", 500)
+        messages = self._messages()
+        with pytest.raises(TokenBudgetExceeded):
+            agent._check_token_budget(self._client(2_000), messages, messages, False)
+
+    def test_counted_within_limit(self, monkeypatch):
+        monkeypatch.setattr(agent, "MAX_REQUEST_TOKENS", 500)
+        messages = self._messages()
+        # The estimate was too high, the request is sent
+        assert agent._check_token_budget(self._client(100), messages, messages, False)
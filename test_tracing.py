@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import tracing
+
+
+@pytest.fixture
+def trace_path(tmp_path):
+    path = str(tmp_path / "trace.json")
+    tracing.enable(path)
+    yield path
+    tracing.disable()
+
+
+def test_disabled_spans_do_nothing(tmp_path):
+    tracing.disable()
+    with tracing.span("stage", size=1) as span:
+        span.set("tokens", 2)
+    assert span is tracing.span("other")
+    assert not tracing.enabled()
+
+
+def test_spans_are_written(trace_path):
+    with tracing.span("outer", iteration=1) as span:
+        with tracing.span("inner"):
+            pass
+        span.set("tokens", 10)
+    with pytest.raises(ValueError):
+        with tracing.span("failing"):
+            raise ValueError()
+    tracing.disable()
+
+    events = tracing.read_events(trace_path)
+    # Written when they end
+    assert [event["name"] for event in events] == ["inner", "outer", "failing"]
+    inner, outer, failing = events
+    assert outer["args"] == {"iteration": 1, "tokens": 10}
+    assert failing["args"] == {"error": "ValueError"}
+    assert outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+
+    # A Chrome trace, missing only the closing bracket
+    with open(trace_path) as f:
+        content = f.read()
+    assert len(json.loads(content.rstrip().rstrip(",") + "]")) == 3
+
+
+def test_appends_to_existing_trace(trace_path):
+    with tracing.span("first"):
+        pass
+    tracing.enable(trace_path)
+    with tracing.span("second"):
+        pass
+    tracing.disable()
+    with open(trace_path, "a") as f:
+        f.write('{"name":"partial","ph":"X","ts":')
+
+    assert [event["name"] for event in tracing.read_events(trace_path)] == ["first", "second"]
+
+
+def test_summary(tmp_path):
+    path = tmp_path / "trace.json"
+    events = [{"name": "generate_content", "ph": "X", "ts": i, "dur": (i + 1) * 1000, "pid": 1, "tid": 1, "args": {}} for i in range(100)]
+    events.append({"name": "stats.write", "ph": "X", "ts": 0, "dur": 500, "pid": 1, "tid": 1, "args": {}})
+    path.write_text("[\n" + "".join(json.dumps(event) + ",\n" for event in events))
+
+    header, slowest, fastest = tracing.summary(str(path)).splitlines()
+    assert header.split() == ["stage", "count", "total", "s", "p50", "ms", "p95", "ms", "max", "ms"]
+    assert slowest.split() == ["generate_content", "100", "5.05", "50.0", "95.0", "100.0"]
+    assert fastest.split() == ["stats.write", "1", "0.00", "0.5", "0.5", "0.5"]
+
+
+def test_empty_summary(tmp_path):
+    path = tmp_path / "trace.json"
+    path.write_text("[\n")
+    assert tracing.summary(str(path)).startswith("No spans")
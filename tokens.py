@@ -0,0 +1,124 @@
+import json
+import math
+import threading
+import weakref
+
+from google.genai import types
+
+
+CHARACTERS_PER_TOKEN = 4
+"""Rough average for English text and code, used to estimate token counts without calling the API."""
+
+# Calibrated ratios outside of these bounds come from bogus counts, and are ignored
+MIN_CHARACTERS_PER_TOKEN = 1.0
+MAX_CHARACTERS_PER_TOKEN = 8.0
+
+# Weight of the latest count when calibrating, older counts weigh less and less
+CALIBRATION_WEIGHT = 0.5
+
+
+class TokenBudgetExceeded(Exception):
+    """A request would be larger than the configured limits, even after compacting it."""
+
+
+def estimate_tokens(contents: list[types.Content]) -> int:
+    """Returns an estimate of the number of prompt tokens needed to send the given messages."""
+    return sum(content_tokens(content) for content in contents)
+
+
+def content_tokens(content: types.Content) -> int:
+    """Returns an estimate of the number of tokens of a single message."""
+    return math.ceil(content_characters(content) / CHARACTERS_PER_TOKEN)
+
+
+def content_characters(content: types.Content) -> int:
+    return sum(part_characters(part) for part in content.parts or [])
+
+
+def part_characters(part: types.Part) -> int:
+    """Returns the number of characters of a message part, measured only the first time:
+    parts are never modified (changed messages get new parts), so each iteration only measures
+    the parts added since the previous one, instead of serializing the whole history again."""
+    key = id(part)
+    entry = _part_characters.get(key)
+    if entry is not None and entry[0]() is part:
+        return entry[1]
+    characters = _measure(part)
+    reference = weakref.ref(part, lambda reference: _forget(key, reference))
+    with _part_characters_lock:
+        _part_characters[key] = (reference, characters)
+    return characters
+
+
+# id() of a part -> weak reference to it, and its number of characters.
+# Entries are removed when their part is garbage collected, as its id can then be reused.
+_part_characters: dict[int, tuple[weakref.ref, int]] = {}
+_part_characters_lock = threading.Lock()
+
+
+def _forget(key: int, reference: weakref.ref) -> None:
+    with _part_characters_lock:
+        entry = _part_characters.get(key)
+        # The id may already belong to a newer part
+        if entry is not None and entry[0] is reference:
+            del _part_characters[key]
+
+
+def _measure(part: types.Part) -> int:
+    characters = 0
+    if part.text:
+        characters += len(part.text)
+    if part.function_call:
+        characters += len(part.function_call.name or "")
+        characters += len(json.dumps(part.function_call.args or {}, ensure_ascii=False))
+    if part.function_response:
+        characters += len(part.function_response.name or "")
+        characters += len(json.dumps(part.function_response.response or {}, ensure_ascii=False, default=str))
+    return characters
+
+
+class TokenEstimator:
+    """Predicts the prompt tokens of a request before sending it, to check it against the limits.
+
+    Characters of the messages (memoized per part, see `part_characters()`) plus those sent with
+    every request (system prompt and function declarations) are converted to tokens with a ratio
+    calibrated on real counts: the prompt tokens reported in the usage of every response,
+    and `count()` when an exact number is needed.
+
+    It is safe to use from multiple threads.
+    """
+
+    def __init__(self, overhead_characters: int = 0) -> None:
+        self.overhead_characters = overhead_characters
+        self.characters_per_token = float(CHARACTERS_PER_TOKEN)
+        self._lock = threading.Lock()
+
+    def estimate(self, contents: list[types.Content]) -> int:
+        """Returns the estimated prompt tokens of a request with the given messages."""
+        characters = self.overhead_characters + sum(content_characters(content) for content in contents)
+        return math.ceil(characters / self.characters_per_token)
+
+    def calibrate(self, contents: list[types.Content], prompt_tokens: int | None) -> None:
+        """Adjusts the ratio with the actual prompt tokens of a request with the given messages."""
+        if not prompt_tokens:
+            return
+        characters = self.overhead_characters + sum(content_characters(content) for content in contents)
+        ratio = characters / prompt_tokens
+        if not MIN_CHARACTERS_PER_TOKEN <= ratio <= MAX_CHARACTERS_PER_TOKEN:
+            return
+        with self._lock:
+            self.characters_per_token += CALIBRATION_WEIGHT * (ratio - self.characters_per_token)
+
+    def count(self, client, model: str, contents: list[types.Content]) -> int:
+        """Returns the prompt tokens of a request with the given messages, counted by the API.
+        The API can't count the system prompt and function declarations, which are estimated."""
+        content_tokens = client.models.count_tokens(model=model, contents=contents).total_tokens or 0
+        overhead_tokens = math.ceil(self.overhead_characters / self.characters_per_token)
+        self.calibrate(contents, content_tokens + overhead_tokens)
+        return content_tokens + overhead_tokens
+
+    def content_budget(self, prompt_tokens: int) -> int:
+        """Converts a budget of prompt tokens into a budget for `estimate_tokens()` of the messages,
+        which is what `compaction.ContextCompactor` works with."""
+        characters = prompt_tokens * self.characters_per_token - self.overhead_characters
+        return max(math.floor(characters / CHARACTERS_PER_TOKEN), 0)
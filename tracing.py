@@ -0,0 +1,182 @@
+"""Timing of the stages of an agent session: model requests, function calls, tools, stats writes.
+
+Code to measure is wrapped in a span, with attributes such as tokens or sizes:
+
+    with tracing.span("generate_content", iteration=3) as span:
+        ...
+        span.set("total_tokens", 1234)
+
+When tracing is disabled `span()` returns a shared object that does nothing,
+so spans can be left everywhere at almost no cost.
+
+Spans are appended to the trace file as complete events of the Chrome trace format, one per line.
+The file is a JSON array whose closing bracket is missing, which that format allows: it can be
+opened as it is in chrome://tracing or https://ui.perfetto.dev, and read line by line like JSONL.
+Use `summary()` (`main.py trace summary`) for the latency percentiles of each stage.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+from config import TRACE_FILE_NAME, TRACING_ENABLED
+
+
+class Span:
+    """A timed section of code, written to the trace when its context exits."""
+
+    __slots__ = ("name", "attributes", "_tracer", "_start_ns")
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: dict) -> None:
+        self.name = name
+        self.attributes = attributes
+        self._tracer = tracer
+        self._start_ns = 0
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self._start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        end_ns = time.perf_counter_ns()
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self._tracer.write(self.name, self._start_ns, end_ns, self.attributes)
+
+
+class NoSpan:
+    """Returned by `span()` when tracing is disabled."""
+
+    __slots__ = ()
+
+    def set(self, key: str, value) -> None:
+        pass
+
+    def __enter__(self) -> "NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+
+_NO_SPAN = NoSpan()
+
+
+class Tracer:
+    """Writes spans to a trace file. The file is opened on the first span, and every span
+    is written as soon as it ends, so the trace is complete even if the process is killed.
+    It is safe to use from multiple threads."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file = None
+        self._pid = os.getpid()
+        # Event times are microseconds since the epoch, measured with the monotonic clock
+        self._epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def span(self, name: str, attributes: dict) -> Span:
+        return Span(self, name, attributes)
+
+    def write(self, name: str, start_ns: int, end_ns: int, attributes: dict) -> None:
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start_ns + self._epoch_offset_ns) // 1000,
+            "dur": (end_ns - start_ns) // 1000,
+            "pid": self._pid,
+            "tid": threading.get_ident(),
+            "args": attributes,
+        }
+        line = json.dumps(event, separators=(",", ":"), default=str) + ",\n"
+        with self._lock:
+            if self._file is None:
+                # Line buffered, and appended with a single write per event
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+                if self._file.tell() == 0:
+                    self._file.write("[\n")
+            self._file.write(line)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_tracer: Tracer | None = Tracer(TRACE_FILE_NAME) if TRACING_ENABLED else None
+
+
+def span(name: str, **attributes) -> Span | NoSpan:
+    """Returns a context manager that measures the time spent in it, if tracing is enabled."""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, attributes)
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def enable(path: str = TRACE_FILE_NAME) -> None:
+    """Starts writing spans to the given file, e.g. for a single run with --trace."""
+    global _tracer
+    disable()
+    _tracer = Tracer(path)
+
+
+def disable() -> None:
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+atexit.register(disable)
+
+
+def read_events(path: str) -> list[dict]:
+    """Returns the complete events of a trace file. Works with files that were
+    closed with a "]" too, and ignores a last line that was only partially written."""
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip().rstrip(",")
+            if line in ("", "[", "]"):
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("ph") == "X":
+                events.append(event)
+    return events
+
+
+def summary(path: str = TRACE_FILE_NAME) -> str:
+    """Returns a table with the number of spans, the total time and the latency percentiles
+    of each stage in the trace, the stages where most time was spent first."""
+    durations: dict[str, list[int]] = {}
+    for event in read_events(path):
+        durations.setdefault(event["name"], []).append(event["dur"])
+    if not durations:
+        return f'No spans in "{path}"'
+
+    lines = [f"{'stage':<28} {'count':>7} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"]
+    for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        lines.append(
+            f"{name:<28} {len(values):>7} {sum(values) / 1e6:>9.2f}"
+            f" {_percentile(values, 50) / 1e3:>9.1f} {_percentile(values, 95) / 1e3:>9.1f} {values[-1] / 1e3:>9.1f}"
+        )
+    return "\n".join(lines)
+
+
+def _percentile(sorted_values: list[int], percent: float) -> int:
+    # Nearest rank
+    rank = max(int(-(-percent * len(sorted_values) // 100)), 1)
+    return sorted_values[rank - 1]